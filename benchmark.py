@@ -0,0 +1,358 @@
+import asyncio
+import contextlib
+import csv
+import json
+import logging
+import os
+import platform
+import random
+import tempfile
+import time
+import argparse
+
+import anthropic
+import httpx
+
+from datetime import date, timedelta
+from bisect import bisect_left, bisect_right
+from typing import List
+from gql.transport.exceptions import TransportServerError
+
+import main
+
+RETAIL_HEADER = ['Website', 'Order ID', 'Order Date', 'Purchase Order Number', 'Currency', 'Unit Price',
+                 'Unit Price Tax', 'Shipping Charge', 'Total Discounts', 'Total Owed', 'Shipment Item Subtotal',
+                 'Shipment Item Subtotal Tax', 'ASIN', 'Product Condition', 'Quantity', 'Payment Instrument Type',
+                 'Order Status', 'Shipment Status', 'Ship Date', 'Shipping Option', 'Shipping Address',
+                 'Billing Address', 'Carrier Name & Tracking Number', 'Product Name', 'Gift Message',
+                 'Gift Sender Name', 'Gift Recipient Contact Details', 'Item Serial Number']
+DIGITAL_ITEMS_HEADER = ['DigitalOrderItemId', 'ProductName', 'FulfilledDate', 'OrderDate', 'OrderId']
+DIGITAL_MONETARY_HEADER = ['DigitalOrderItemId', 'TransactionAmount', 'Currency']
+RETAIL_CSV = 'Your Orders/Retail.OrderHistory.{shard}/Retail.OrderHistory.{shard}.csv'
+DIGITAL_ITEMS_CSV = 'Your Orders/Digital-Ordering.1/Digital Items.csv'
+DIGITAL_MONETARY_CSV = 'Your Orders/Digital-Ordering.1/Digital Orders Monetary.csv'
+BENCHMARK_CATEGORIES = ['Shopping', 'Groceries', 'Electronics', 'Entertainment', 'Home Improvement', 'Clothing',
+                        'Pets', 'Books']
+PRODUCT_WORDS = ['Wireless', 'Organic', 'Stainless', 'Portable', 'Kids', 'Premium', 'Cotton', 'Smart', 'Glass',
+                 'Charger', 'Coffee', 'Blender', 'Notebook', 'Shirt', 'Leash', 'Drill', 'Novel', 'Lamp', 'Towel',
+                 'Headphones', 'Vitamins', 'Batteries', 'Backpack', 'Mug']
+DEFAULT_ORDER_COUNTS = [1000, 10000, 100000]
+DEFAULT_OUTPUT_FILE = 'benchmark_results.json'
+
+
+def random_product(rng: random.Random) -> str:
+    return ' '.join(rng.sample(PRODUCT_WORDS, 3)) + f" {rng.randint(1, 500)}"
+
+
+def amazon_timestamp(day: date) -> str:
+    return f"{day.isoformat()}T12:00:00Z"
+
+
+def generate_orders_folder(root: str, orders: int, start_date: date, days: int, split_rate: float = 0.1,
+                           digital_rate: float = 0.1, noise_rate: float = 0.05, seed: int = 0,
+                           retail_shards: int = 1) -> List[dict]:
+    """
+    Write a synthetic 'Your Orders' folder under root and return the Monarch transactions its orders were charged as.
+
+    Single-item orders are charged once. Multi-item orders are charged per shipment with probability split_rate, and
+    otherwise either item by item or as one order total. noise_rate adds unrelated Amazon charges. Retail orders are
+    spread round-robin over retail_shards Retail.OrderHistory.N folders.
+    """
+    rng = random.Random(seed)
+    retail_paths = [os.path.join(root, RETAIL_CSV.format(shard=shard)) for shard in range(1, retail_shards + 1)]
+    for path in retail_paths + [os.path.join(root, DIGITAL_ITEMS_CSV)]:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    transactions = []
+
+    def charge(amount_cents: int, day: date, merchant: str = 'Amazon'):
+        transactions.append({'id': f"txn-{len(transactions)}", 'amount': -amount_cents / 100,
+                             'date': day.isoformat(), 'merchant': {'name': merchant}, 'notes': '',
+                             'category': {'id': 'cat-0', 'name': BENCHMARK_CATEGORIES[0]}})
+
+    with contextlib.ExitStack() as stack:
+        retail_writers = [csv.writer(stack.enter_context(open(path, 'w', newline=''))) for path in retail_paths]
+        digital_items = csv.writer(stack.enter_context(open(os.path.join(root, DIGITAL_ITEMS_CSV), 'w', newline='')))
+        digital_monetary = csv.writer(stack.enter_context(open(os.path.join(root, DIGITAL_MONETARY_CSV), 'w',
+                                                               newline='')))
+        for retail in retail_writers:
+            retail.writerow(RETAIL_HEADER)
+        digital_items.writerow(DIGITAL_ITEMS_HEADER)
+        digital_monetary.writerow(DIGITAL_MONETARY_HEADER)
+
+        for order_number in range(orders):
+            order_date = start_date + timedelta(days=rng.randrange(days))
+            charge_date = order_date + timedelta(days=rng.randint(0, 3))
+
+            if rng.random() < digital_rate:
+                item_id = f"D{order_number:08d}"
+                cents = rng.randint(99, 2999)
+                digital_items.writerow([item_id, random_product(rng), amazon_timestamp(order_date),
+                                        amazon_timestamp(order_date), f"D01-{order_number:08d}"])
+                digital_monetary.writerow([item_id, f"{cents / 100:.2f}", 'USD'])
+                charge(cents, charge_date, rng.choice(['Amazon Digital', 'Prime Video']))
+                continue
+
+            order_id = f"111-{order_number:07d}-{rng.randint(0, 9999999):07d}"
+            retail = retail_writers[order_number % retail_shards]
+            item_cents = [rng.randint(199, 25000) for _ in range(rng.choice([1, 1, 1, 2, 2, 3, 4]))]
+            ship_dates = []
+            for cents in item_cents:
+                ship_date = order_date + timedelta(days=rng.randint(0, 2))
+                ship_dates.append(ship_date)
+                row = [''] * len(RETAIL_HEADER)
+                row[0], row[1], row[2], row[4] = 'Amazon.com', order_id, amazon_timestamp(order_date), 'USD'
+                row[9] = f"{cents / 100:,.2f}"
+                row[18] = amazon_timestamp(ship_date) if rng.random() > 0.02 else main.NOT_AVAILABLE
+                row[23] = random_product(rng)
+                retail.writerow(row)
+
+            if len(item_cents) == 1:
+                charge(item_cents[0], charge_date)
+            elif rng.random() < split_rate:
+                shipments = rng.randint(2, len(item_cents))
+                groups = [[] for _ in range(shipments)]
+                for position, cents in enumerate(item_cents):
+                    groups[position if position < shipments else rng.randrange(shipments)].append(cents)
+                for group in groups:
+                    charge(sum(group), charge_date + timedelta(days=rng.randint(0, 1)))
+            elif rng.random() < 0.5:
+                for cents, ship_date in zip(item_cents, ship_dates):
+                    charge(cents, ship_date + timedelta(days=rng.randint(0, 1)))
+            else:
+                charge(sum(item_cents), charge_date)
+
+        for _ in range(int(orders * noise_rate)):
+            charge(rng.randint(199, 25000), start_date + timedelta(days=rng.randrange(days)))
+
+    return transactions
+
+
+class FakeMonarchMoney:
+    """
+    In-process stand-in for MonarchMoney with configurable latency, write failures and throttling. Throttled calls
+    raise the TransportServerError with code 429 that monarchmoney's GraphQL transport raises for a real 429.
+    """
+
+    def __init__(self, transactions: List[dict], read_latency: float = 0.05, write_latency: float = 0.02,
+                 write_failure_rate: float = 0.0, seed: int = 0, throttle_rate: float = 0.0):
+        self.transactions = sorted(transactions, key=lambda transaction: transaction['date'])
+        self._dates = [transaction['date'] for transaction in self.transactions]
+        self._by_id = {transaction['id']: transaction for transaction in self.transactions}
+        self._results = {}
+        self.read_latency = read_latency
+        self.write_latency = write_latency
+        self.write_failure_rate = write_failure_rate
+        self.throttle_rate = throttle_rate
+        self._rng = random.Random(seed)
+        self.read_calls = 0
+        self.write_calls = 0
+        self.write_failures = 0
+        self.throttled = 0
+
+    def maybe_throttle(self, endpoint: str) -> None:
+        if self._rng.random() < self.throttle_rate:
+            self.throttled += 1
+            raise TransportServerError(f'Injected 429 Too Many Requests from {endpoint}', 429)
+
+    async def login(self, *args, **kwargs):
+        return None
+
+    async def get_transaction_categories(self):
+        return {'categories': [{'id': f"cat-{position}", 'name': name}
+                               for position, name in enumerate(BENCHMARK_CATEGORIES)]}
+
+    async def get_transactions(self, limit: int = main.DEFAULT_RECORD_LIMIT, offset: int = 0, start_date: str = None,
+                               end_date: str = None, search: str = '', category_ids: List[str] = None,
+                               has_notes: bool = None, **kwargs) -> dict:
+        self.read_calls += 1
+        await asyncio.sleep(self.read_latency)
+        self.maybe_throttle('get_transactions')
+        key = (start_date, end_date, search.lower(), tuple(category_ids or ()), has_notes)
+        results = self._results.get(key)
+        if results is None:
+            low = bisect_left(self._dates, start_date) if start_date else 0
+            high = bisect_right(self._dates, end_date) if end_date else len(self._dates)
+            results = [transaction for transaction in self.transactions[low:high]
+                       if key[2] in transaction['merchant']['name'].lower()
+                       and (not category_ids or transaction['category']['id'] in category_ids)
+                       and (has_notes is None or bool(transaction['notes']) == has_notes)]
+            self._results[key] = results
+        return {'allTransactions': {'totalCount': len(results), 'results': results[offset:offset + limit]}}
+
+    async def update_transaction(self, transaction_id: str, notes: str = None, category_id: str = None, **kwargs):
+        self.write_calls += 1
+        await asyncio.sleep(self.write_latency)
+        self.maybe_throttle('update_transaction')
+        if self._rng.random() < self.write_failure_rate:
+            self.write_failures += 1
+            raise Exception(f"Injected failure updating {transaction_id}")
+        transaction = self._by_id[transaction_id]
+        if notes is not None:
+            transaction['notes'] = notes
+        if category_id is not None:
+            transaction['category'] = {'id': category_id}
+        self._results.clear()
+        return {'updateTransaction': {'transaction': {'id': transaction_id}}}
+
+
+class FakeMessages:
+    def __init__(self, owner: 'FakeAsyncAnthropic'):
+        self.owner = owner
+
+    async def create(self, extra_headers: dict = None, **request):
+        return await self.owner.respond(request)
+
+
+def fake_message(text: str, input_tokens: int, cache_creation_input_tokens: int = 0,
+                 cache_read_input_tokens: int = 0) -> anthropic.types.Message:
+    return anthropic.types.Message.model_validate({
+        'id': 'msg_fake', 'type': 'message', 'role': 'assistant', 'model': main.CLASSIFIER_MODEL,
+        'content': [{'type': 'text', 'text': text}], 'stop_reason': 'end_turn', 'stop_sequence': None,
+        'usage': {'input_tokens': input_tokens, 'output_tokens': max(1, len(text) // 4),
+                  'cache_creation_input_tokens': cache_creation_input_tokens,
+                  'cache_read_input_tokens': cache_read_input_tokens},
+    })
+
+
+class FakeAsyncAnthropic:
+    """In-process stand-in for AsyncAnthropic that answers from the prompt, with latency and 429 injection."""
+
+    def __init__(self, latency: float = 0.3, throttle_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self._rng = random.Random(seed)
+        self.messages = FakeMessages(self)
+        self.calls = 0
+        self.throttled = 0
+        self._cached_prefixes = set()
+
+    async def respond(self, request: dict) -> anthropic.types.Message:
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        if self._rng.random() < self.throttle_rate:
+            self.throttled += 1
+            response = httpx.Response(429, request=httpx.Request('POST', 'https://api.anthropic.com/v1/messages'))
+            raise anthropic.RateLimitError('Injected rate limit', response=response, body=None)
+
+        prompt = request['messages'][0]['content']
+        system = request['system'][0]['text']
+        count = system[system.index('<categories>'):].count('\n') - 1
+        if '<items>' in prompt:
+            text = '\n'.join(f"{item_id}:{self._rng.randint(1, count)}" for item_id in range(prompt.count('<item id=')))
+        else:
+            text = str(self._rng.randint(1, count))
+        # Like the real prompt cache, the first request with a given system prefix writes it and later ones read it
+        if system in self._cached_prefixes:
+            return fake_message(text, len(prompt) // 4, cache_read_input_tokens=len(system) // 4)
+        self._cached_prefixes.add(system)
+        return fake_message(text, len(prompt) // 4, cache_creation_input_tokens=len(system) // 4)
+
+
+async def run_benchmark(orders: int, args: argparse.Namespace) -> dict:
+    start_date = date(2023, 1, 1)
+    end_date = start_date + timedelta(days=args.days - 1)
+    with tempfile.TemporaryDirectory() as root:
+        started = time.perf_counter()
+        transactions = generate_orders_folder(root, orders, start_date, args.days, args.split_rate,
+                                              args.digital_rate, args.noise_rate, args.seed, args.retail_shards)
+        generate_seconds = time.perf_counter() - started
+
+        mm = FakeMonarchMoney(transactions, args.monarch_read_latency, args.monarch_write_latency,
+                              args.write_failure_rate, args.seed, args.monarch_throttle_rate)
+        anthropic_client = FakeAsyncAnthropic(args.anthropic_latency, args.throttle_rate, args.seed)
+        state = main.StateStore(os.path.join(root, main.DEFAULT_STATE_FILE))
+        cache = main.ClassificationCache(os.path.join(root, main.DEFAULT_CACHE_FILE)) if args.cache else None
+        metrics = main.RunMetrics()
+        try:
+            summary = await main.match_and_update_transactions(
+                mm, anthropic_client, main.discover_order_files(os.path.join(root, main.DEFAULT_ORDERS_DIR)), None,
+                1.0 / args.requests_per_second,
+                start_date.isoformat(), end_date.isoformat(), max_concurrency=args.max_concurrency,
+                requests_per_second=args.requests_per_second, cache=cache, batch_size=args.batch_size,
+                state=state, write_concurrency=args.write_concurrency,
+                dead_letter_file=os.path.join(root, main.DEFAULT_DEAD_LETTER_FILE),
+                dry_run_file=os.path.join(root, main.DEFAULT_DRY_RUN_FILE),
+                fetch_concurrency=args.fetch_concurrency, metrics=metrics, parse_workers=args.parse_workers)
+        finally:
+            state.close()
+            if cache is not None:
+                cache.close()
+
+    return {
+        'orders': orders,
+        'transactions': len(transactions),
+        'generate_seconds': generate_seconds,
+        'summary': summary,
+        'metrics': metrics.summary(),
+        'monarch': {'read_calls': mm.read_calls, 'write_calls': mm.write_calls,
+                    'write_failures': mm.write_failures, 'throttled': mm.throttled},
+        'anthropic': {'calls': anthropic_client.calls, 'throttled': anthropic_client.throttled},
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark match_and_update_transactions on synthetic order data.')
+    parser.add_argument('--orders', nargs='+', type=int, default=DEFAULT_ORDER_COUNTS,
+                        help='Order counts to benchmark (space-separated, default 1000 10000 100000)')
+    parser.add_argument('--days', type=int, default=365, help='Days the generated orders are spread over')
+    parser.add_argument('--split_rate', type=float, default=0.1,
+                        help='Share of multi-item orders charged once per shipment')
+    parser.add_argument('--digital_rate', type=float, default=0.1, help='Share of orders that are digital')
+    parser.add_argument('--noise_rate', type=float, default=0.05,
+                        help='Unrelated Amazon charges to add, as a share of the order count')
+    parser.add_argument('--monarch_read_latency', type=float, default=0.05,
+                        help='Seconds each fake get_transactions call takes')
+    parser.add_argument('--monarch_write_latency', type=float, default=0.0,
+                        help='Seconds each fake update_transaction call takes')
+    parser.add_argument('--write_failure_rate', type=float, default=0.0,
+                        help='Probability a fake update_transaction call fails')
+    parser.add_argument('--monarch_throttle_rate', type=float, default=0.0,
+                        help='Probability a fake get_transactions or update_transaction call is rejected with a 429')
+    parser.add_argument('--anthropic_latency', type=float, default=0.0,
+                        help='Seconds each fake Anthropic call takes')
+    parser.add_argument('--throttle_rate', type=float, default=0.0,
+                        help='Probability a fake Anthropic call is rejected with a 429')
+    parser.add_argument('--max_concurrency', type=int, default=16, help='Classification requests in flight')
+    parser.add_argument('--requests_per_second', type=float, default=1000.0,
+                        help='Highest classification request rate')
+    parser.add_argument('--batch_size', type=int, default=main.DEFAULT_BATCH_SIZE,
+                        help='Descriptions to classify per request')
+    parser.add_argument('--write_concurrency', type=int, default=16, help='Monarch update workers')
+    parser.add_argument('--fetch_concurrency', type=int, default=main.DEFAULT_FETCH_CONCURRENCY,
+                        help='Concurrent get_transactions calls')
+    parser.add_argument('--retail_shards', type=int, default=1,
+                        help='Retail.OrderHistory.N folders the generated retail orders are spread over')
+    parser.add_argument('--parse_workers', type=int, default=main.DEFAULT_PARSE_WORKERS,
+                        help='Processes used to parse the dump shards')
+    parser.add_argument('--cache', action='store_true', help='Use a (fresh) classification cache')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the generator and fakes')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT_FILE, help='File to write the JSON results to')
+    parser.add_argument('--log_level', default='ERROR', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help="Log level for the script's own output")
+    return parser.parse_args()
+
+
+async def run_all(args: argparse.Namespace) -> dict:
+    runs = []
+    for orders in args.orders:
+        result = await run_benchmark(orders, args)
+        timings = result['summary']['timings']
+        print(f"{orders} orders: {timings['total']:.2f}s total (" +
+              ', '.join(f"{phase} {seconds:.2f}s" for phase, seconds in timings.items() if phase != 'total') + ')')
+        runs.append(result)
+    return {
+        'version': main.__version__,
+        'python': platform.python_version(),
+        'settings': {key: value for key, value in vars(args).items() if key not in ('orders', 'output', 'log_level')},
+        'runs': runs,
+    }
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    logging.basicConfig(level=arguments.log_level, format='%(message)s')
+    results = asyncio.run(run_all(arguments))
+    with open(arguments.output, 'w') as results_file:
+        json.dump(results, results_file, indent=2)
+    print(f"Wrote benchmark results to {arguments.output}")
@@ -1,436 +1,2978 @@
+import time
+
+MODULE_LOAD_STARTED = time.perf_counter()
+
 import asyncio
+import cProfile
 import csv
-import time
+import glob
+import gzip
+import hashlib
+import io
+import json
+import logging
+import math
+import multiprocessing
+import os
+import pstats
+import random
+import signal
+import sqlite3
+import sys
+import tracemalloc
+import zlib
 import argparse
-import numpy as np
-import pandas as pd
-
-import anthropic
-from anthropic import AsyncAnthropic
 
-from datetime import datetime, timedelta
-from typing import List, Tuple
-from collections import defaultdict
-from pprint import pprint
+from dataclasses import dataclass, replace
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from typing import TYPE_CHECKING, Awaitable, Callable, Iterator, List, NamedTuple, Optional, Tuple
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, deque
+from pprint import pformat
 import configparser
+import contextvars
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
 from monarchmoney import MonarchMoney
 
+# pandas, numpy and anthropic take most of the start-up time, so they are imported by the code paths that use them
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+
+MODULE_LOAD_SECONDS = time.perf_counter() - MODULE_LOAD_STARTED
+
 DEFAULT_RECORD_LIMIT = 100
-ORDER_ID_INDEX = 0
-SUB_TOTAL_INDEX = 4
-DESCRIPTION_INDEX = 1
-DELIVERY_DATE_INDEX = 2
-ORDER_DATE_INDEX = 3
-IS_DIGITAL_ORDER_INDEX = 5
+UNIX_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+DEFAULT_SESSION_FILE = '.mm/mm_session.pickle'
+DEFAULT_CATEGORIES_CACHE_FILE = '.categories_cache.json'
+DEFAULT_CATEGORIES_REFRESH_HOURS = 24.0
+DEFAULT_FETCH_CONCURRENCY = 4
+READ_MAX_ATTEMPTS = 5
+READ_BACKOFF_SECONDS = 1.0
+RETAIL_ORDER_ID_COLUMN = 'Order ID'
+RETAIL_SUB_TOTAL_COLUMN = 'Total Owed'
+RETAIL_DESCRIPTION_COLUMN = 'Product Name'
+RETAIL_DELIVERY_DATE_COLUMN = 'Ship Date'
+RETAIL_ORDER_DATE_COLUMN = 'Order Date'
+DIGITAL_ITEM_ID_COLUMN = 'DigitalOrderItemId'
+DIGITAL_DESCRIPTION_COLUMN = 'ProductName'
+DIGITAL_DELIVERY_DATE_COLUMN = 'FulfilledDate'
+DIGITAL_ORDER_DATE_COLUMN = 'OrderDate'
+DIGITAL_AMOUNT_COLUMN = 'TransactionAmount'
+DEFAULT_SNAPSHOT_DIR = '.order_snapshots'
+DEFAULT_ORDERS_DIR = 'Your Orders'
+RETAIL_SHARD_PATTERN = os.path.join('Retail.OrderHistory.*', 'Retail.OrderHistory.*.csv')
+DIGITAL_SHARD_PATTERN = 'Digital-Ordering.*'
+DIGITAL_ITEMS_FILE = 'Digital Items.csv'
+DIGITAL_MONETARY_FILE = 'Digital Orders Monetary.csv'
+DEFAULT_PARSE_WORKERS = os.cpu_count() or 1
+# Enough distinct order and delivery dates for over a decade of history
+DAY_CACHE_SIZE = 4096
+DEFAULT_STATE_FILE = '.run_state.sqlite3'
+DEFAULT_WATCH_INTERVAL_SECONDS = 300.0
+DEFAULT_CASSETTE_FILE = 'traffic_cassette.json.gz'
+CASSETTE_VERSION = 1
+MONARCH_CASSETTE_ENDPOINTS = ('get_transactions', 'get_transaction_categories', 'update_transaction')
+PIPELINE_QUEUE_SIZE = 4
+PIPELINE_BATCH_SIZE = 64
+PIPELINE_BATCHES_PER_WORKER = 4
+SYNC_OVERLAP_DAYS = 7
+SYNC_CURSOR = 'monarch_transactions'
+DEFAULT_WRITE_CONCURRENCY = 4
+DEFAULT_WRITE_MAX_ATTEMPTS = 5
+WRITE_BACKOFF_SECONDS = 1.0
+DEFAULT_DEAD_LETTER_FILE = 'dead_letters.jsonl'
+DEFAULT_DRY_RUN_FILE = 'dry_run_updates.jsonl'
+DEFAULT_PLAN_FILE = 'match_plan.jsonl'
+COMMANDS = ('run', 'plan', 'apply')
+DEFAULT_ACCOUNTS_DIR = '.accounts'
+ACCOUNT_LOG_FORMAT = '[%(account)s] %(message)s'
+DEFAULT_METRICS_FILE = 'run_metrics.json'
+DEFAULT_PROFILE_FILE = 'run_profile.prof'
+DEFAULT_LOG_LEVEL = 'INFO'
+LATENCY_BUCKETS_SECONDS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROFILE_TOP_FUNCTIONS = 25
+PROFILE_TOP_ALLOCATIONS = 10
+MAX_EXACT_ASSIGNMENT_SIZE = 80
+MAX_SPLIT_ORDER_ITEMS = 30
+NOT_AVAILABLE = 'Not Available'
+MERCHANT_SEARCHES = ['Amazon', 'Prime Video']
+WINDOW_START_SLACK_DAYS = 1
+WINDOW_END_SLACK_DAYS = 4
+PRE_AGGREGATION_NOTE = ' ~Pre-aggregation match via auto-classifier script~'
+POST_AGGREGATION_NOTE = ' ~Post-aggregation match via auto-classifier script~'
+SPLIT_SHIPMENT_NOTE = ' ~Split-shipment match via auto-classifier script~'
+APPROXIMATE_NOTE = ' ~Amount differs by {difference}, match confidence {confidence:.2f}~'
+TOLERANCE_POLICIES = ('exact', 'absolute', 'percent', 'tax')
+DEFAULT_TOLERANCE_CENTS = 100
+DEFAULT_TOLERANCE_PERCENT = 2.0
+DEFAULT_TAX_RATE = 0.1
+TOLERANCE_PENALTY_DAYS = 30
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_REQUESTS_PER_SECOND = 5.0
+MAX_CLASSIFY_ATTEMPTS = 5
+CLASSIFY_BACKOFF_SECONDS = 1.0
+THROTTLE_STATUS_CODES = (429, 529)
+DEFAULT_CACHE_FILE = '.classification_cache.sqlite3'
+DEFAULT_CACHE_MAX_ENTRIES = 50000
+CLASSIFIER_MODEL = 'claude-3-5-sonnet-20240620'
+DEFAULT_BATCH_SIZE = 1
+DEFAULT_BATCH_POLL_SECONDS = 30.0
+CLASSIFY_MAX_TOKENS = 5
+BATCH_BASE_MAX_TOKENS = 5
+BATCH_ITEM_MAX_TOKENS = 8
+PROMPT_CACHING_BETA = 'prompt-caching-2024-07-31'
+NO_MATCHING_CATEGORY = "No matching category found"
+DEFAULT_LOCAL_CLASSIFIER_FILE = '.local_classifier.npz'
+DEFAULT_LOCAL_CONFIDENCE = 0.8
+LOCAL_FEATURE_DIMENSIONS = 2 ** 14
+LOCAL_MIN_EXAMPLES = 3
+LOCAL_TEMPERATURE = 0.05
+HISTORY_START_DATE = '2000-01-01'
+# Files each account of an --accounts run keeps to itself, under DEFAULT_ACCOUNTS_DIR/<account> unless its config says
+ACCOUNT_FILE_OPTIONS = {
+    'session_file': DEFAULT_SESSION_FILE,
+    'state_file': DEFAULT_STATE_FILE,
+    'dead_letter_file': DEFAULT_DEAD_LETTER_FILE,
+    'dry_run_file': DEFAULT_DRY_RUN_FILE,
+    'plan_file': DEFAULT_PLAN_FILE,
+    'categories_cache_file': DEFAULT_CATEGORIES_CACHE_FILE,
+    'local_classifier_file': DEFAULT_LOCAL_CLASSIFIER_FILE,
+    'metrics_file': DEFAULT_METRICS_FILE,
+}
 
 __version__ = "1.1.0"
 
-def process_csv_files(orders_file: str, transactions_file: str) -> []:
-    # Read the CSV files
-    orders_df = pd.read_csv(orders_file)
+logger = logging.getLogger(__name__)
+current_account = contextvars.ContextVar('current_account', default='-')
 
-    transactions_df = pd.read_csv(transactions_file)
 
-    # count the number of NAs in the column.
-    print(transactions_df[pd.to_numeric(transactions_df['TransactionAmount'], errors='coerce').isna()][
-              'TransactionAmount'])
-    transactions_df['TransactionAmount'] = (transactions_df['TransactionAmount']
-                                            .replace('Not Applicable', np.nan)
-                                            .astype(float))
+class AccountLogFilter(logging.Filter):
+    """Tag every log record with the account whose task or thread logged it, for ACCOUNT_LOG_FORMAT."""
 
-    # Group transactions by DigitalOrderItemId and sum TransactionAmount
-    transactions_grouped = transactions_df.groupby('DigitalOrderItemId')['TransactionAmount'].sum().reset_index()
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.account = current_account.get()
+        return True
 
-    # Merge the dataframes
-    merged_df = orders_df.merge(
-        transactions_grouped,
-        on='DigitalOrderItemId',
-        how='left'
-    )
+@dataclass(frozen=True, slots=True)
+class OrderItem:
+    """
+    One Amazon row. Money is integer cents and dates are day ordinals (date.toordinal()), so amounts compare exactly
+    and the matching loops never parse or allocate dates.
+    """
+    order_id: str  # interned, so the items of one order share a single string
+    description: str
+    delivery_day: Optional[int]  # None when Amazon reports the item as 'Not Available'
+    order_day: int
+    cents: Optional[int]  # None when the dump has no amount for the item
+    is_digital: bool
+    occurrence: int = 0  # position among the identical rows of its order, which are separate purchases
 
-    # Create the final dictionary
-    result = []
-    for _, row in merged_df.iterrows():
-        result.append([row['DigitalOrderItemId'], row['ProductName'], row['FulfilledDate'], row['OrderDate'],
-                       row['TransactionAmount'], 1
-                       ])
 
-    return result
+@dataclass(slots=True)
+class AggregatedOrder:
+    """The unmatched items of one order, matched against a single charge for their total."""
+    order_id: str
+    items: List[OrderItem]
 
+    @property
+    def cents(self) -> Optional[int]:
+        if any(item.cents is None for item in self.items):
+            return None
+        return sum(item.cents for item in self.items)
 
-async def classify_item(anthropic_client: any, categories: List[str], description: str):
-    prompt = f"Given the following categories:<categories>{', '.join(categories)}</categories>, classify the item with description <description>{description}</description>. Respond with only the category, no other text."
-    prompt.encode('utf-8')
+    @property
+    def description(self) -> str:
+        return ' '.join(item.description for item in self.items)
 
-    try:
-        response = await anthropic_client.messages.create(
-            messages=[{'role': 'user', 'content': prompt}],
-            stop_sequences=[anthropic.HUMAN_PROMPT],
-            max_tokens=1000,
-            model='claude-3-5-sonnet-20240620'
-        )
+    @property
+    def order_day(self) -> int:
+        return self.items[0].order_day
 
-        pprint(response.content)
-        result = response.content[0].text.strip()
+    @property
+    def delivery_day(self) -> Optional[int]:
+        return self.items[0].delivery_day
 
-        if result in categories:
-            return result
-        else:
-            return "No matching category found"
 
-    except anthropic.APIConnectionError as e:
-        print("The server could not be reached")
-        print(e)  # an underlying Exception, likely raised within httpx.
+@dataclass(frozen=True, slots=True)
+class UnmatchedRow:
+    order_id: str
+    order_day: int
+    delivery_day: Optional[int]
+    description: str
+    cents: int
 
 
-def process_categories(category_dict):
-    # todo type hint this
-    category_names = []
-    category_id_map = {}
+def item_key(item: OrderItem) -> str:
+    """
+    Stable identity of an Amazon row, used to recognize rows already processed by an earlier run. Repeats of an
+    identical row in the same order are told apart by their occurrence; the first keeps the key it always had.
+    """
+    key = (f'{item.order_id}|{item.description}|{date.fromordinal(item.order_day).isoformat()}|'
+           f'{item.cents}|{int(item.is_digital)}')
+    if item.occurrence:
+        key += f'|{item.occurrence}'
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
 
-    for category in category_dict['categories']:
-        name = category['name']
-        category_id = category['id']
 
-        category_names.append(name)
-        category_id_map[name] = category_id
+def format_day(day: Optional[int]) -> str:
+    return date.fromordinal(day).isoformat() if day is not None else NOT_AVAILABLE
 
-    return category_names, category_id_map
 
+def format_cents(cents: Optional[int]) -> str:
+    return f"${cents / 100:,.2f}" if cents is not None else NOT_AVAILABLE
 
-def parse_data(csv_file, digital_item_csv, digital_transaction_csv, start_date: str, end_date: str):
-    # todo type hint this
-    retail_order_id_index = 1
-    retail_sub_total_index = 9
-    retail_description_index = 23
-    retail_delivery_date_index = 18
-    retail_order_date_index = 2
-
-    def str_to_float(string, is_digital_order):
-        if not is_digital_order:
-            # Remove commas from the string
-            string = string.replace(',', '')
-
-        # Convert the modified string to a float
-        return round(float(string), 2)
-
-    def clean_retail_data(csv_file):
-        with open(csv_file, 'r') as file:
-            retail_data = csv.reader(file)
-            next(retail_data)  # Skip the header row
-            cleaned_data = []
-            for retail_row in retail_data:
-                cleaned_data.append(
-                    [retail_row[retail_order_id_index], retail_row[retail_description_index],
-                     retail_row[retail_delivery_date_index],
-                     retail_row[retail_order_date_index], retail_row[retail_sub_total_index], 0])
-            return cleaned_data
-
-    orders = defaultdict(dict)
+
+@lru_cache(maxsize=DAY_CACHE_SIZE)
+def parse_iso_day(value: str) -> Optional[int]:
     try:
-        cleaned_retail_data = clean_retail_data(csv_file)
-    except FileNotFoundError as e:
-        print(f"Error processing CSV file: {e}")
-        cleaned_retail_data = []
+        return date.fromisoformat(value).toordinal()
+    except ValueError:
+        return None
+
+
+def parse_amazon_day(value: str) -> Optional[int]:
+    """
+    Parse the date part of an Amazon timestamp such as 2024-01-31T18:04:22Z into a day ordinal, or None if it isn't
+    one. Timestamps are nearly unique, but their dates repeat, so only the date part is cached.
+    """
+    return parse_iso_day(value[:10]) if isinstance(value, str) else None
+
 
+def parse_delivery_day(value: str, order_day: int) -> Optional[int]:
+    if value == NOT_AVAILABLE:
+        return None
+    # Fall back to the order date when there is no usable delivery date, e.g. digital items without one
+    return parse_amazon_day(value) or order_day
+
+
+def parse_signed_cents(value: str) -> Optional[int]:
+    """Parse an Amazon amount such as '-1,234.56' into signed integer cents, or None if it isn't one."""
     try:
-        digital_data = process_csv_files(digital_item_csv, digital_transaction_csv)
-    except FileNotFoundError as e:
-        print(f"Error processing CSV files: {e}")
-        digital_data = []
-
-    data = cleaned_retail_data + digital_data
-    data.sort(key=lambda x: x[ORDER_DATE_INDEX])
-
-    for row in data:
-        if datetime.strptime(start_date, "%Y-%m-%d") <= datetime.strptime(row[ORDER_DATE_INDEX].split('T')[0], "%Y-%m-%d") <= datetime.strptime(end_date, "%Y-%m-%d"):
-            # if not is_digital_order_data_set and row[16] == 'Cancelled':
-            #     continue
-            order_id = f'{row[ORDER_ID_INDEX]}'
-            item_subtotal = str_to_float(row[SUB_TOTAL_INDEX], row[IS_DIGITAL_ORDER_INDEX])
-            if order_id in orders:
-                orders[order_id]['total_cost'] += item_subtotal
-                orders[order_id]['description'] += ' ' + row[DESCRIPTION_INDEX]
-            else:
-                orders[order_id] = {'total_cost': item_subtotal, 'description': row[DESCRIPTION_INDEX],
-                                    'delivery_date': row[DELIVERY_DATE_INDEX], 'order_date': row[ORDER_DATE_INDEX]}
-        else:
-            print(f"Skipping row order: {row[ORDER_ID_INDEX]} as it is outside the date range.")
-    return orders
+        return int(round(float(value.replace(',', '')) * 100))
+    except ValueError:
+        return None
 
 
-async def match_individual_items(mm: MonarchMoney, anthropic_client: any, individual_items: List, 
-                                category_ids: List[str], cat_names: List[str], cat_map: dict, 
-                                sleep_seconds: float, dry_run: bool = False) -> List:
-    matched_items = []
-    unmatched_items = []
-    
-    for item in individual_items:
-        order_id, description, delivery_date, order_date, subtotal, is_digital = item
-        print(f"Processing individual item - Order ID: {order_id}, Description: {description[:50]}{'...' if len(description) > 50 else ''}, Amount: ${subtotal}")
-        if delivery_date == 'Not Available':
-            unmatched_items.append(item)
+def parse_cents(value: str) -> Optional[int]:
+    """Parse an Amazon amount such as '1,234.56' into integer cents (ignoring the sign), or None if it isn't one."""
+    cents = parse_signed_cents(value)
+    return abs(cents) if cents is not None else None
+
+
+def find_columns(csv_file: str, header: List[str], columns: List[str]) -> List[int]:
+    """Return the position of each named column, so a reordered export still parses correctly."""
+    missing = [column for column in columns if column not in header]
+    if missing:
+        raise ValueError(f"{csv_file} is missing expected columns: {', '.join(missing)}")
+    return [header.index(column) for column in columns]
+
+
+def iter_retail_items(csv_file: str, start_day: int, end_day: int) -> Iterator[OrderItem]:
+    try:
+        file = open(csv_file, 'r', encoding='utf-8-sig', newline='')
+    except FileNotFoundError as e:
+        logger.error(f"Error processing CSV file: {e}")
+        return
+
+    with file:
+        retail_data = csv.reader(file)
+        header = next(retail_data, [])
+        order_id_index, description_index, delivery_date_index, order_date_index, sub_total_index = (
+            find_columns(csv_file, header, [RETAIL_ORDER_ID_COLUMN, RETAIL_DESCRIPTION_COLUMN,
+                                            RETAIL_DELIVERY_DATE_COLUMN, RETAIL_ORDER_DATE_COLUMN,
+                                            RETAIL_SUB_TOTAL_COLUMN]))
+        for retail_row in retail_data:
+            order_day = parse_amazon_day(retail_row[order_date_index])
+            if order_day is None or not start_day <= order_day <= end_day:
+                continue
+            yield OrderItem(sys.intern(retail_row[order_id_index]), retail_row[description_index],
+                            parse_delivery_day(retail_row[delivery_date_index], order_day), order_day,
+                            parse_cents(retail_row[sub_total_index]), False)
+
+
+def sum_digital_transactions(transactions_file: str) -> dict:
+    """
+    Sum the monetary rows of the digital dump in cents by DigitalOrderItemId, treating 'Not Applicable' as zero.
+    Promotions and credits are negative rows, so the rows are summed signed and only the total loses its sign.
+    """
+    totals = {}
+    with open(transactions_file, 'r', encoding='utf-8-sig', newline='') as file:
+        for row in csv.DictReader(file):
+            totals[row[DIGITAL_ITEM_ID_COLUMN]] = (totals.get(row[DIGITAL_ITEM_ID_COLUMN], 0)
+                                                   + (parse_signed_cents(row[DIGITAL_AMOUNT_COLUMN]) or 0))
+    return {item_id: abs(cents) for item_id, cents in totals.items()}
+
+
+def iter_digital_items(orders_file: str, transactions_file: str, start_day: int,
+                       end_day: int) -> Iterator[OrderItem]:
+    try:
+        totals = sum_digital_transactions(transactions_file)
+        file = open(orders_file, 'r', encoding='utf-8-sig', newline='')
+    except FileNotFoundError as e:
+        logger.error(f"Error processing CSV files: {e}")
+        return
+
+    with file:
+        for row in csv.DictReader(file):
+            order_day = parse_amazon_day(row[DIGITAL_ORDER_DATE_COLUMN])
+            if order_day is None or not start_day <= order_day <= end_day:
+                continue
+            yield OrderItem(sys.intern(row[DIGITAL_ITEM_ID_COLUMN]), row[DIGITAL_DESCRIPTION_COLUMN],
+                            parse_delivery_day(row[DIGITAL_DELIVERY_DATE_COLUMN], order_day), order_day,
+                            totals.get(row[DIGITAL_ITEM_ID_COLUMN]), True)
+
+
+def normalize_order_dates(frame: 'pd.DataFrame') -> 'pd.DataFrame':
+    """Parse the raw order/delivery date columns in place, the same way parse_delivery_day does row by row."""
+    import pandas as pd
+    order_dates = pd.to_datetime(frame['order_date'].str[:10], format='%Y-%m-%d', errors='coerce')
+    delivery_dates = pd.to_datetime(frame['delivery_date'].str[:10], format='%Y-%m-%d', errors='coerce')
+    delivery_dates = delivery_dates.fillna(order_dates).mask(frame['delivery_date'] == NOT_AVAILABLE)
+    frame['order_date'] = order_dates
+    frame['delivery_date'] = delivery_dates
+    return frame[order_dates.notna()]
+
+
+def load_retail_frame(csv_file: str) -> 'pd.DataFrame':
+    import pandas as pd
+    frame = pd.read_csv(csv_file, usecols=[RETAIL_ORDER_ID_COLUMN, RETAIL_DESCRIPTION_COLUMN,
+                                           RETAIL_DELIVERY_DATE_COLUMN, RETAIL_ORDER_DATE_COLUMN,
+                                           RETAIL_SUB_TOTAL_COLUMN],
+                        dtype=str, keep_default_na=False, encoding='utf-8-sig')
+    frame = frame.rename(columns={RETAIL_ORDER_ID_COLUMN: 'order_id', RETAIL_DESCRIPTION_COLUMN: 'description',
+                                  RETAIL_DELIVERY_DATE_COLUMN: 'delivery_date',
+                                  RETAIL_ORDER_DATE_COLUMN: 'order_date', RETAIL_SUB_TOTAL_COLUMN: 'subtotal'})
+    frame['subtotal'] = pd.to_numeric(frame['subtotal'].str.replace(',', ''), errors='coerce').round(2)
+    frame['is_digital'] = False
+    return frame
+
+
+def load_digital_frame(orders_file: str, transactions_file: str) -> 'pd.DataFrame':
+    import pandas as pd
+    transactions = pd.read_csv(transactions_file, usecols=[DIGITAL_ITEM_ID_COLUMN, DIGITAL_AMOUNT_COLUMN],
+                               dtype=str, keep_default_na=False, encoding='utf-8-sig')
+    # 'Not Applicable' amounts count as zero, items without any monetary rows stay NaN
+    totals = (pd.to_numeric(transactions[DIGITAL_AMOUNT_COLUMN], errors='coerce').fillna(0.0)
+              .groupby(transactions[DIGITAL_ITEM_ID_COLUMN]).sum())
+
+    frame = pd.read_csv(orders_file, usecols=[DIGITAL_ITEM_ID_COLUMN, DIGITAL_DESCRIPTION_COLUMN,
+                                              DIGITAL_DELIVERY_DATE_COLUMN, DIGITAL_ORDER_DATE_COLUMN],
+                        dtype=str, keep_default_na=False, encoding='utf-8-sig')
+    frame = frame.rename(columns={DIGITAL_ITEM_ID_COLUMN: 'order_id', DIGITAL_DESCRIPTION_COLUMN: 'description',
+                                  DIGITAL_DELIVERY_DATE_COLUMN: 'delivery_date',
+                                  DIGITAL_ORDER_DATE_COLUMN: 'order_date'})
+    frame['subtotal'] = frame['order_id'].map(totals).round(2)
+    frame['is_digital'] = True
+    return frame
+
+
+def source_signature(paths: List[str], manifest: dict) -> str:
+    """
+    Hash the size, mtime and contents of each source file into one snapshot key.
+
+    Content hashes are remembered in the manifest by (path, size, mtime) so an unchanged dump isn't re-read.
+    """
+    signature = hashlib.sha256()
+    for path in paths:
+        if not os.path.exists(path):
+            signature.update(f'{path}:missing'.encode('utf-8'))
             continue
-            
+        stat = os.stat(path)
+        stat_key = f'{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}'
+        if stat_key not in manifest:
+            content_hash = hashlib.sha256()
+            with open(path, 'rb') as file:
+                for chunk in iter(lambda: file.read(1 << 20), b''):
+                    content_hash.update(chunk)
+            manifest[stat_key] = content_hash.hexdigest()
+        signature.update(f'{stat_key}:{manifest[stat_key]}'.encode('utf-8'))
+    return signature.hexdigest()[:32]
+
+
+def load_shard_frame(shard: Tuple[str, ...]) -> Optional['pd.DataFrame']:
+    """Load one retail CSV, or one digital (items, monetary) pair, as a table. Runs in a worker process."""
+    try:
+        return load_retail_frame(shard[0]) if len(shard) == 1 else load_digital_frame(*shard)
+    except FileNotFoundError as e:
+        logger.error(f"Error processing CSV files: {e}")
+        return None
+
+
+def load_orders_frame(order_files: 'OrderFiles', snapshot_dir: str = DEFAULT_SNAPSHOT_DIR,
+                      workers: int = DEFAULT_PARSE_WORKERS) -> 'pd.DataFrame':
+    """
+    Load every shard of the Amazon dump into one normalized table with vectorized parsing.
+
+    The shards are loaded in parallel and rows repeated across shards are dropped. The table is saved as a Parquet
+    snapshot keyed by the source files' size, mtime and hash, so later runs over the same dump read the snapshot
+    instead of the CSVs.
+    """
+    import pandas as pd
+    os.makedirs(snapshot_dir, exist_ok=True)
+    manifest_file = os.path.join(snapshot_dir, 'manifest.json')
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as file:
+            manifest = json.load(file)
+
+    snapshot_file = os.path.join(snapshot_dir, f'{source_signature(order_files.paths, manifest)}.parquet')
+    if os.path.exists(snapshot_file):
+        logger.info(f"Loading parsed orders from snapshot {snapshot_file}")
+        return pd.read_parquet(snapshot_file)
+
+    identity = ['is_digital', 'order_id', 'description', 'order_date', 'subtotal']
+    frames = [frame for frame in map_shards(load_shard_frame, order_files.shards, workers=workers)
+              if frame is not None]
+    for frame in frames:
+        # Number identical rows within each shard, so only copies of the same row in another shard are dropped
+        frame['occurrence'] = frame.groupby(identity, dropna=False).cumcount()
+    if frames:
+        merged = pd.concat(frames, ignore_index=True)
+        frame = normalize_order_dates(merged.drop_duplicates(identity + ['occurrence']).drop(columns='occurrence'))
+        logger.info(f"Dropped {len(merged) - len(frame)} rows repeated across shards")
+    else:
+        frame = pd.DataFrame({'order_id': [], 'description': [], 'delivery_date': pd.to_datetime([]),
+                              'order_date': pd.to_datetime([]), 'subtotal': [], 'is_digital': []})
+    frame.to_parquet(snapshot_file, index=False)
+    with open(manifest_file, 'w') as file:
+        json.dump(manifest, file)
+    logger.info(f"Saved parsed orders snapshot to {snapshot_file}")
+    return frame
+
+
+def iter_frame_items(frame: 'pd.DataFrame', start_day: int, end_day: int) -> Iterator[OrderItem]:
+    """Yield the table's items ordered between start_day and end_day, converting dates and amounts column-wise."""
+    import numpy as np
+    order_days = frame['order_date'].values.astype('datetime64[D]').astype(np.int64) + UNIX_EPOCH_ORDINAL
+    in_range = (order_days >= start_day) & (order_days <= end_day)
+    delivery_dates = frame['delivery_date'].values[in_range]
+    delivery_days = delivery_dates.astype('datetime64[D]').astype(np.int64) + UNIX_EPOCH_ORDINAL
+    cents = np.round(np.abs(frame['subtotal'].values[in_range].astype(np.float64)) * 100)
+    for order_id, description, delivery_day, has_delivery, order_day, item_cents, has_cents, is_digital in zip(
+            frame['order_id'].values[in_range].tolist(), frame['description'].values[in_range].tolist(),
+            delivery_days.tolist(), (~np.isnat(delivery_dates)).tolist(), order_days[in_range].tolist(),
+            np.nan_to_num(cents).astype(np.int64).tolist(), (~np.isnan(cents)).tolist(),
+            frame['is_digital'].values[in_range].tolist()):
+        yield OrderItem(sys.intern(order_id), description, delivery_day if has_delivery else None, order_day,
+                        item_cents if has_cents else None, bool(is_digital))
+
+
+class OrderFiles(NamedTuple):
+    """Every shard of an Amazon dump: the retail order history CSVs and the digital (items, monetary) CSV pairs."""
+    retail: Tuple[str, ...] = ()
+    digital: Tuple[Tuple[str, str], ...] = ()
+
+    @property
+    def shards(self) -> List[Tuple[str, ...]]:
+        return [(path,) for path in self.retail] + list(self.digital)
+
+    @property
+    def paths(self) -> List[str]:
+        return [path for shard in self.shards for path in shard]
+
+
+def discover_order_files(orders_dir: str = DEFAULT_ORDERS_DIR) -> OrderFiles:
+    """
+    Find every retail and digital shard under the dump folder. Large histories and accounts with several marketplaces
+    are split across Retail.OrderHistory.1, .2, ... and Digital-Ordering.1, .2, ...
+    """
+    root = glob.escape(orders_dir)
+    retail = tuple(sorted(glob.glob(os.path.join(root, RETAIL_SHARD_PATTERN))))
+    digital = tuple((os.path.join(folder, DIGITAL_ITEMS_FILE), os.path.join(folder, DIGITAL_MONETARY_FILE))
+                    for folder in sorted(glob.glob(os.path.join(root, DIGITAL_SHARD_PATTERN)))
+                    if os.path.isdir(folder))
+    if not retail and not digital:
+        logger.error(f"No order history CSVs found under {orders_dir}")
+    return OrderFiles(retail, digital)
+
+
+def map_shards(function: Callable, shards: List[tuple], *args, workers: int = DEFAULT_PARSE_WORKERS) -> list:
+    """
+    Call function(shard, *args) for every shard, across a process pool when there are several shards and workers.
+
+    Workers are spawned rather than forked: this runs in a thread beside the event loop and other accounts' runs, and
+    a forked child can inherit a lock, such as the logging lock, that another thread held at the time.
+    """
+    workers = min(workers, len(shards))
+    if workers <= 1:
+        return [function(shard, *args) for shard in shards]
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return list(executor.map(function, shards, *([arg] * len(shards) for arg in args)))
+
+
+def parse_order_shard(shard: Tuple[str, ...], start_day: int, end_day: int) -> List[tuple]:
+    """
+    Parse the items of one retail CSV, or one digital (items, monetary) pair. Runs in a worker process, so items are
+    returned as plain tuples, which are several times cheaper to send back than OrderItems.
+    """
+    items = iter_retail_items(shard[0], start_day, end_day) if len(shard) == 1 \
+        else iter_digital_items(*shard, start_day, end_day)
+    return [(item.order_id, item.description, item.delivery_day, item.order_day, item.cents, item.is_digital)
+            for item in items]
+
+
+def merge_shard_items(shard_items: List[List[tuple]]) -> List[OrderItem]:
+    """
+    Merge the items parsed from each shard, dropping rows repeated across shards, e.g. by overlapping exports.
+
+    Identical rows within one shard are separate purchases, so each row is kept as many times as it appears in the
+    shard with the most copies of it.
+    """
+    kept = defaultdict(int)
+    merged = []
+    for items in shard_items:
+        seen = defaultdict(int)
+        for order_id, description, delivery_day, order_day, cents, is_digital in items:
+            identity = (is_digital, order_id, description, order_day, cents)
+            seen[identity] += 1
+            if seen[identity] > kept[identity]:
+                kept[identity] = seen[identity]
+                merged.append(OrderItem(sys.intern(order_id), description, delivery_day, order_day, cents, is_digital))
+    duplicates = sum(len(items) for items in shard_items) - len(merged)
+    if duplicates:
+        logger.info(f"Dropped {duplicates} rows repeated across shards")
+    return merged
+
+
+def number_identical_items(items: Iterator[OrderItem]) -> Iterator[OrderItem]:
+    """Set each item's occurrence to the number of identical rows of its order seen before it."""
+    seen = defaultdict(int)
+    for item in items:
+        identity = (item.order_id, item.description, item.order_day, item.cents, item.is_digital)
+        occurrence = seen[identity]
+        seen[identity] += 1
+        yield replace(item, occurrence=occurrence) if occurrence else item
+
+
+def iter_order_items(order_files: OrderFiles, start_date: str, end_date: str, snapshot_dir: Optional[str] = None,
+                     workers: int = DEFAULT_PARSE_WORKERS) -> Iterator[OrderItem]:
+    """
+    Yield every retail and digital item ordered between start_date and end_date (inclusive), from every shard.
+
+    The shards are parsed in parallel, one per worker process. Each row's dates and amount are parsed exactly once and
+    rows outside the range are dropped before anything else is done with them, so memory stays proportional to the
+    date range rather than the whole dump. With a snapshot_dir the dump is instead loaded through the columnar loader
+    and its Parquet snapshot.
+    """
+    start = date.fromisoformat(start_date).toordinal()
+    end = date.fromisoformat(end_date).toordinal()
+    logger.info(f"Loading {len(order_files.retail)} retail and {len(order_files.digital)} digital order history shards")
+    if snapshot_dir is not None:
+        yield from number_identical_items(iter_frame_items(load_orders_frame(order_files, snapshot_dir, workers),
+                                                           start, end))
+        return
+    yield from number_identical_items(merge_shard_items(map_shards(parse_order_shard, order_files.shards, start, end,
+                                                                   workers=workers)))
+
+
+def to_cents(amount) -> int:
+    """Convert a dollar amount to integer cents, ignoring the sign. Returns None for missing amounts."""
+    if amount is None or (isinstance(amount, float) and math.isnan(amount)):
+        return None
+    return int(round(abs(amount) * 100))
+
+
+def get_transaction_window(order_day: int, delivery_day: int) -> Tuple[int, int]:
+    """Return the (start, end) posting day window a charge for this order could fall in."""
+    return order_day - WINDOW_START_SLACK_DAYS, delivery_day + WINDOW_END_SLACK_DAYS
+
+
+class TransactionIndex:
+    """
+    In-memory index of candidate Monarch transactions keyed by amount in integer cents.
+
+    Each amount holds its postings sorted by day ordinal so a date window can be found with a binary search. Posting
+    dates are parsed once, when the transaction is added. Matched transactions are removed so they can't be assigned
+    twice.
+    """
+
+    def __init__(self, transactions: List[dict] = ()):
+        self._days = defaultdict(list)
+        self._postings = defaultdict(list)
+        self._by_id = {}
+        self._sorted = None
+        for transaction in transactions:
+            self.add(transaction)
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __contains__(self, transaction_id):
+        return transaction_id in self._by_id
+
+    def __iter__(self):
+        return iter(self._by_id.values())
+
+    def add(self, transaction: dict) -> bool:
+        """Index a transaction, returning False if one with the same id is already indexed."""
+        if transaction['id'] in self._by_id:
+            return False
+        cents = to_cents(transaction['amount'])
+        day = date.fromisoformat(transaction['date']).toordinal()
+        days = self._days[cents]
+        position = bisect_right(days, day)
+        days.insert(position, day)
+        self._postings[cents].insert(position, transaction)
+        self._by_id[transaction['id']] = transaction
+        self._sorted = None
+        return True
+
+    def candidates(self, cents: Optional[int], start_day: int, end_day: int) -> List[Tuple[int, dict]]:
+        """Return (posting day, transaction) for this amount's transactions posted between start_day and end_day."""
+        if cents is None or cents not in self._days:
+            return []
+        days = self._days[cents]
+        start, end = bisect_left(days, start_day), bisect_right(days, end_day)
+        return list(zip(days[start:end], self._postings[cents][start:end]))
+
+    def _sorted_arrays(self) -> Tuple['np.ndarray', 'np.ndarray', List[dict]]:
+        """NumPy arrays of every transaction's cents and posting day sorted by (cents, day), built after each add."""
+        if self._sorted is None:
+            import numpy as np
+            transactions = list(self._by_id.values())
+            cents = np.fromiter((to_cents(transaction['amount']) for transaction in transactions), dtype=np.int64,
+                                count=len(transactions))
+            days = np.fromiter((date.fromisoformat(transaction['date']).toordinal() for transaction in transactions),
+                               dtype=np.int64, count=len(transactions))
+            order = np.lexsort((days, cents))
+            self._sorted = (cents[order], days[order], [transactions[position] for position in order])
+        return self._sorted
+
+    def candidates_between(self, low_cents: int, high_cents: int, start_day: int,
+                           end_day: int) -> List[Tuple[int, int, dict]]:
+        """
+        Return (cents, posting day, transaction) for transactions between low_cents and high_cents posted between
+        start_day and end_day. The amount range is two binary searches on the sorted cents array and the date window
+        is a vectorized filter over that slice. Removed transactions are skipped rather than rebuilding the arrays.
+        """
+        import numpy as np
+        cents, days, transactions = self._sorted_arrays()
+        start, end = np.searchsorted(cents, low_cents, 'left'), np.searchsorted(cents, high_cents, 'right')
+        window = days[start:end]
+        positions = np.flatnonzero((window >= start_day) & (window <= end_day)) + start
+        return [(int(cents[position]), int(days[position]), transactions[position]) for position in positions
+                if transactions[position]['id'] in self._by_id]
+
+    def remove(self, transaction_id: str) -> None:
+        transaction = self._by_id.pop(transaction_id, None)
+        if transaction is None:
+            return
+        cents = to_cents(transaction['amount'])
+        postings = self._postings[cents]
+        position = postings.index(transaction)
+        del postings[position]
+        del self._days[cents][position]
+
+
+def summarize_latencies(latencies: List[float]) -> str:
+    if not latencies:
+        return 'no calls'
+    ordered = sorted(latencies)
+    percentile = lambda fraction: ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000
+    return (f"{len(ordered)} calls, mean {sum(ordered) / len(ordered) * 1000:.0f} ms, p50 {percentile(0.5):.0f} ms, "
+            f"p95 {percentile(0.95):.0f} ms, max {ordered[-1] * 1000:.0f} ms")
+
+
+class RunMetrics:
+    """
+    Counters, API call latencies and token usage for one run.
+
+    Counters and call counts are grouped by the phase that was running when they were recorded; latencies are kept
+    per endpoint and summarized as percentiles plus a histogram over LATENCY_BUCKETS_SECONDS. The current phase is
+    tracked per asyncio task and thread, so pipeline stages running at the same time each count into their own phase.
+    """
+
+    def __init__(self):
+        self.started_at = datetime.now()
+        self._phase = contextvars.ContextVar(f'phase-{id(self)}', default='setup')
+        self.timings = {}
+        self.counters = defaultdict(lambda: defaultdict(int))
+        self.calls = defaultdict(lambda: defaultdict(int))
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.tokens = defaultdict(int)
+        self.peak_memory_bytes = None
+        self.queue_capacity = {}
+        self.queue_depths = defaultdict(list)
+        self.queue_full = defaultdict(int)
+
+    @property
+    def current_phase(self) -> str:
+        return self._phase.get()
+
+    @contextmanager
+    def phase(self, name: str):
+        """Attribute everything recorded in the block to phase `name` and add its wall-clock time to timings."""
+        token = self._phase.set(name)
+        started = time.perf_counter()
         try:
-            transaction_date_start = (datetime.strptime(order_date, '%Y-%m-%dT%H:%M:%SZ') - timedelta(
-                days=1)).strftime('%Y-%m-%d')
-        except ValueError:
-            transaction_date_start = (datetime.strptime(order_date, '%Y-%m-%dT%H:%M:%S.%fZ') - timedelta(
-                days=1)).strftime('%Y-%m-%d')
-
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - started
+            self._phase.reset(token)
+
+    def set_phase(self, name: str) -> None:
+        """Attribute everything the current task records from now on to phase `name`, for tasks that only do one job."""
+        self._phase.set(name)
+
+    def count(self, name: str, amount: int = 1) -> None:
+        self.counters[self.current_phase][name] += amount
+
+    @contextmanager
+    def call(self, endpoint: str):
+        """Time one API call, counting it as an error if it raises."""
+        self.calls[self.current_phase][endpoint] += 1
+        started = time.perf_counter()
         try:
-            transaction_date_end = (
-                    datetime.strptime(delivery_date, '%Y-%m-%dT%H:%M:%SZ') + timedelta(days=4)).strftime(
-                '%Y-%m-%d')
-        except ValueError:
-            try:
-                transaction_date_end = (
-                        datetime.strptime(delivery_date, '%Y-%m-%dT%H:%M:%S.%fZ') + timedelta(
-                    days=4)).strftime('%Y-%m-%d')
-            except ValueError:
-                transaction_date_end = transaction_date_start
+            yield
+        except BaseException:
+            self.errors[endpoint] += 1
+            raise
+        finally:
+            self.latencies[endpoint].append(time.perf_counter() - started)
+
+    def record_usage(self, usage: any) -> None:
+        for field in ('input_tokens', 'output_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens'):
+            self.tokens[field] += getattr(usage, field, None) or 0
+
+    def summary(self) -> dict:
+        latency = {}
+        for endpoint, samples in self.latencies.items():
+            ordered = sorted(samples)
+            percentile = lambda fraction: ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000
+            histogram = [0] * (len(LATENCY_BUCKETS_SECONDS) + 1)
+            for seconds in ordered:
+                histogram[bisect_left(LATENCY_BUCKETS_SECONDS, seconds)] += 1
+            latency[endpoint] = {
+                'calls': len(ordered),
+                'errors': self.errors[endpoint],
+                'mean_ms': sum(ordered) / len(ordered) * 1000,
+                'p50_ms': percentile(0.5),
+                'p95_ms': percentile(0.95),
+                'p99_ms': percentile(0.99),
+                'max_ms': ordered[-1] * 1000,
+                'histogram': {f"le_{bound:g}s": count for bound, count in zip(LATENCY_BUCKETS_SECONDS, histogram)}
+                | {'gt_last': histogram[-1]},
+            }
+        match_rates = {phase: counters['matched'] / counters['attempted']
+                       for phase, counters in self.counters.items() if counters.get('attempted')}
+        queues = {name: {'capacity': self.queue_capacity[name], 'puts': len(depths), 'max_depth': max(depths),
+                         'mean_depth': sum(depths) / len(depths), 'full': self.queue_full[name]}
+                  for name, depths in self.queue_depths.items() if depths}
+        return {
+            'started_at': self.started_at.isoformat(timespec='seconds'),
+            'timings': dict(self.timings),
+            'phases': {phase: dict(counters) for phase, counters in self.counters.items()},
+            'calls': {phase: dict(endpoints) for phase, endpoints in self.calls.items()},
+            'latency': latency,
+            'match_rates': match_rates,
+            'queues': queues,
+            'tokens': dict(self.tokens),
+            'peak_memory_bytes': self.peak_memory_bytes,
+        }
+
+    def write(self, path: str) -> None:
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(self.summary(), file, indent=2)
+        logger.info(f"Wrote run metrics to {path}")
+
+
+class StageQueue(asyncio.Queue):
+    """
+    Bounded queue between two pipeline stages. A full queue makes the producing stage wait, and the depth after every
+    put and how often a producer found the queue full are recorded in the run metrics.
+    """
+
+    def __init__(self, name: str, maxsize: int, metrics: RunMetrics):
+        super().__init__(maxsize)
+        self.name = name
+        self.metrics = metrics
+        metrics.queue_capacity[name] = maxsize
+
+    async def put(self, item) -> None:
+        if self.full():
+            self.metrics.queue_full[self.name] += 1
+        await super().put(item)
+        self.metrics.queue_depths[self.name].append(self.qsize())
+
+
+def report_profile(profiler: cProfile.Profile, profile_file: str, metrics: Optional[RunMetrics] = None) -> None:
+    """Save the cProfile stats and log the slowest functions and the largest allocation sites traced since start."""
+    profiler.dump_stats(profile_file)
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+    logger.info(f"Saved cProfile stats to {profile_file}. Top {PROFILE_TOP_FUNCTIONS} functions by cumulative time:\n"
+                f"{stream.getvalue()}")
+
+    snapshot = tracemalloc.take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if metrics is not None:
+        metrics.peak_memory_bytes = peak
+    logger.info(f"Memory: {current / 2 ** 20:.1f} MiB allocated at exit, {peak / 2 ** 20:.1f} MiB peak. "
+                f"Top {PROFILE_TOP_ALLOCATIONS} allocation sites:")
+    for statistic in snapshot.statistics('lineno')[:PROFILE_TOP_ALLOCATIONS]:
+        logger.info(f"  {statistic}")
+
+
+async def fetch_transaction_window(mm: MonarchMoney, category_ids: List[str], start_date: str, end_date: str,
+                                   searches: List[str] = MERCHANT_SEARCHES,
+                                   concurrency: int = DEFAULT_FETCH_CONCURRENCY,
+                                   metrics: Optional['RunMetrics'] = None,
+                                   has_notes: bool = False) -> TransactionIndex:
+    """
+    Page through every un-noted (or with has_notes, noted) transaction matching any of the merchant searches between
+    start_date and end_date.
+
+    The searches run concurrently, and after the first page of each search (which gives the total count) the remaining
+    pages are requested in waves of `concurrency` offsets, with at most `concurrency` calls in flight overall. Paging
+    stops at the first short page. Transactions found by more than one search are only indexed once.
+    """
+    index = TransactionIndex()
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    duplicates = 0
+
+    async def fetch_page(search, offset):
+        async with semaphore:
+            for attempt in range(1, READ_MAX_ATTEMPTS + 1):
+                started = time.perf_counter()
+                try:
+                    with metrics.call('get_transactions') if metrics is not None else nullcontext():
+                        response = await mm.get_transactions(
+                            limit=DEFAULT_RECORD_LIMIT,
+                            offset=offset,
+                            start_date=start_date,
+                            end_date=end_date,
+                            category_ids=category_ids,
+                            search=search,
+                            has_notes=has_notes
+                        )
+                except Exception as e:
+                    if not is_throttle_error(e) or attempt == READ_MAX_ATTEMPTS:
+                        raise
+                    if metrics is not None:
+                        metrics.count('throttled')
+                    delay = READ_BACKOFF_SECONDS * 2 ** (attempt - 1) * (0.5 + random.random())
+                    logger.warning(f"Throttled by Monarch fetching '{search}' at offset {offset}, retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+                    continue
+                latencies.append(time.perf_counter() - started)
+                break
+        return response['allTransactions']['results'], response['allTransactions'].get('totalCount')
 
-        total_cost = round(subtotal, 2)
+    async def fetch_search(search):
+        nonlocal duplicates
         offset = 0
-        matched = False
-
+        total_count = None
         while True:
-            amazon_transactions = await mm.get_transactions(
-                limit=DEFAULT_RECORD_LIMIT,
-                offset=offset,
-                start_date=transaction_date_start,
-                end_date=transaction_date_end,
-                category_ids=category_ids,
-                search='Amazon',
-                has_notes=False
-            )
-            prime_transactions = await mm.get_transactions(
-                limit=DEFAULT_RECORD_LIMIT,
-                offset=offset,
-                start_date=transaction_date_start,
-                end_date=transaction_date_end,
-                category_ids=category_ids,
-                search='Prime Video',
-                has_notes=False
-            )
-            transactions = amazon_transactions['allTransactions']['results'] + prime_transactions['allTransactions']['results']
-            print(f"  Found {len(transactions)} transactions between {transaction_date_start} and {transaction_date_end} for comparison")
-            if transactions:
-                print(f"  Transaction amounts: {[round(abs(t['amount']), 2) for t in transactions]} (looking for ${total_cost})")
-
-            for transaction in transactions:
-                rounded_transaction = round(abs(transaction['amount']), 2)
-                if rounded_transaction == total_cost:
-                    matched = True
-                    predicted_category = await classify_item(anthropic_client, cat_names, description)
-                    pprint(f"PRE-AGGREGATION Match - Item Description: {description}")
-                    pprint(f"PRE-AGGREGATION Predicted category: {predicted_category}")
-                    if dry_run:
-                        print(f"[DRY RUN] Would update transaction {transaction['id']} with category '{predicted_category}' and notes '{description} ~Pre-aggregation match via auto-classifier script~'")
-                    else:
-                        await mm.update_transaction(
-                            transaction_id=transaction['id'],
-                            notes=description + ' ~Pre-aggregation match via auto-classifier script~',
-                            category_id=cat_map.get(predicted_category, None)
-                        )
-                    matched_items.append(item)
-                    time.sleep(sleep_seconds)
-                    break
-
-            if matched or len(transactions) < DEFAULT_RECORD_LIMIT:
+            offsets = [offset + page * DEFAULT_RECORD_LIMIT for page in range(concurrency if offset else 1)]
+            if total_count is not None:
+                offsets = [page_offset for page_offset in offsets if page_offset < total_count]
+            if not offsets:
+                break
+            pages = await asyncio.gather(*(fetch_page(search, page_offset) for page_offset in offsets))
+            for transactions, count in pages:
+                total_count = count if count is not None else total_count
+                for transaction in transactions:
+                    if not index.add(transaction):
+                        duplicates += 1
+            if any(len(transactions) < DEFAULT_RECORD_LIMIT for transactions, _ in pages):
                 break
+            offset = offsets[-1] + DEFAULT_RECORD_LIMIT
+
+    await asyncio.gather(*(fetch_search(search) for search in searches))
+    if metrics is not None:
+        metrics.count('transactions', len(index))
+        metrics.count('duplicates', duplicates)
+
+    logger.info(f"Fetched {len(index)} {'noted' if has_notes else 'candidate'} transactions between {start_date} and {end_date} for {searches} "
+                f"({duplicates} duplicates across searches)")
+    logger.info(f"  get_transactions latency: {summarize_latencies(latencies)}")
+    return index
+
+
+def build_category_system(categories: List[str]) -> List[dict]:
+    """
+    The static part of every classification prompt, marked as a cacheable prefix.
+
+    Categories are numbered so the model can answer with an index instead of repeating the category name. The block
+    only changes when the Monarch categories do, so repeat calls read it from Anthropic's prompt cache.
+    """
+    numbered = '\n'.join(f"{number}. {category}" for number, category in enumerate(categories, start=1))
+    text = f"You categorize Amazon purchases. The available categories are:\n<categories>\n{numbered}\n</categories>"
+    return [{'type': 'text', 'text': text, 'cache_control': {'type': 'ephemeral'}}]
+
+
+def category_from_reply(reply: str, categories: List[str]) -> Optional[str]:
+    """Map a category number (or, failing that, an exact category name) back to the category."""
+    reply = reply.strip().rstrip('.')
+    if reply.isdigit() and 1 <= int(reply) <= len(categories):
+        return categories[int(reply) - 1]
+    return reply if reply in categories else None
+
+
+def build_classify_request(categories: List[str], description: str) -> dict:
+    prompt = f"<description>{description}</description>\nReply with only the number of the category that fits this item best."
+    return {
+        'system': build_category_system(categories),
+        'messages': [{'role': 'user', 'content': prompt}],
+        'max_tokens': CLASSIFY_MAX_TOKENS,
+        'model': CLASSIFIER_MODEL,
+    }
+
+
+def parse_classification(response: any, categories: List[str]) -> str:
+    return category_from_reply(response.content[0].text, categories) or NO_MATCHING_CATEGORY
+
+
+def build_batch_classify_request(categories: List[str], descriptions: List[str]) -> dict:
+    items = '\n'.join(f'<item id="{item_id}">{description}</item>' for item_id, description in enumerate(descriptions))
+    prompt = f"<items>\n{items}\n</items>\nFor each item reply with one line of the form id:number, where number is the category that fits it best. No other text."
+    return {
+        'system': build_category_system(categories),
+        'messages': [{'role': 'user', 'content': prompt}],
+        'max_tokens': BATCH_BASE_MAX_TOKENS + BATCH_ITEM_MAX_TOKENS * len(descriptions),
+        'model': CLASSIFIER_MODEL,
+    }
+
+
+def parse_batch_classification(response: any, categories: List[str], count: int) -> List[Optional[str]]:
+    """Parse "id:number" reply lines, leaving None for any item whose label is missing or not a category."""
+    results = [None] * count
+    for line in response.content[0].text.splitlines():
+        item_id, separator, reply = line.partition(':')
+        item_id = item_id.strip()
+        if not separator or not item_id.isdigit() or int(item_id) >= count:
+            continue
+        results[int(item_id)] = category_from_reply(reply, categories)
+    if not any(results):
+        logger.warning(f"Could not parse batch classification response: {response.content[0].text}")
+    return results
+
+
+async def classify_item(anthropic_client: any, categories: List[str], description: str,
+                        metrics: Optional['RunMetrics'] = None):
+    response = await anthropic_client.messages.create(**build_classify_request(categories, description),
+                                                      extra_headers={'anthropic-beta': PROMPT_CACHING_BETA})
+
+    logger.debug(pformat(response.content))
+    if metrics is not None:
+        metrics.record_usage(response.usage)
+    return parse_classification(response, categories)
+
+
+async def classify_batch(anthropic_client: any, categories: List[str], descriptions: List[str],
+                         metrics: Optional['RunMetrics'] = None) -> List[Optional[str]]:
+    response = await anthropic_client.messages.create(**build_batch_classify_request(categories, descriptions),
+                                                      extra_headers={'anthropic-beta': PROMPT_CACHING_BETA})
+
+    logger.debug(pformat(response.content))
+    if metrics is not None:
+        metrics.record_usage(response.usage)
+    return parse_batch_classification(response, categories, len(descriptions))
+
+
+async def classify_with_message_batches(anthropic_client: any, categories: List[str], descriptions: List[str],
+                                        batch_size: int, poll_seconds: float,
+                                        metrics: Optional['RunMetrics'] = None) -> List[Optional[str]]:
+    """
+    Submit every description through the Message Batches API and wait for the results.
+
+    Batches are processed asynchronously by Anthropic, so this trades latency for throughput on large backfills.
+    Each request carries batch_size descriptions. Items that fail or come back without a valid label are None.
+    """
+    chunks = [descriptions[start:start + batch_size] for start in range(0, len(descriptions), batch_size)]
+    requests = []
+    for chunk_id, chunk in enumerate(chunks):
+        params = build_batch_classify_request(categories, chunk) if batch_size > 1 \
+            else build_classify_request(categories, chunk[0])
+        requests.append({'custom_id': f'chunk-{chunk_id}', 'params': params})
+
+    if metrics is not None:
+        metrics.count('batch_requests', len(requests))
+    batch = await anthropic_client.beta.messages.batches.create(requests=requests, betas=[PROMPT_CACHING_BETA])
+    logger.info(f"Submitted message batch {batch.id} with {len(requests)} requests")
+    while batch.processing_status != 'ended':
+        await asyncio.sleep(poll_seconds)
+        batch = await anthropic_client.beta.messages.batches.retrieve(batch.id)
+        logger.info(f"  Message batch {batch.id}: {batch.processing_status} {batch.request_counts}")
+
+    labels_by_chunk = {}
+    async for result in await anthropic_client.beta.messages.batches.results(batch.id):
+        if result.result.type != 'succeeded':
+            logger.warning(f"  Message batch request {result.custom_id} {result.result.type}")
+            continue
+        if metrics is not None:
+            metrics.record_usage(result.result.message.usage)
+        chunk_id = int(result.custom_id.split('-')[1])
+        if batch_size > 1:
+            labels_by_chunk[chunk_id] = parse_batch_classification(result.result.message, categories,
+                                                                   len(chunks[chunk_id]))
+        else:
+            label = parse_classification(result.result.message, categories)
+            labels_by_chunk[chunk_id] = [label if label in categories else None]
+
+    return [label for chunk_id, chunk in enumerate(chunks)
+            for label in labels_by_chunk.get(chunk_id, [None] * len(chunk))]
+
+
+class Match(NamedTuple):
+    transaction_id: str
+    description: str
+    phase: str
+    note_suffix: str
+    item_keys: Tuple[str, ...] = ()
+    confidence: float = 1.0
+    transaction_date: Optional[str] = None
+
+
+class AdaptiveRateLimiter:
+    """
+    Non-blocking token bucket whose rate adapts to the server (AIMD).
+
+    The rate starts at max_rate, is multiplied by decrease_factor whenever the server throttles us and creeps back up
+    by increase_step per successful call. It never drops below min_rate, which is capped at max_rate.
+    """
+
+    def __init__(self, max_rate: float, min_rate: float, increase_step: float = 0.1, decrease_factor: float = 0.5):
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.rate = self.max_rate
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self._tokens = 1.0
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(1.0, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                await asyncio.sleep((1.0 - self._tokens) / self.rate)
+
+    def on_success(self) -> None:
+        self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+    def on_throttle(self) -> None:
+        self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+        # Drop any saved-up token so the next call waits out the new, slower interval
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+
+
+def classification_limiter(requests_per_second: float, sleep_seconds: float) -> AdaptiveRateLimiter:
+    """A limiter starting at requests_per_second that backs off as far as one call every sleep_seconds."""
+    if sleep_seconds <= 0 or 1.0 / sleep_seconds >= requests_per_second:
+        logger.warning(f"--sleep_seconds {sleep_seconds} is no longer than the {1.0 / requests_per_second:g}s between "
+                       f"calls at --requests_per_second {requests_per_second}, so the Anthropic rate can't back off "
+                       f"when throttled")
+    return AdaptiveRateLimiter(requests_per_second, 1.0 / sleep_seconds if sleep_seconds > 0 else requests_per_second)
+
+
+class ClassificationCache:
+    """
+    On-disk cache of description -> category answers, backed by SQLite.
+
+    Keys combine the normalized description with a hash of the category list, so a change to the Monarch categories
+    never serves a stale answer. The least recently used entries are evicted beyond max_entries, entries older than
+    ttl_seconds (if set) are ignored, and concurrent lookups for the same key share a single in-flight request.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_FILE, max_entries: int = DEFAULT_CACHE_MAX_ENTRIES,
+                 ttl_seconds: Optional[float] = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self._in_flight = {}
+        self._connection = sqlite3.connect(path, isolation_level=None)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS classifications '
+            '(key TEXT PRIMARY KEY, category TEXT NOT NULL, created_at REAL NOT NULL, last_used REAL NOT NULL)'
+        )
+        self._connection.execute(
+            'CREATE INDEX IF NOT EXISTS classifications_last_used ON classifications (last_used)'
+        )
 
-            offset += DEFAULT_RECORD_LIMIT
-            time.sleep(sleep_seconds)
+    @staticmethod
+    def categories_hash(categories: List[str]) -> str:
+        return hashlib.sha256('\n'.join(sorted(categories)).encode('utf-8')).hexdigest()[:16]
+
+    @staticmethod
+    def make_key(description: str, categories_hash: str) -> str:
+        return f"{categories_hash}:{' '.join(description.lower().split())}"
+
+    def get(self, key: str) -> Optional[str]:
+        row = self._connection.execute(
+            'SELECT category, created_at FROM classifications WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        category, created_at = row
+        now = time.time()
+        if self.ttl_seconds is not None and now - created_at > self.ttl_seconds:
+            self._connection.execute('DELETE FROM classifications WHERE key = ?', (key,))
+            return None
+        self._connection.execute('UPDATE classifications SET last_used = ? WHERE key = ?', (now, key))
+        return category
+
+    def put(self, key: str, category: str) -> None:
+        now = time.time()
+        self._connection.execute(
+            'INSERT OR REPLACE INTO classifications (key, category, created_at, last_used) VALUES (?, ?, ?, ?)',
+            (key, category, now, now)
+        )
+        count = self._connection.execute('SELECT COUNT(*) FROM classifications').fetchone()[0]
+        if count > self.max_entries:
+            self._connection.execute(
+                'DELETE FROM classifications WHERE key IN '
+                '(SELECT key FROM classifications ORDER BY last_used ASC LIMIT ?)',
+                (count - self.max_entries,)
+            )
 
-        if not matched:
-            unmatched_items.append(item)
-    
-    return unmatched_items
+    async def get_or_classify(self, keys: List[str],
+                              classify: Callable[[List[str]], Awaitable[List[Optional[str]]]],
+                              categories: List[str]) -> List[Optional[str]]:
+        """
+        Return the category for each key, calling classify once with every key that is neither cached nor already
+        in flight. Answers that are real categories are cached.
+        """
+        loop = asyncio.get_running_loop()
+        results = [None] * len(keys)
+        waiting = {}
+        owned = {}
+        for position, key in enumerate(keys):
+            cached = self.get(key)
+            if cached is not None:
+                self.hits += 1
+                results[position] = cached
+            elif key in self._in_flight:
+                self.shared += 1
+                waiting[position] = self._in_flight[key]
+            else:
+                self.misses += 1
+                future = loop.create_future()
+                self._in_flight[key] = owned[key] = waiting[position] = future
 
+        if owned:
+            pending_keys = list(owned)
+            try:
+                answers = await classify(pending_keys)
+                for key, answer in zip(pending_keys, answers):
+                    owned[key].set_result(answer)
+                    if answer in categories:
+                        self.put(key, answer)
+            except BaseException as e:
+                for future in owned.values():
+                    if not future.done():
+                        future.set_exception(e)
+                raise
+            finally:
+                for key in pending_keys:
+                    del self._in_flight[key]
+
+        for position, future in waiting.items():
+            results[position] = await asyncio.shield(future)
+        return results
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+class LocalClassifier:
+    """
+    Nearest-centroid classifier over hashed word, word-pair and character trigram features, saved as a .npz file.
+
+    Each description becomes an L2-normalized vector of LOCAL_FEATURE_DIMENSIONS hashed features and each category
+    keeps the sum of its examples' vectors, so learning one more example is a single vector add. A prediction is the
+    category whose centroid has the highest cosine similarity. Its confidence is a softmax over the similarities
+    (at LOCAL_TEMPERATURE), so it is only high when one category clearly beats the rest. Categories with fewer than
+    LOCAL_MIN_EXAMPLES examples are never predicted, and nothing is predicted until two categories qualify.
+    """
+
+    def __init__(self, path: Optional[str] = DEFAULT_LOCAL_CLASSIFIER_FILE):
+        import numpy as np
+        self.path = path
+        self.reset()
+        if path is not None and os.path.exists(path):
+            with np.load(path, allow_pickle=False) as model:
+                self.categories = model['categories'].tolist()
+                self.sums = model['sums']
+                self.counts = model['counts']
+                self.trained_ids = set(model['trained_ids'].tolist())
+            self._rows = {category: row for row, category in enumerate(self.categories)}
+
+    def reset(self) -> None:
+        import numpy as np
+        self.categories = []
+        self.sums = np.zeros((0, LOCAL_FEATURE_DIMENSIONS), dtype=np.float32)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.trained_ids = set()
+        self._rows = {}
+        self._norms = None
+
+    @staticmethod
+    def features(description: str) -> Tuple['np.ndarray', 'np.ndarray']:
+        import numpy as np
+        words = ''.join(character if character.isalnum() else ' ' for character in description.lower()).split()
+        grams = [f"w:{word}" for word in words] + [f"p:{first} {second}" for first, second in zip(words, words[1:])]
+        for word in words:
+            padded = f"^{word}$"
+            grams += [f"c:{padded[start:start + 3]}" for start in range(len(padded) - 2)]
+        hashed = np.fromiter((zlib.crc32(gram.encode('utf-8')) % LOCAL_FEATURE_DIMENSIONS for gram in grams),
+                             dtype=np.int64, count=len(grams))
+        indices, counts = np.unique(hashed, return_counts=True)
+        values = counts.astype(np.float32)
+        return indices, values / max(float(np.linalg.norm(values)), 1e-12)
+
+    def learn(self, description: str, category: str, transaction_id: Optional[str] = None) -> bool:
+        """Add one labelled example, returning False if it has no features or transaction_id was already learned."""
+        import numpy as np
+        if transaction_id is not None and transaction_id in self.trained_ids:
+            return False
+        indices, values = self.features(description)
+        if not len(indices):
+            return False
+        if transaction_id is not None:
+            self.trained_ids.add(transaction_id)
+
+        row = self._rows.get(category)
+        if row is None:
+            row = self._rows[category] = len(self.categories)
+            self.categories.append(category)
+            self.sums = np.vstack([self.sums, np.zeros((1, LOCAL_FEATURE_DIMENSIONS), dtype=np.float32)])
+            self.counts = np.append(self.counts, 0)
+        self.sums[row, indices] += values
+        self.counts[row] += 1
+        self._norms = None
+        return True
+
+    def predict_many(self, descriptions: List[str], categories: List[str]) -> List[Tuple[Optional[str], float]]:
+        """Return (category, confidence) for each description, choosing only among the given categories."""
+        import numpy as np
+        rows = np.array([self._rows[category] for category in categories
+                         if category in self._rows and self.counts[self._rows[category]] >= LOCAL_MIN_EXAMPLES],
+                        dtype=np.int64)
+        if len(rows) < 2:
+            return [(None, 0.0)] * len(descriptions)
+        if self._norms is None:
+            self._norms = np.maximum(np.linalg.norm(self.sums, axis=1), 1e-12)
+
+        predictions = []
+        for description in descriptions:
+            indices, values = self.features(description)
+            if not len(indices):
+                predictions.append((None, 0.0))
+                continue
+            scores = (self.sums[np.ix_(rows, indices)] @ values) / self._norms[rows]
+            weights = np.exp((scores - scores.max()) / LOCAL_TEMPERATURE)
+            best = int(np.argmax(scores))
+            predictions.append((self.categories[rows[best]], float(weights[best] / weights.sum())))
+        return predictions
+
+    def save(self) -> None:
+        import numpy as np
+        if self.path is None:
+            return
+        with open(self.path + '.tmp', 'wb') as file:
+            np.savez_compressed(file, categories=np.array(self.categories, dtype=np.str_), sums=self.sums,
+                                counts=self.counts, trained_ids=np.array(sorted(self.trained_ids), dtype=np.str_))
+        os.replace(self.path + '.tmp', self.path)
+
+
+def description_from_notes(notes: str) -> Optional[str]:
+    """Recover the item description from the notes an earlier run wrote, or None if this script didn't write them."""
+    for suffix in (PRE_AGGREGATION_NOTE, POST_AGGREGATION_NOTE, SPLIT_SHIPMENT_NOTE):
+        if notes.endswith(suffix):
+            description = notes[:-len(suffix)]
+            approximate = description.rfind(APPROXIMATE_NOTE[:APPROXIMATE_NOTE.index('{')])
+            return description[:approximate] if approximate >= 0 and description.endswith('~') else description
+    return None
+
+
+async def train_from_history(mm: MonarchMoney, classifier: LocalClassifier, searches: List[str] = MERCHANT_SEARCHES,
+                             concurrency: int = DEFAULT_FETCH_CONCURRENCY,
+                             metrics: Optional['RunMetrics'] = None) -> int:
+    """Teach the classifier every transaction an earlier run noted, labelled with its current Monarch category."""
+    history = await fetch_transaction_window(mm, None, HISTORY_START_DATE, date.today().isoformat(), searches,
+                                             concurrency, metrics, has_notes=True)
+    learned = 0
+    for transaction in history:
+        description = description_from_notes(transaction.get('notes') or '')
+        category = (transaction.get('category') or {}).get('name')
+        if description and category and classifier.learn(description, category, transaction['id']):
+            learned += 1
+    logger.info(f"Trained the local classifier on {learned} past matches across {len(classifier.categories)} "
+                f"categories")
+    return learned
+
+
+class MonarchUpdate(NamedTuple):
+    transaction_id: str
+    notes: str
+    category_id: Optional[str]
+    category: Optional[str]
+    phase: str
+    item_keys: Tuple[str, ...] = ()
+    order_ids: Tuple[str, ...] = ()
+    confidence: float = 1.0
+    transaction_date: Optional[str] = None
+
+
+def append_json_line(path: str, record: dict) -> None:
+    with open(path, 'a', encoding='utf-8') as file:
+        file.write(json.dumps(record) + '\n')
+
+
+def clear_dry_run_file(path: Optional[str]) -> None:
+    """Start a dry run's output from an empty file, so it only lists the updates this run would make."""
+    if path is not None and os.path.exists(path):
+        os.remove(path)
+
+
+class StateStore:
+    """
+    Crash-safe journal of the Amazon rows a run has processed and the Monarch transactions matched to them.
+
+    Every Monarch update is journaled as soon as it is written, and rows left unmatched are journaled once the run
+    finishes, so a crashed run can be resumed and a later run over a newer dump only processes new rows.
+    """
+
+    def __init__(self, path: str = DEFAULT_STATE_FILE):
+        self._connection = sqlite3.connect(path, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS processed_rows '
+            '(row_key TEXT PRIMARY KEY, order_id TEXT NOT NULL, phase TEXT NOT NULL, status TEXT NOT NULL, '
+            'processed_at REAL NOT NULL)'
+        )
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS matched_transactions '
+            '(transaction_id TEXT PRIMARY KEY, order_ids TEXT NOT NULL, category TEXT, phase TEXT NOT NULL, '
+            'matched_at REAL NOT NULL)'
+        )
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS sync_cursors (name TEXT PRIMARY KEY, value TEXT NOT NULL, updated_at REAL NOT NULL)'
+        )
 
-async def match_and_update_transactions(mm: MonarchMoney, anthropic_client: any, csv_file: str,
-                                        digital_items_csv_file: str,
-                                        digital_transact_csv: str,
-                                        category_ids: List[str], sleep_seconds: float, start_date: str,
-                                        end_date: str, dry_run: bool = False) -> None:
-    unmatched_rows: List[Tuple[str, str, float]] = []
-    mm_categories = await mm.get_transaction_categories()
-    cat_names, cat_map = process_categories(mm_categories)
-    pprint("category list")
-    pprint(cat_map)
-
-    # Get individual items before aggregation for pre-aggregation matching
-    def get_individual_items(csv_file, digital_item_csv, digital_transaction_csv, start_date: str, end_date: str):
-        retail_order_id_index = 1
-        retail_sub_total_index = 9
-        retail_description_index = 23
-        retail_delivery_date_index = 18
-        retail_order_date_index = 2
-
-        def str_to_float(string, is_digital_order):
-            if not is_digital_order:
-                string = string.replace(',', '')
-            return round(float(string), 2)
-
-        def clean_retail_data(csv_file):
-            with open(csv_file, 'r') as file:
-                retail_data = csv.reader(file)
-                next(retail_data)
-                cleaned_data = []
-                for retail_row in retail_data:
-                    cleaned_data.append(
-                        [retail_row[retail_order_id_index], retail_row[retail_description_index],
-                         retail_row[retail_delivery_date_index],
-                         retail_row[retail_order_date_index], retail_row[retail_sub_total_index], 0])
-                return cleaned_data
-
-        individual_items = []
-        try:
-            cleaned_retail_data = clean_retail_data(csv_file)
-        except FileNotFoundError as e:
-            print(f"Error processing CSV file: {e}")
-            cleaned_retail_data = []
+    def get_cursor(self, name: str) -> Optional[str]:
+        row = self._connection.execute('SELECT value FROM sync_cursors WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_cursor(self, name: str, value: str) -> None:
+        self._connection.execute('INSERT OR REPLACE INTO sync_cursors (name, value, updated_at) VALUES (?, ?, ?)',
+                                 (name, value, time.time()))
+
+    def processed_rows(self) -> set:
+        return {row_key for row_key, in self._connection.execute('SELECT row_key FROM processed_rows')}
+
+    def matched_transactions(self) -> set:
+        return {transaction_id for transaction_id, in
+                self._connection.execute('SELECT transaction_id FROM matched_transactions')}
+
+    def record_update(self, update: MonarchUpdate) -> None:
+        now = time.time()
+        with self._connection:
+            self._connection.execute('BEGIN')
+            self._connection.execute(
+                'INSERT OR REPLACE INTO matched_transactions (transaction_id, order_ids, category, phase, matched_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (update.transaction_id, ','.join(update.order_ids), update.category, update.phase, now)
+            )
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO processed_rows (row_key, order_id, phase, status, processed_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(key, order_id, update.phase, 'matched', now)
+                 for key, order_id in zip(update.item_keys, update.order_ids)]
+            )
 
-        try:
-            digital_data = process_csv_files(digital_item_csv, digital_transaction_csv)
-        except FileNotFoundError as e:
-            print(f"Error processing CSV files: {e}")
-            digital_data = []
-
-        data = cleaned_retail_data + digital_data
-        data.sort(key=lambda x: x[ORDER_DATE_INDEX])
-
-        for row in data:
-            if datetime.strptime(start_date, "%Y-%m-%d") <= datetime.strptime(row[ORDER_DATE_INDEX].split('T')[0], "%Y-%m-%d") <= datetime.strptime(end_date, "%Y-%m-%d"):
-                item_subtotal = str_to_float(row[SUB_TOTAL_INDEX], row[IS_DIGITAL_ORDER_INDEX])
-                individual_items.append([row[ORDER_ID_INDEX], row[DESCRIPTION_INDEX], row[DELIVERY_DATE_INDEX], 
-                                       row[ORDER_DATE_INDEX], item_subtotal, row[IS_DIGITAL_ORDER_INDEX]])
-        
-        return individual_items
-
-    # Phase 1: Match individual items before aggregation
-    print("Phase 1: Matching individual items before aggregation...")
-    individual_items = get_individual_items(csv_file, digital_items_csv_file, digital_transact_csv, start_date, end_date)
-    unmatched_individual_items = await match_individual_items(mm, anthropic_client, individual_items, 
-                                                            category_ids, cat_names, cat_map, sleep_seconds, dry_run)
-    
-    # Phase 2: Aggregate remaining unmatched items and try matching again
-    print("Phase 2: Aggregating unmatched items and matching again...")
-    aggregated_orders = defaultdict(dict)
-    
-    def str_to_float(string, is_digital_order):
-        if not is_digital_order:
-            string = string.replace(',', '')
-        return round(float(string), 2)
-    
-    for item in unmatched_individual_items:
-        order_id, description, delivery_date, order_date, subtotal, is_digital = item
-        order_id = f'{order_id}'
-        
-        if order_id in aggregated_orders:
-            aggregated_orders[order_id]['total_cost'] += subtotal
-            aggregated_orders[order_id]['description'] += ' ' + description
+    def record_unmatched(self, items: List[OrderItem]) -> None:
+        now = time.time()
+        with self._connection:
+            self._connection.execute('BEGIN')
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO processed_rows (row_key, order_id, phase, status, processed_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(item_key(item), item.order_id, 'UNMATCHED', 'unmatched', now) for item in items]
+            )
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+class UpdateWriter:
+    """
+    Write-behind queue for Monarch transaction updates.
+
+    Updates are queued as they are produced and written by `concurrency` workers, retrying failures with exponential
+    backoff. Each transaction is written at most once per writer. Updates that still fail after max_attempts go to the
+    dead-letter file so they can be replayed with --retry_dead_letters. With a dry_run_file, updates are appended to
+    that file instead of being sent to Monarch.
+    """
+
+    def __init__(self, mm: MonarchMoney, concurrency: int = DEFAULT_WRITE_CONCURRENCY,
+                 max_attempts: int = DEFAULT_WRITE_MAX_ATTEMPTS, dead_letter_file: str = DEFAULT_DEAD_LETTER_FILE,
+                 state: Optional[StateStore] = None, dry_run_file: Optional[str] = None,
+                 metrics: Optional['RunMetrics'] = None):
+        self.mm = mm
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.dead_letter_file = dead_letter_file
+        self.state = state
+        self.dry_run_file = dry_run_file
+        self.metrics = metrics
+        self.written = 0
+        self.failed = 0
+        self.duplicates = 0
+        self.errors = 0
+        self.submitted = set()
+        self._queue = StageQueue('write', concurrency * 4, metrics) if metrics is not None \
+            else asyncio.Queue(maxsize=concurrency * 4)
+        self._workers = []
+
+    async def __aenter__(self) -> 'UpdateWriter':
+        self._started = time.perf_counter()
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self.concurrency)]
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        if exc_info[0] is None:
+            await self._queue.join()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        if self.metrics is not None:
+            # The write phase lasts as long as the writer is open, whatever phase the code feeding it is in
+            self.metrics.timings['write'] = self.metrics.timings.get('write', 0.0) + time.perf_counter() - self._started
+            counters = self.metrics.counters['write']
+            counters['written'] += self.written
+            counters['dead_lettered'] += self.failed
+            counters['duplicates'] += self.duplicates
+            counters['write_errors'] += self.errors
+        logger.info(f"Monarch updates: {self.written} written, {self.failed} dead-lettered, "
+                    f"{self.duplicates} duplicates skipped, {self.errors} errors")
+
+    async def submit(self, update: MonarchUpdate) -> None:
+        if update.transaction_id in self.submitted:
+            self.duplicates += 1
+            return
+        self.submitted.add(update.transaction_id)
+        await self._queue.put(update)
+
+    async def _work(self) -> None:
+        if self.metrics is not None:
+            self.metrics.set_phase('write')
+        while True:
+            update = await self._queue.get()
+            try:
+                await self._write(update)
+            except Exception as e:
+                # Journaling or the dead-letter file failing must not kill the worker, or the queue never drains
+                logger.exception(f"Handling the update of transaction {update.transaction_id} failed: {e}")
+                self.errors += 1
+            finally:
+                self._queue.task_done()
+
+    async def _write(self, update: MonarchUpdate) -> None:
+        if self.dry_run_file is not None:
+            append_json_line(self.dry_run_file, update._asdict())
+            self.written += 1
+            return
+
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                with self.metrics.call('update_transaction') if self.metrics is not None else nullcontext():
+                    await self.mm.update_transaction(
+                        transaction_id=update.transaction_id,
+                        notes=update.notes,
+                        category_id=update.category_id
+                    )
+            except Exception as e:
+                if attempt == self.max_attempts:
+                    logger.error(f"Giving up updating transaction {update.transaction_id}: {e}")
+                    append_json_line(self.dead_letter_file, {**update._asdict(), 'error': str(e),
+                                                             'failed_at': time.time()})
+                    self.failed += 1
+                    return
+                delay = WRITE_BACKOFF_SECONDS * 2 ** (attempt - 1) * (0.5 + random.random())
+                logger.warning(f"Updating transaction {update.transaction_id} failed ({e}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+
+            self.written += 1
+            if self.state is not None:
+                self.state.record_update(update)
+            return
+
+
+def load_updates(path: str) -> List[MonarchUpdate]:
+    """Read the updates saved one JSON object per line, as in the dead-letter, dry run and plan files."""
+    updates = []
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            updates.append(MonarchUpdate(record['transaction_id'], record['notes'], record['category_id'],
+                                         record['category'], record['phase'], tuple(record['item_keys']),
+                                         tuple(record['order_ids']), record.get('confidence', 1.0),
+                                         record.get('transaction_date')))
+    return updates
+
+
+async def retry_dead_letters(mm: MonarchMoney, dead_letter_file: str = DEFAULT_DEAD_LETTER_FILE,
+                             state: Optional[StateStore] = None, concurrency: int = DEFAULT_WRITE_CONCURRENCY,
+                             max_attempts: int = DEFAULT_WRITE_MAX_ATTEMPTS,
+                             metrics: Optional[RunMetrics] = None) -> None:
+    """Replay the updates in the dead-letter file. Any that fail again are written back to it."""
+    replaying_file = dead_letter_file + '.replaying'
+    updates = load_updates(replaying_file) if os.path.exists(replaying_file) else []
+    if os.path.exists(dead_letter_file):
+        updates += load_updates(dead_letter_file)
+        os.replace(dead_letter_file, replaying_file)
+    already_written = state.matched_transactions() if state is not None else set()
+    updates = [update for update in updates if update.transaction_id not in already_written]
+    logger.info(f"Replaying {len(updates)} dead-lettered updates from {dead_letter_file}")
+
+    async with UpdateWriter(mm, concurrency, max_attempts, dead_letter_file, state, metrics=metrics) as writer:
+        for update in updates:
+            await writer.submit(update)
+    if os.path.exists(replaying_file):
+        os.remove(replaying_file)
+
+
+async def apply_plan(mm: MonarchMoney, plan_file: str = DEFAULT_PLAN_FILE, state: Optional[StateStore] = None,
+                     concurrency: int = DEFAULT_WRITE_CONCURRENCY, max_attempts: int = DEFAULT_WRITE_MAX_ATTEMPTS,
+                     dead_letter_file: str = DEFAULT_DEAD_LETTER_FILE, dry_run_file: Optional[str] = None,
+                     merchant_searches: List[str] = MERCHANT_SEARCHES,
+                     fetch_concurrency: int = DEFAULT_FETCH_CONCURRENCY, categories_cache_file: Optional[str] = None,
+                     categories_refresh_seconds: float = 0.0, metrics: Optional[RunMetrics] = None) -> dict:
+    """
+    Write the updates of a reviewed plan file to Monarch through the write-behind queue.
+
+    The un-noted transactions between the plan's earliest and latest transaction dates are fetched once, and entries
+    whose transaction is no longer among them (it gained notes or was deleted since the plan was made) are skipped, as
+    are entries already journaled in the state file. An entry's category name wins over its category_id, so a
+    reviewer only has to change the name.
+    """
+    metrics = metrics if metrics is not None else RunMetrics()
+    updates = load_updates(plan_file)
+    already_written = state.matched_transactions() if state is not None else set()
+    pending = [update for update in updates if update.transaction_id not in already_written]
+    undated = [update for update in pending if update.transaction_date is None]
+    if undated:
+        logger.warning(f"Skipping {len(undated)} plan entries without a transaction date, they can't be checked "
+                       f"against Monarch")
+    pending = [update for update in pending if update.transaction_date is not None]
+
+    with metrics.phase('categories'):
+        _, cat_map = process_categories(await load_categories(mm, categories_cache_file, categories_refresh_seconds,
+                                                              metrics))
+    with metrics.phase('fetch'):
+        if pending:
+            index = await fetch_transaction_window(mm, None, min(update.transaction_date for update in pending),
+                                                   max(update.transaction_date for update in pending),
+                                                   merchant_searches, fetch_concurrency, metrics)
         else:
-            aggregated_orders[order_id] = {'total_cost': subtotal, 'description': description,
-                                         'delivery_date': delivery_date, 'order_date': order_date}
-
-    orders = aggregated_orders
-    for order_id, items in orders.items():
-        print(f"Processing aggregated order - Order ID: {order_id}, Description: {items['description'][:50]}{'...' if len(items['description']) > 50 else ''}, Amount: ${items['total_cost']}")
-        pprint(f' processing orderID: {order_id}')
-        if items['delivery_date'] == 'Not Available':
-            continue
-        try:
-            transaction_date_start = (datetime.strptime(items['order_date'], '%Y-%m-%dT%H:%M:%SZ') - timedelta(
-                days=1)).strftime('%Y-%m-%d')
+            index = TransactionIndex()
+    stale = [update for update in pending if update.transaction_id not in index]
+    pending = [update._replace(category_id=cat_map.get(update.category, update.category_id))
+               for update in pending if update.transaction_id in index]
+    logger.info(f"Applying {len(pending)} of {len(updates)} planned updates from {plan_file}: "
+                f"{len(updates) - len(pending) - len(stale) - len(undated)} already written, "
+                f"{len(stale)} transactions gained notes since the plan was made")
+    for update in stale:
+        logger.debug(f"  Skipping transaction {update.transaction_id}, it has notes now: {update.notes}")
+
+    async with UpdateWriter(mm, concurrency, max_attempts, dead_letter_file, None if dry_run_file else state,
+                            dry_run_file, metrics) as writer:
+        for update in pending:
+            await writer.submit(update)
+    return {
+        'planned': len(updates),
+        'applied': writer.written,
+        'failed': writer.failed,
+        'stale': len(stale),
+        'already_written': len(updates) - len(pending) - len(stale) - len(undated),
+        'undated': len(undated),
+    }
+
+
+async def classify_items(anthropic_client: any, categories: List[str], descriptions: List[str],
+                         limiter: AdaptiveRateLimiter, max_concurrency: int,
+                         cache: Optional[ClassificationCache] = None, batch_size: int = 1,
+                         use_message_batches: bool = False,
+                         batch_poll_seconds: float = DEFAULT_BATCH_POLL_SECONDS,
+                         metrics: Optional['RunMetrics'] = None,
+                         local_classifier: Optional[LocalClassifier] = None,
+                         local_confidence: float = DEFAULT_LOCAL_CONFIDENCE) -> List[str]:
+    """
+    Classify descriptions concurrently, keeping at most max_concurrency requests in flight.
+
+    With batch_size > 1 each request classifies up to batch_size descriptions; any item that comes back without a
+    valid category is retried on its own. With use_message_batches everything goes through the Message Batches API.
+    With a local_classifier, only the items it labels with less than local_confidence go to Claude, and it learns
+    from Claude's answers.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    categories_hash = ClassificationCache.categories_hash(categories)
+
+    async def call_limited(request: Callable[[], Awaitable], description: str, endpoint: str):
+        import anthropic
+        async with semaphore:
+            for attempt in range(MAX_CLASSIFY_ATTEMPTS):
+                await limiter.acquire()
+                try:
+                    with metrics.call(endpoint) if metrics is not None else nullcontext():
+                        result = await request()
+                except anthropic.APIStatusError as e:
+                    if e.status_code in THROTTLE_STATUS_CODES:
+                        limiter.on_throttle()
+                        if metrics is not None:
+                            metrics.count('throttled')
+                        logger.warning(f"Throttled by Anthropic ({e.status_code}), backing off to {limiter.rate:.2f} requests/s")
+                        continue
+                    if e.status_code < 500:
+                        raise
+                    error = f"Anthropic error {e.status_code}"
+                except anthropic.APIConnectionError as e:  # also covers timeouts
+                    error = f"Anthropic could not be reached ({e})"
+                else:
+                    limiter.on_success()
+                    return result
+                # The SDK's own retries are off, so server errors and dropped connections are retried here
+                if attempt + 1 < MAX_CLASSIFY_ATTEMPTS:
+                    delay = CLASSIFY_BACKOFF_SECONDS * 2 ** attempt * (0.5 + random.random())
+                    logger.warning(f"{error} classifying {description}, retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+            logger.error(f"Giving up classifying {description} after {MAX_CLASSIFY_ATTEMPTS} attempts")
+            return None
+
+    async def classify_one(description):
+        return await call_limited(lambda: classify_item(anthropic_client, categories, description, metrics),
+                                  f"'{description}'", 'classify_item')
+
+    async def classify_chunk(chunk):
+        labels = await call_limited(lambda: classify_batch(anthropic_client, categories, chunk, metrics),
+                                    f"a batch of {len(chunk)} items", 'classify_batch')
+        return labels if labels is not None else [None] * len(chunk)
+
+    async def retry_invalid(pending, labels):
+        retries = [position for position, label in enumerate(labels) if label not in categories]
+        if retries:
+            logger.info(f"Retrying {len(retries)} batch items individually")
+            for position, label in zip(retries, await asyncio.gather(*(classify_one(pending[position])
+                                                                      for position in retries))):
+                labels[position] = label
+        return labels
+
+    async def classify_many(pending):
+        if use_message_batches:
+            labels = await classify_with_message_batches(anthropic_client, categories, pending, batch_size,
+                                                         batch_poll_seconds, metrics)
+            return await retry_invalid(pending, labels)
+        if batch_size <= 1:
+            return await asyncio.gather(*(classify_one(description) for description in pending))
+
+        chunks = [pending[start:start + batch_size] for start in range(0, len(pending), batch_size)]
+        chunk_labels = await asyncio.gather(*(classify_chunk(chunk) for chunk in chunks))
+        return await retry_invalid(pending, [label for labels in chunk_labels for label in labels])
+
+    async def classify_remote(pending):
+        if cache is None:
+            return await classify_many(list(pending))
+
+        keys = [ClassificationCache.make_key(description, categories_hash) for description in pending]
+        description_by_key = dict(zip(keys, pending))
+        return await cache.get_or_classify(keys, lambda missing: classify_many([description_by_key[key]
+                                                                                for key in missing]), categories)
+
+    if local_classifier is None:
+        return await classify_remote(descriptions)
+
+    labels = [None] * len(descriptions)
+    escalated = []
+    for position, (category, confidence) in enumerate(local_classifier.predict_many(descriptions, categories)):
+        if category is not None and confidence >= local_confidence:
+            labels[position] = category
+        else:
+            escalated.append(position)
+    logger.info(f"Local classifier labelled {len(descriptions) - len(escalated)} of {len(descriptions)} items, "
+                f"escalating {len(escalated)} to Claude")
+    if metrics is not None:
+        metrics.count('local_labels', len(descriptions) - len(escalated))
+        metrics.count('escalated', len(escalated))
+
+    remote_labels = await classify_remote([descriptions[position] for position in escalated])
+    for position, label in zip(escalated, remote_labels):
+        labels[position] = label
+        if label in categories:
+            local_classifier.learn(descriptions[position], label)
+    return labels
+
+
+class LazyAsyncAnthropic:
+    """Stand-in for AsyncAnthropic that imports anthropic and creates the client the first time it is used."""
+
+    def __init__(self, **client_args):
+        self._client_args = client_args
+        self._client = None
+
+    def __getattr__(self, name: str):
+        if self._client is None:
+            from anthropic import AsyncAnthropic
+            self._client = AsyncAnthropic(**self._client_args)
+        return getattr(self._client, name)
+
+
+def is_throttle_error(error: Exception) -> bool:
+    return 429 in (getattr(error, 'status', None), getattr(error, 'code', None))
+
+
+def is_auth_error(error: Exception) -> bool:
+    return 401 in (getattr(error, 'status', None), getattr(error, 'code', None)) or 'Unauthorized' in str(error)
+
+
+class MonarchSession:
+    """
+    MonarchMoney wrapper that reuses the saved session token and logs in again once Monarch rejects it.
+
+    Any API call that fails with a 401 while using a saved token triggers one fresh login, shared by every call that
+    failed with the same token, and is then retried.
+    """
+
+    def __init__(self, mm: MonarchMoney, email: str, password: str):
+        self.mm = mm
+        self.email = email
+        self.password = password
+        self.reused_session = False
+        self._login_lock = asyncio.Lock()
+
+    async def login(self) -> None:
+        if os.path.exists(self.mm._session_file):
+            logger.info(f"Reusing the saved Monarch session in {self.mm._session_file}")
+            self.mm.load_session()
+            self.reused_session = True
+            return
+        await self._fresh_login()
+
+    async def _fresh_login(self) -> None:
+        self.mm.delete_session()
+        await self.mm.login(self.email, self.password, use_saved_session=False, save_session=True)
+        self.reused_session = False
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self.mm, name)
+        if not asyncio.iscoroutinefunction(attribute):
+            return attribute
+
+        async def call(*args, **kwargs):
+            token = self.mm.token
+            try:
+                return await attribute(*args, **kwargs)
+            except Exception as e:
+                if not is_auth_error(e):
+                    raise
+                async with self._login_lock:
+                    if self.mm.token == token:
+                        if not self.reused_session:
+                            raise
+                        logger.warning(f"The saved Monarch session has expired ({e}), logging in again")
+                        await self._fresh_login()
+                return await attribute(*args, **kwargs)
+
+        return call
+
+
+class Cassette:
+    """
+    Recorded Monarch and Anthropic traffic, stored as gzipped JSON of responses keyed by a hash of each request.
+
+    Identical requests are served their responses in the order they were recorded, repeating the last one.
+    """
+
+    def __init__(self, path: str = DEFAULT_CASSETTE_FILE):
+        self.path = path
+        self.entries = defaultdict(list)
+        self.recorded = 0
+        self.replayed = 0
+        self.misses = 0
+        self._positions = defaultdict(int)
+
+    @staticmethod
+    def key(endpoint: str, args: tuple, kwargs: dict) -> str:
+        request = json.dumps({'endpoint': endpoint, 'args': args, 'kwargs': kwargs}, sort_keys=True, default=str)
+        return hashlib.sha256(request.encode('utf-8')).hexdigest()[:32]
+
+    def load(self) -> 'Cassette':
+        with gzip.open(self.path, 'rt', encoding='utf-8') as file:
+            data = json.load(file)
+        if data.get('version') != CASSETTE_VERSION:
+            raise ValueError(f"{self.path} is a version {data.get('version')} cassette, expected {CASSETTE_VERSION}")
+        self.entries = defaultdict(list, data['entries'])
+        logger.info(f"Loaded {sum(map(len, self.entries.values()))} recorded responses from {self.path}")
+        return self
+
+    def save(self) -> None:
+        with gzip.open(self.path + '.tmp', 'wt', encoding='utf-8') as file:
+            json.dump({'version': CASSETTE_VERSION, 'entries': self.entries}, file, separators=(',', ':'))
+        os.replace(self.path + '.tmp', self.path)
+        logger.info(f"Recorded {self.recorded} responses to {self.path}")
+
+    def record(self, key: str, response: any) -> None:
+        self.entries[key].append(response)
+        self.recorded += 1
+
+    def replay(self, key: str) -> Optional[any]:
+        """Return the next recorded response for this request, or None if it was never recorded."""
+        responses = self.entries.get(key)
+        if not responses:
+            self.misses += 1
+            return None
+        position = self._positions[key]
+        self._positions[key] = position + 1
+        self.replayed += 1
+        return responses[min(position, len(responses) - 1)]
+
+
+class CassetteMonarch:
+    """
+    Records (with a MonarchMoney to wrap) or replays (without one) the calls in MONARCH_CASSETTE_ENDPOINTS.
+
+    Anything else is passed through when recording and unavailable when replaying. Replayed reads that were never
+    recorded raise, while replayed updates that were never recorded, e.g. after a matcher change, succeed.
+    """
+
+    def __init__(self, cassette: Cassette, mm: Optional[MonarchMoney] = None, latency: float = 0.0):
+        self.cassette = cassette
+        self.mm = mm
+        self.latency = latency
+        self.reused_session = mm is None
+
+    async def login(self) -> None:
+        if self.mm is not None:
+            await self.mm.login()
+            self.reused_session = self.mm.reused_session
+
+    def __getattr__(self, name: str):
+        if name not in MONARCH_CASSETTE_ENDPOINTS:
+            if self.mm is None:
+                raise AttributeError(f"Monarch's {name} is not available when replaying a cassette")
+            return getattr(self.mm, name)
+
+        async def call(*args, **kwargs):
+            key = Cassette.key(name, args, kwargs)
+            if self.mm is not None:
+                response = await getattr(self.mm, name)(*args, **kwargs)
+                self.cassette.record(key, response)
+                return response
+
+            await asyncio.sleep(self.latency)
+            response = self.cassette.replay(key)
+            if response is not None:
+                return response
+            if name == 'update_transaction':
+                return {'updateTransaction': {'transaction': {'id': kwargs.get('transaction_id')}}}
+            raise KeyError(f"{name}{args or ''}{kwargs or ''} was not recorded in {self.cassette.path}")
+
+        return call
+
+
+class CassetteAnthropic:
+    """
+    Records (with a client to wrap) or replays (without one) messages.create calls.
+
+    A replayed request that was never recorded gets an empty reply, so its item is left unclassified. The Message
+    Batches API is passed through when recording and unavailable when replaying.
+    """
+
+    def __init__(self, cassette: Cassette, client: any = None, latency: float = 0.0):
+        self.cassette = cassette
+        self.client = client
+        self.latency = latency
+        self.messages = self
+
+    @property
+    def beta(self):
+        if self.client is None:
+            raise AttributeError("The Message Batches API is not available when replaying a cassette")
+        return self.client.beta
+
+    async def create(self, **request):
+        from anthropic.types import Message
+        key = Cassette.key('messages.create', (), request)
+        if self.client is not None:
+            response = await self.client.messages.create(**request)
+            self.cassette.record(key, response.model_dump(mode='json'))
+            return response
+
+        await asyncio.sleep(self.latency)
+        response = self.cassette.replay(key)
+        if response is None:
+            logger.warning("A classification request was not recorded in the cassette, leaving it unclassified")
+            response = {'id': 'msg_unrecorded', 'type': 'message', 'role': 'assistant', 'model': request['model'],
+                        'content': [{'type': 'text', 'text': ''}], 'stop_reason': 'end_turn',
+                        'stop_sequence': None, 'usage': {'input_tokens': 0, 'output_tokens': 0}}
+        return Message.model_validate(response)
+
+
+async def load_categories(mm: MonarchMoney, cache_file: Optional[str] = DEFAULT_CATEGORIES_CACHE_FILE,
+                          refresh_seconds: float = DEFAULT_CATEGORIES_REFRESH_HOURS * 60 * 60,
+                          metrics: Optional[RunMetrics] = None) -> dict:
+    """Return Monarch's transaction categories, from cache_file if they were fetched less than refresh_seconds ago."""
+    if cache_file is not None and os.path.exists(cache_file):
+        with open(cache_file, 'r', encoding='utf-8') as file:
+            cached = json.load(file)
+        if time.time() - cached['fetched_at'] < refresh_seconds:
+            logger.info(f"Using the categories cached in {cache_file}")
+            if metrics is not None:
+                metrics.count('cached')
+            return cached['categories']
+
+    categories = await mm.get_transaction_categories()
+    if cache_file is not None:
+        with open(cache_file + '.tmp', 'w', encoding='utf-8') as file:
+            json.dump({'fetched_at': time.time(), 'categories': categories}, file)
+        os.replace(cache_file + '.tmp', cache_file)
+    return categories
 
-        except ValueError as e:
-            # pprint(e)
-            transaction_date_start = (datetime.strptime(items['order_date'], '%Y-%m-%dT%H:%M:%S.%fZ') - timedelta(
-                days=1)).strftime('%Y-%m-%d')
 
-        try:
-            transaction_date_end = (
-                    datetime.strptime(items['delivery_date'], '%Y-%m-%dT%H:%M:%SZ') + timedelta(days=4)).strftime(
-                '%Y-%m-%d')
-        except ValueError as e:
-            # pprint(e)
-            try:
-                transaction_date_end = (
-                        datetime.strptime(items['delivery_date'], '%Y-%m-%dT%H:%M:%S.%fZ') + timedelta(
-                    days=4)).strftime('%Y-%m-%d')
-            except ValueError as e:
-                # pprint(e)
-                transaction_date_end = transaction_date_start
+def process_categories(category_dict):
+    # todo type hint this
+    category_names = []
+    category_id_map = {}
 
-        total_cost = round(items['total_cost'], 2)
+    for category in category_dict['categories']:
+        name = category['name']
+        category_id = category['id']
 
-        offset = 0
+        category_names.append(name)
+        category_id_map[name] = category_id
 
+    return category_names, category_id_map
+
+
+@dataclass(frozen=True, slots=True)
+class AmountTolerance:
+    """
+    How far a charge may be from the Amazon amount and still match, for totals changed by shipping, tax or promotions.
+
+    exact needs the same cents. absolute allows +/- cents, percent allows +/- percent of the amount and tax allows
+    anything from the amount up to the amount plus tax_rate, give or take a cent of rounding.
+    """
+    policy: str = 'exact'
+    cents: int = DEFAULT_TOLERANCE_CENTS
+    percent: float = DEFAULT_TOLERANCE_PERCENT
+    tax_rate: float = DEFAULT_TAX_RATE
+
+    @property
+    def is_exact(self) -> bool:
+        return self.policy == 'exact'
+
+    def bounds(self, cents: int) -> Tuple[int, int]:
+        """The lowest and highest charge, in cents, that can match an amount of `cents`."""
+        if self.policy == 'absolute':
+            return cents - self.cents, cents + self.cents
+        if self.policy == 'percent':
+            allowance = math.ceil(cents * self.percent / 100)
+            return cents - allowance, cents + allowance
+        if self.policy == 'tax':
+            return cents - 1, math.ceil(cents * (1 + self.tax_rate)) + 1
+        return cents, cents
+
+    def confidence(self, cents: int, charged_cents: int) -> float:
+        """1.0 for an exact amount, falling linearly to 0.5 at the edge of the tolerance."""
+        if charged_cents == cents:
+            return 1.0
+        low, high = self.bounds(cents)
+        allowance = high - cents if charged_cents > cents else cents - low
+        return 1.0 - 0.5 * abs(charged_cents - cents) / allowance
+
+
+EXACT_TOLERANCE = AmountTolerance()
+
+
+def approximate_note(cents: int, charged_cents: int, confidence: float) -> str:
+    if charged_cents == cents:
+        return ''
+    return APPROXIMATE_NOTE.format(difference=format_cents(charged_cents - cents), confidence=confidence)
+
+
+@dataclass(frozen=True, slots=True)
+class MatchNode:
+    """An item or aggregated order to be matched against the transactions charged in its window."""
+    cents: Optional[int]
+    order_day: int
+    delivery_day: int
+
+
+def candidate_edges(nodes: List[MatchNode], index: TransactionIndex,
+                    tolerance: AmountTolerance = EXACT_TOLERANCE) -> List[List[Tuple[dict, float]]]:
+    """
+    For each node, list (transaction, cost) for every transaction it could match. The cost is the number of days
+    between the order and the posting, so the assignment prefers the closest charge. Charges that only match within
+    the tolerance cost TOLERANCE_PENALTY_DAYS more, plus up to as much again as their confidence drops, so an exact
+    amount is always preferred.
+    """
+    edges = []
+    for node in nodes:
+        start_day, end_day = get_transaction_window(node.order_day, node.delivery_day)
+        if tolerance.is_exact or node.cents is None:
+            edges.append([(transaction, abs(day - node.order_day))
+                          for day, transaction in index.candidates(node.cents, start_day, end_day)])
+            continue
+        node_edges = []
+        for cents, day, transaction in index.candidates_between(*tolerance.bounds(node.cents), start_day, end_day):
+            cost = abs(day - node.order_day)
+            if cents != node.cents:
+                cost += TOLERANCE_PENALTY_DAYS * (1 + 2 * (1 - tolerance.confidence(node.cents, cents)))
+            node_edges.append((transaction, cost))
+        edges.append(node_edges)
+    return edges
+
+
+def solve_assignment(costs: List[List[float]]) -> List[int]:
+    """
+    Minimum-cost assignment of every row to a distinct column (rows <= columns), using the Hungarian algorithm with
+    potentials. Returns the column chosen for each row.
+    """
+    rows, columns = len(costs), len(costs[0])
+    u = [0.0] * (rows + 1)
+    v = [0.0] * (columns + 1)
+    owner = [0] * (columns + 1)
+    way = [0] * (columns + 1)
+    for row in range(1, rows + 1):
+        owner[0] = row
+        column = 0
+        min_slack = [math.inf] * (columns + 1)
+        used = [False] * (columns + 1)
         while True:
-            matched = False
-            amazon_transactions = await mm.get_transactions(
-                limit=DEFAULT_RECORD_LIMIT,
-                offset=offset,
-                start_date=transaction_date_start,
-                end_date=transaction_date_end,
-                category_ids=category_ids,
-                search='Amazon',
-                has_notes=False
-            )
-            prime_transactions = await mm.get_transactions(
-                limit=DEFAULT_RECORD_LIMIT,
-                offset=offset,
-                start_date=transaction_date_start,
-                end_date=transaction_date_end,
-                category_ids=category_ids,
-                search='Prime Video',
-                has_notes=False
-            )
-            transactions = amazon_transactions['allTransactions']['results'] + prime_transactions['allTransactions'][
-                'results']
-
-            # pprint(f'Checked for transactions from {transaction_date_start} to {transaction_date_end}')
-            print(f"  Found {len(transactions)} transactions between {transaction_date_start} and {transaction_date_end} for comparison")
-            if transactions:
-                print(f"  Transaction amounts: {[round(abs(t['amount']), 2) for t in transactions]} (looking for ${total_cost})")
-            pprint(f'transactions found for comparison: {len(transactions)}')
-            for transaction in transactions:
-                rounded_transaction = round(abs(transaction['amount']), 2)
-                # print(f'transaction amount un-rounded: ${transaction['amount']}, rounded: ${rounded_transaction}, '
-                #       f'total_cost: ${total_cost}')
-                if rounded_transaction == total_cost:
-                    matched = True
-                    predicted_category = await classify_item(anthropic_client, cat_names, items['description'])
-                    pprint(f"POST-AGGREGATION Match - Item Description: {items['description']}")
-                    pprint(f"POST-AGGREGATION Predicted category: {predicted_category}")
-                    if dry_run:
-                        print(f"[DRY RUN] Would update transaction {transaction['id']} with category '{predicted_category}' and notes '{items['description']} ~Post-aggregation match via auto-classifier script~'")
-                    else:
-                        await mm.update_transaction(
-                            transaction_id=transaction['id'],
-                            notes=items['description'] + ' ~Post-aggregation match via auto-classifier script~',
-                            category_id=cat_map.get(predicted_category, None)
-                        )
-                    time.sleep(sleep_seconds)
+            used[column] = True
+            current_row = owner[column]
+            delta = math.inf
+            next_column = 0
+            for candidate in range(1, columns + 1):
+                if used[candidate]:
+                    continue
+                slack = costs[current_row - 1][candidate - 1] - u[current_row] - v[candidate]
+                if slack < min_slack[candidate]:
+                    min_slack[candidate] = slack
+                    way[candidate] = column
+                if min_slack[candidate] < delta:
+                    delta = min_slack[candidate]
+                    next_column = candidate
+            for candidate in range(columns + 1):
+                if used[candidate]:
+                    u[owner[candidate]] += delta
+                    v[candidate] -= delta
+                else:
+                    min_slack[candidate] -= delta
+            column = next_column
+            if owner[column] == 0:
+                break
+        while column:
+            previous = way[column]
+            owner[column] = owner[previous]
+            column = previous
+
+    assignment = [-1] * rows
+    for column in range(1, columns + 1):
+        if owner[column]:
+            assignment[owner[column] - 1] = column - 1
+    return assignment
+
+
+def assign_component(node_ids: List[int], transaction_ids: List[str], edges: List[List[Tuple[dict, int]]],
+                     nodes: List[MatchNode]) -> dict:
+    """Assign one connected component of the candidate graph, returning {node id: transaction}."""
+    if len(node_ids) == 1:
+        transaction, _ = min(edges[node_ids[0]], key=lambda edge: edge[1])
+        return {node_ids[0]: transaction}
+
+    if len(node_ids) + len(transaction_ids) > MAX_EXACT_ASSIGNMENT_SIZE:
+        # Too big to solve exactly: sweep the postings in date order and give each one to the open node whose window
+        # closes first, which still matches as many nodes as possible when windows are the only constraint
+        open_nodes = defaultdict(list)
+        for node_id in node_ids:
+            for transaction, cost in edges[node_id]:
+                open_nodes[transaction['id']].append((nodes[node_id].delivery_day, cost, node_id, transaction))
+        assigned = {}
+        for transaction_id in sorted(transaction_ids, key=lambda key: open_nodes[key][0][3]['date']):
+            for _, _, node_id, transaction in sorted(open_nodes[transaction_id], key=lambda edge: edge[:3]):
+                if node_id not in assigned:
+                    assigned[node_id] = transaction
                     break
+        return assigned
+
+    column_of = {transaction_id: column for column, transaction_id in enumerate(transaction_ids)}
+    transactions = {}
+    # Any real edge must beat leaving a node unassigned, so the solver maximizes matches first and cost second
+    missing_cost = 1 + len(node_ids) * (1 + max(cost for node_id in node_ids for _, cost in edges[node_id]))
+    costs = [[missing_cost] * len(transaction_ids) for _ in node_ids]
+    for row, node_id in enumerate(node_ids):
+        for transaction, cost in edges[node_id]:
+            costs[row][column_of[transaction['id']]] = cost
+            transactions[transaction['id']] = transaction
+
+    transposed = len(node_ids) > len(transaction_ids)
+    if transposed:
+        costs = [list(column) for column in zip(*costs)]
+    assignment = solve_assignment(costs)
+    pairs = [(column, row) for row, column in enumerate(assignment)] if transposed else enumerate(assignment)
+
+    assigned = {}
+    for row, column in pairs:
+        if column >= 0 and costs[column if transposed else row][row if transposed else column] < missing_cost:
+            assigned[node_ids[row]] = transactions[transaction_ids[column]]
+    return assigned
+
+
+def assign_transactions(nodes: List[MatchNode], index: TransactionIndex,
+                        tolerance: AmountTolerance = EXACT_TOLERANCE) -> List[Optional[dict]]:
+    """
+    Find the assignment of nodes to transactions that matches the most nodes with the least total date distance.
+
+    The range queries on the index keep the candidate graph sparse, and the graph is split into connected components
+    that are solved independently, so only nodes competing for the same charges are solved together. Assigned
+    transactions are removed from the index.
+    """
+    edges = candidate_edges(nodes, index, tolerance)
+    nodes_of_transaction = defaultdict(list)
+    for node_id, node_edges in enumerate(edges):
+        for transaction, _ in node_edges:
+            nodes_of_transaction[transaction['id']].append(node_id)
+
+    assignment = [None] * len(nodes)
+    visited = set()
+    for start in range(len(nodes)):
+        if start in visited or not edges[start]:
+            continue
+        visited.add(start)
+        node_ids, transaction_ids = [], set()
+        queue = deque([start])
+        while queue:
+            node_id = queue.popleft()
+            node_ids.append(node_id)
+            for transaction, _ in edges[node_id]:
+                if transaction['id'] in transaction_ids:
+                    continue
+                transaction_ids.add(transaction['id'])
+                for neighbour in nodes_of_transaction[transaction['id']]:
+                    if neighbour not in visited:
+                        visited.add(neighbour)
+                        queue.append(neighbour)
+
+        for node_id, transaction in assign_component(node_ids, list(transaction_ids), edges, nodes).items():
+            assignment[node_id] = transaction
+            index.remove(transaction['id'])
+    return assignment
+
+
+def match_individual_items(individual_items: List[OrderItem], index: TransactionIndex,
+                           tolerance: AmountTolerance = EXACT_TOLERANCE) -> Tuple[List[Match], List[OrderItem]]:
+    matches = []
+    unmatched_items = []
+    candidate_items = []
 
-            if matched or len(transactions) < DEFAULT_RECORD_LIMIT:
-                break
+    for item in individual_items:
+        logger.debug(f"Processing individual item - Order ID: {item.order_id}, Description: {item.description[:50]}{'...' if len(item.description) > 50 else ''}, Amount: {format_cents(item.cents)}")
+        if item.delivery_day is None:
+            unmatched_items.append(item)
+        else:
+            candidate_items.append(item)
+
+    assignment = assign_transactions([MatchNode(item.cents, item.order_day, item.delivery_day)
+                                      for item in candidate_items], index, tolerance)
+    for item, transaction in zip(candidate_items, assignment):
+        if transaction is None:
+            unmatched_items.append(item)
+        else:
+            charged_cents = to_cents(transaction['amount'])
+            confidence = tolerance.confidence(item.cents, charged_cents)
+            matches.append(Match(transaction['id'], item.description, 'PRE-AGGREGATION',
+                                 approximate_note(item.cents, charged_cents, confidence) + PRE_AGGREGATION_NOTE,
+                                 (item_key(item),), confidence, transaction['date']))
+
+    logger.info(f"Matched {len(matches)} of {len(individual_items)} individual items")
+    return matches, unmatched_items
 
-            offset += DEFAULT_RECORD_LIMIT
-            time.sleep(sleep_seconds)
 
-        if not matched:
-            unmatched_rows.append((items['order_date'], items['delivery_date'], items['description'], total_cost))
+def match_aggregated_orders(unmatched_individual_items: List[OrderItem], index: TransactionIndex,
+                            tolerance: AmountTolerance = EXACT_TOLERANCE) -> Tuple[List[Match], List[AggregatedOrder]]:
+    matches = []
+    unmatched_orders = []
+    aggregated_orders = {}
+
+    for item in unmatched_individual_items:
+        order = aggregated_orders.get(item.order_id)
+        if order is None:
+            aggregated_orders[item.order_id] = AggregatedOrder(item.order_id, [item])
+        else:
+            order.items.append(item)
+
+    candidate_orders = []
+    for order in aggregated_orders.values():
+        logger.debug(f"Processing aggregated order - Order ID: {order.order_id}, Description: {order.description[:50]}{'...' if len(order.description) > 50 else ''}, Amount: {format_cents(order.cents)}")
+        if order.delivery_day is not None:
+            candidate_orders.append(order)
+
+    assignment = assign_transactions([MatchNode(order.cents, order.order_day, order.delivery_day)
+                                      for order in candidate_orders], index, tolerance)
+    for order, transaction in zip(candidate_orders, assignment):
+        if transaction is None:
+            unmatched_orders.append(order)
+        else:
+            charged_cents = to_cents(transaction['amount'])
+            confidence = tolerance.confidence(order.cents, charged_cents)
+            matches.append(Match(transaction['id'], order.description, 'POST-AGGREGATION',
+                                 approximate_note(order.cents, charged_cents, confidence) + POST_AGGREGATION_NOTE,
+                                 tuple(item_key(item) for item in order.items), confidence, transaction['date']))
+
+    logger.info(f"Matched {len(matches)} of {len(aggregated_orders)} aggregated orders")
+    return matches, unmatched_orders
+
+
+def reachable_subset_sums(item_cents: List[int], limit: int) -> dict:
+    """
+    Bounded subset-sum dynamic program over integer cents.
+
+    Returns {total: (previous total, item position, item count)} for every total up to limit reachable by some subset,
+    which is enough to walk back one subset per total. The table never holds more than limit + 1 entries.
+    """
+    reachable = {0: (None, None, 0)}
+    for position, cents in enumerate(item_cents):
+        for total, (_, _, count) in list(reachable.items()):
+            new_total = total + cents
+            if new_total <= limit and new_total not in reachable:
+                reachable[new_total] = (total, position, count + 1)
+    return reachable
+
+
+def subset_for_total(reachable: dict, total: int) -> List[int]:
+    positions = []
+    while total:
+        total, position, _ = reachable[total]
+        positions.append(position)
+    return positions
+
+
+def match_split_shipments(unmatched_orders: List[AggregatedOrder],
+                          index: TransactionIndex) -> Tuple[List[Match], List[UnmatchedRow]]:
+    """
+    Match orders Amazon charged as several transactions, one per shipment.
+
+    For each order, look for subsets of two or more of its remaining items whose cent total equals a transaction
+    posted in the order's window. Single items and the whole order were already tried by the earlier phases. Orders
+    with more than MAX_SPLIT_ORDER_ITEMS items are skipped to keep the search bounded.
+    """
+    matches = []
+    unmatched_rows = []
+
+    for order in unmatched_orders:
+        started = time.perf_counter()
+        remaining = [item for item in order.items if item.cents and item.delivery_day is not None]
+        order_matches = 0
+        shipped = set()
+
+        if 2 <= len(remaining) <= MAX_SPLIT_ORDER_ITEMS:
+            order_day = min(item.order_day for item in remaining)
+            start_day, end_day = get_transaction_window(order_day, max(item.delivery_day for item in remaining))
+            while len(remaining) >= 2:
+                item_cents = [item.cents for item in remaining]
+                # Only totals some charge in the window could equal are worth building, so the largest such charge
+                # bounds the table, and an empty window skips it altogether
+                window = index.candidates_between(sum(sorted(item_cents)[:2]), sum(item_cents), start_day, end_day)
+                if not window:
+                    break
+                amounts = sorted({cents for cents, _, _ in window}, reverse=True)
+                reachable = reachable_subset_sums(item_cents, amounts[0])
+                found = None
+                # Try the largest shipments first so big charges aren't broken up by smaller coincidental totals
+                for total in amounts:
+                    if total in reachable and reachable[total][2] >= 2:
+                        found = (total, min((candidate for candidate in window if candidate[0] == total),
+                                            key=lambda candidate: abs(candidate[1] - order_day))[2])
+                        break
+                if found is None:
+                    break
+
+                total, transaction = found
+                positions = set(subset_for_total(reachable, total))
+                shipment = [item for position, item in enumerate(remaining) if position in positions]
+                remaining = [item for position, item in enumerate(remaining) if position not in positions]
+                shipped.update(id(item) for item in shipment)
+                index.remove(transaction['id'])
+                matches.append(Match(transaction['id'], ' '.join(item.description for item in shipment),
+                                     'SPLIT-SHIPMENT', SPLIT_SHIPMENT_NOTE,
+                                     tuple(item_key(item) for item in shipment), 1.0, transaction['date']))
+                order_matches += 1
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        logger.debug(f"  Split shipment search for order {order.order_id} ({len(order.items)} items): "
+                     f"{order_matches} shipments matched in {elapsed_ms:.1f} ms")
+
+        unmatched_items = [item for item in order.items if id(item) not in shipped]
+        if unmatched_items:
+            unmatched_rows.append(UnmatchedRow(order.order_id, order.order_day, order.delivery_day,
+                                               ' '.join(item.description for item in unmatched_items),
+                                               sum(item.cents or 0 for item in unmatched_items)))
+
+    logger.info(f"Matched {len(matches)} split shipments across {len(unmatched_orders)} unmatched orders")
+    return matches, unmatched_rows
+
+
+async def update_matches(writer: UpdateWriter, matches: List[Match], predicted_categories: List[str], cat_map: dict,
+                         order_ids_by_key: dict) -> int:
+    """
+    Queue the Monarch update of every match. Matches whose classification failed (None) are left alone, so their
+    transactions stay un-noted and the next run tries them again. Returns how many were left.
+    """
+    skipped = 0
+    for match, predicted_category in zip(matches, predicted_categories):
+        logger.debug(f"{match.phase} Match - Item Description: {match.description}")
+        logger.debug(f"{match.phase} Predicted category: {predicted_category}")
+        if predicted_category is None:
+            logger.warning(f"Not updating transaction {match.transaction_id}, classifying '{match.description}' failed")
+            skipped += 1
+            continue
+        await writer.submit(MonarchUpdate(match.transaction_id, match.description + match.note_suffix,
+                                          cat_map.get(predicted_category, None), predicted_category, match.phase,
+                                          match.item_keys, tuple(order_ids_by_key[key] for key in match.item_keys),
+                                          match.confidence, match.transaction_date))
+    return skipped
+
+
+def match_items(individual_items: List[OrderItem], index: TransactionIndex, order_ids_by_key: dict,
+                metrics: RunMetrics, tolerance: AmountTolerance = EXACT_TOLERANCE,
+                on_matches: Callable[[List[Match]], None] = lambda matches: None
+                ) -> Tuple[List[Match], List[UnmatchedRow]]:
+    """
+    Run the three matching phases over items sorted by order day, removing matched transactions from the index.
+    Each phase's matches are handed to on_matches as soon as the phase finishes.
+
+    The phases only match exact amounts. With a tolerance, the rows still unmatched afterwards get one more pass of the
+    first two phases that accepts amounts within it, so an approximate match never takes a charge an exact one needed.
+    """
+    logger.info("Phase 1: Matching individual items before aggregation...")
+    with metrics.phase('phase1'):
+        matches, unmatched_individual_items = match_individual_items(individual_items, index)
+        metrics.count('attempted', len(individual_items))
+        metrics.count('matched', len(matches))
+    on_matches(matches)
+
+    # Phase 2: Aggregate remaining unmatched items and try matching again
+    logger.info("Phase 2: Aggregating unmatched items and matching again...")
+    with metrics.phase('phase2'):
+        aggregated_matches, unmatched_orders = match_aggregated_orders(unmatched_individual_items, index)
+        metrics.count('attempted', len(aggregated_matches) + len(unmatched_orders))
+        metrics.count('matched', len(aggregated_matches))
+    on_matches(aggregated_matches)
+    matches += aggregated_matches
+
+    # Phase 3: Look for orders charged as several transactions, one per shipment
+    logger.info("Phase 3: Matching split shipments...")
+    with metrics.phase('phase3'):
+        split_matches, unmatched_rows = match_split_shipments(unmatched_orders, index)
+        metrics.count('attempted', len(unmatched_orders))
+        metrics.count('matched', len({order_ids_by_key[key] for match in split_matches for key in match.item_keys}))
+        metrics.count('transactions', len(split_matches))
+    on_matches(split_matches)
+    matches += split_matches
+    if tolerance.is_exact or not unmatched_rows:
+        return matches, unmatched_rows
+
+    logger.info(f"Matching the remaining rows within the {tolerance.policy} amount tolerance...")
+    with metrics.phase('approximate'):
+        matched_keys = {key for match in matches for key in match.item_keys}
+        remaining_items = [item for item in individual_items if item_key(item) not in matched_keys]
+        item_matches, remaining_items = match_individual_items(remaining_items, index, tolerance)
+        order_matches, _ = match_aggregated_orders(remaining_items, index, tolerance)
+        approximate_matches = item_matches + order_matches
+        metrics.count('attempted', len(unmatched_rows))
+        metrics.count('matched', len({order_ids_by_key[key] for match in approximate_matches
+                                      for key in match.item_keys}))
+        metrics.count('transactions', len(approximate_matches))
+    on_matches(approximate_matches)
+    matches += approximate_matches
+
+    matched_keys.update(key for match in approximate_matches for key in match.item_keys)
+    unmatched_by_order = defaultdict(list)
+    for item in remaining_items:
+        if item_key(item) not in matched_keys:
+            unmatched_by_order[item.order_id].append(item)
+    unmatched_rows = [UnmatchedRow(order_id, items[0].order_day, items[0].delivery_day,
+                                   ' '.join(item.description for item in items),
+                                   sum(item.cents or 0 for item in items))
+                      for order_id, items in unmatched_by_order.items()]
+    return matches, unmatched_rows
+
+
+async def match_classify_and_write(mm: MonarchMoney, anthropic_client: any, individual_items: List[OrderItem],
+                                   index: TransactionIndex, order_ids_by_key: dict, cat_names: List[str],
+                                   cat_map: dict, limiter: AdaptiveRateLimiter, dry_run: bool = False,
+                                   max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                                   cache: Optional[ClassificationCache] = None, batch_size: int = DEFAULT_BATCH_SIZE,
+                                   use_message_batches: bool = False,
+                                   batch_poll_seconds: float = DEFAULT_BATCH_POLL_SECONDS,
+                                   state: Optional[StateStore] = None,
+                                   write_concurrency: int = DEFAULT_WRITE_CONCURRENCY,
+                                   write_max_attempts: int = DEFAULT_WRITE_MAX_ATTEMPTS,
+                                   dead_letter_file: str = DEFAULT_DEAD_LETTER_FILE,
+                                   dry_run_file: str = DEFAULT_DRY_RUN_FILE,
+                                   merchant_searches: List[str] = MERCHANT_SEARCHES,
+                                   fetch_concurrency: int = DEFAULT_FETCH_CONCURRENCY,
+                                   metrics: Optional[RunMetrics] = None,
+                                   local_classifier: Optional[LocalClassifier] = None,
+                                   local_confidence: float = DEFAULT_LOCAL_CONFIDENCE,
+                                   tolerance: AmountTolerance = EXACT_TOLERANCE
+                                   ) -> Tuple[List[Match], List[UnmatchedRow], UpdateWriter]:
+    """
+    Match, classify and write as a pipeline of stages connected by bounded queues: match -> classify -> write.
+
+    The matching phases run in a worker thread. Each phase's matches are cut into micro-batches and queued for
+    classification as soon as the phase finishes, so Claude classifies phase 1 while the later phases are still
+    solving, and every classified micro-batch goes straight to the write-behind queue. A full queue makes the stage
+    feeding it wait. Returns the matches, the unmatched rows and the drained writer.
+    """
+    metrics = metrics if metrics is not None else RunMetrics()
+    if local_classifier is not None and not local_classifier.categories:
+        with metrics.phase('train'):
+            await train_from_history(mm, local_classifier, merchant_searches, fetch_concurrency, metrics)
+
+    loop = asyncio.get_running_loop()
+    classify_queue = StageQueue('classify', PIPELINE_QUEUE_SIZE, metrics)
+    micro_batch = max(PIPELINE_BATCH_SIZE, PIPELINE_BATCHES_PER_WORKER * max_concurrency * max(batch_size, 1))
+    abandoned = False
+
+    def enqueue(matches: List[Match]) -> None:
+        # Runs on the match thread. Message batches take minutes each, so they get a whole phase at a time
+        size = len(matches) if use_message_batches else micro_batch
+        for start in range(0, len(matches), size):
+            if abandoned:
+                return
+            asyncio.run_coroutine_threadsafe(classify_queue.put(matches[start:start + size]), loop).result()
+
+    async def match_stage() -> Tuple[List[Match], List[UnmatchedRow]]:
+        try:
+            return await asyncio.to_thread(match_items, individual_items, index, order_ids_by_key, metrics, tolerance,
+                                           enqueue)
+        finally:
+            await classify_queue.put(None)
+
+    hits, misses = (cache.hits, cache.misses) if cache is not None else (0, 0)
+    classified = unclassified = failed = 0
+    async with UpdateWriter(mm, write_concurrency, write_max_attempts, dead_letter_file,
+                            None if dry_run else state, dry_run_file if dry_run else None, metrics) as writer:
+        matcher = asyncio.create_task(match_stage())
+        try:
+            while (batch := await classify_queue.get()) is not None:
+                logger.info(f"Classifying {len(batch)} matched transactions...")
+                with metrics.phase('classify'):
+                    predicted_categories = await classify_items(anthropic_client, cat_names,
+                                                                [match.description for match in batch], limiter,
+                                                                max_concurrency, cache, batch_size,
+                                                                use_message_batches, batch_poll_seconds, metrics,
+                                                                local_classifier, local_confidence)
+                classified += len(batch)
+                unclassified += sum(category not in cat_map for category in predicted_categories)
+                failed += await update_matches(writer, batch, predicted_categories, cat_map, order_ids_by_key)
+            matches, unmatched_rows = await matcher
+        except BaseException:
+            # Unblock the match thread if it is waiting on the full queue, then let it finish
+            abandoned = True
+            while not matcher.done():
+                while not classify_queue.empty():
+                    classify_queue.get_nowait()
+                await asyncio.wait([matcher], timeout=0.05)
+            raise
+
+    with metrics.phase('classify'):
+        if local_classifier is not None:
+            local_classifier.save()
+        metrics.count('descriptions', classified)
+        metrics.count('unclassified', unclassified)
+        metrics.count('classification_failed', failed)
+        if cache is not None:
+            metrics.count('cache_hits', cache.hits - hits)
+            metrics.count('cache_misses', cache.misses - misses)
+    if failed:
+        logger.warning(f"{failed} matched transactions were left un-noted because classifying them failed, "
+                       f"the next run will try them again")
+    if cache is not None:
+        logger.info(f"Classification cache: {cache.hits} hits, {cache.misses} misses, {cache.shared} shared in-flight requests")
+    if metrics.tokens:
+        logger.info(f"Anthropic tokens: {metrics.tokens['input_tokens']} input, "
+                    f"{metrics.tokens['cache_creation_input_tokens']} written to the prompt cache, "
+                    f"{metrics.tokens['cache_read_input_tokens']} read from the prompt cache, "
+                    f"{metrics.tokens['output_tokens']} output")
+    if dry_run:
+        logger.info(f"[DRY RUN] {writer.written} updates that would be made were written to {dry_run_file}")
+    return matches, unmatched_rows, writer
+
+
+async def match_and_update_transactions(mm: MonarchMoney, anthropic_client: any, order_files: OrderFiles,
+                                        category_ids: List[str], sleep_seconds: float, start_date: str,
+                                        end_date: str, dry_run: bool = False,
+                                        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                                        requests_per_second: float = DEFAULT_REQUESTS_PER_SECOND,
+                                        cache: Optional[ClassificationCache] = None,
+                                        batch_size: int = DEFAULT_BATCH_SIZE, use_message_batches: bool = False,
+                                        batch_poll_seconds: float = DEFAULT_BATCH_POLL_SECONDS,
+                                        snapshot_dir: Optional[str] = None, state: Optional[StateStore] = None,
+                                        resume: bool = False, write_concurrency: int = DEFAULT_WRITE_CONCURRENCY,
+                                        write_max_attempts: int = DEFAULT_WRITE_MAX_ATTEMPTS,
+                                        dead_letter_file: str = DEFAULT_DEAD_LETTER_FILE,
+                                        dry_run_file: str = DEFAULT_DRY_RUN_FILE,
+                                        merchant_searches: List[str] = MERCHANT_SEARCHES,
+                                        fetch_concurrency: int = DEFAULT_FETCH_CONCURRENCY,
+                                        metrics: Optional[RunMetrics] = None,
+                                        local_classifier: Optional[LocalClassifier] = None,
+                                        local_confidence: float = DEFAULT_LOCAL_CONFIDENCE,
+                                        categories_cache_file: Optional[str] = None,
+                                        categories_refresh_seconds: float = 0.0,
+                                        tolerance: AmountTolerance = EXACT_TOLERANCE,
+                                        parse_workers: int = DEFAULT_PARSE_WORKERS) -> dict:
+    """Match, classify and update the transactions for one run. Returns a summary with per-phase timings."""
+    metrics = metrics if metrics is not None else RunMetrics()
+    started = time.perf_counter()
+    if dry_run:
+        clear_dry_run_file(dry_run_file)
+    with metrics.phase('categories'):
+        mm_categories = await load_categories(mm, categories_cache_file, categories_refresh_seconds, metrics)
+    cat_names, cat_map = process_categories(mm_categories)
+    metrics.timings['startup'] = time.perf_counter() - MODULE_LOAD_STARTED
+    logger.info(f"Ready {metrics.timings['startup']:.2f}s after start (" +
+                ', '.join(f"{phase} {metrics.timings[phase]:.2f}s" for phase in ('import', 'login', 'categories')
+                          if phase in metrics.timings) + ')')
+    logger.info(f"Category list: {pformat(cat_map)}")
+
+    with metrics.phase('load'):
+        # Parsing is CPU-bound and may wait on the process pool, so it runs off the event loop
+        individual_items = await asyncio.to_thread(
+            lambda: sorted(iter_order_items(order_files, start_date, end_date, snapshot_dir, parse_workers),
+                           key=lambda item: item.order_day))
+        metrics.count('rows', len(individual_items))
+    order_ids_by_key = {item_key(item): item.order_id for item in individual_items}
+    if resume and state is not None:
+        processed = state.processed_rows()
+        individual_items = [item for item in individual_items if item_key(item) not in processed]
+        logger.info(f"Resuming: skipping {len(order_ids_by_key) - len(individual_items)} rows processed by earlier runs")
+
+    # Fetch every candidate transaction for the whole range once, both phases match against this index
+    windows = [get_transaction_window(item.order_day, item.delivery_day)
+               for item in individual_items if item.delivery_day is not None]
+    with metrics.phase('fetch'):
+        if windows:
+            index = await fetch_transaction_window(mm, category_ids,
+                                                   date.fromordinal(min(window[0] for window in windows)).isoformat(),
+                                                   date.fromordinal(max(window[1] for window in windows)).isoformat(),
+                                                   merchant_searches, fetch_concurrency, metrics)
+        else:
+            index = TransactionIndex()
+    candidate_transactions = len(index)
+    if resume and state is not None:
+        for transaction_id in state.matched_transactions():
+            index.remove(transaction_id)
+
+    limiter = classification_limiter(requests_per_second, sleep_seconds)
+    matches, unmatched_rows, writer = await match_classify_and_write(
+        mm, anthropic_client, individual_items, index, order_ids_by_key, cat_names, cat_map, limiter, dry_run,
+        max_concurrency, cache, batch_size, use_message_batches, batch_poll_seconds, state, write_concurrency,
+        write_max_attempts, dead_letter_file, dry_run_file, merchant_searches, fetch_concurrency, metrics,
+        local_classifier, local_confidence, tolerance)
+    if state is not None and not dry_run:
+        matched_keys = {key for match in matches for key in match.item_keys}
+        state.record_unmatched([item for item in individual_items if item_key(item) not in matched_keys])
 
     if unmatched_rows:
-        print("Unmatched rows, or rows that were already matched:")
+        logger.info(f"{len(unmatched_rows)} unmatched rows, or rows that were already matched:")
         for row in unmatched_rows:
-            print(
-                f"Order Date: {row[ORDER_ID_INDEX]}, Delivery Date: {row[DELIVERY_DATE_INDEX]}, Description: {row[DESCRIPTION_INDEX]}, Total Cost: ${row[3]}")
+            logger.info(
+                f"Order ID: {row.order_id}, Order Date: {format_day(row.order_day)}, Delivery Date: {format_day(row.delivery_day)}, Description: {row.description}, Total Cost: {format_cents(row.cents)}")
+
+    metrics.timings['total'] = time.perf_counter() - started
+    matches_by_phase = defaultdict(int)
+    for match in matches:
+        matches_by_phase[match.phase] += 1
+    return {
+        'items': len(individual_items),
+        'candidate_transactions': candidate_transactions,
+        'matches': dict(matches_by_phase),
+        'approximate_matches': sum(match.confidence < 1.0 for match in matches),
+        'unmatched_rows': len(unmatched_rows),
+        'updates_written': writer.written,
+        'updates_failed': writer.failed,
+        'timings': dict(metrics.timings),
+    }
+
+
+def dump_signature(paths: List[str]) -> tuple:
+    """Modification time and size of each dump file that exists, to notice when a newer dump is dropped in."""
+    signature = []
+    for path in paths:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            signature.append((path, stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+class Watcher:
+    """
+    Daemon mode: keep matching new Amazon rows and new Monarch transactions as they appear.
+
+    Parsed rows, the candidate transaction index, categories and caches stay in memory between cycles. Each cycle
+    re-reads the dump only if its files changed and polls Monarch for un-noted transactions posted since the sync
+    cursor, less SYNC_OVERLAP_DAYS because banks post late. Only the rows still pending are matched and classified.
+    A row stays pending until its posting window has been closed for SYNC_OVERLAP_DAYS, then it is journaled as
+    unmatched.
+    """
+
+    def __init__(self, mm: MonarchMoney, anthropic_client: any, orders_dir: str, category_ids: List[str],
+                 start_date: str, state: StateStore, limiter: AdaptiveRateLimiter, metrics: RunMetrics,
+                 snapshot_dir: Optional[str] = None, merchant_searches: List[str] = MERCHANT_SEARCHES,
+                 fetch_concurrency: int = DEFAULT_FETCH_CONCURRENCY, categories_cache_file: Optional[str] = None,
+                 categories_refresh_seconds: float = 0.0, dry_run: bool = False,
+                 tolerance: AmountTolerance = EXACT_TOLERANCE, parse_workers: int = DEFAULT_PARSE_WORKERS,
+                 **write_options):
+        self.mm = mm
+        self.anthropic_client = anthropic_client
+        self.orders_dir = orders_dir
+        self.category_ids = category_ids
+        self.start_date = start_date
+        self.state = state
+        self.limiter = limiter
+        self.metrics = metrics
+        self.snapshot_dir = snapshot_dir
+        self.merchant_searches = merchant_searches
+        self.fetch_concurrency = fetch_concurrency
+        self.categories_cache_file = categories_cache_file
+        self.categories_refresh_seconds = categories_refresh_seconds
+        self.dry_run = dry_run
+        self.tolerance = tolerance
+        self.parse_workers = parse_workers
+        self.write_options = write_options
+        self.signature = None
+        self.pending = []
+        self.order_ids_by_key = {}
+        self.index = TransactionIndex()
+        self.fetched_from = None
+        self.matched_transactions = state.matched_transactions()
+        self.cursor = state.get_cursor(SYNC_CURSOR)
+        self.cycles = 0
+
+    async def ingest_dump(self, today: int) -> int:
+        """Re-read the dump if it changed since the last cycle, queueing rows not seen or processed before."""
+        # Scanning and parsing the dump blocks, so it runs off the event loop, like the one-shot run's load
+        order_files = await asyncio.to_thread(discover_order_files, self.orders_dir)
+        signature = await asyncio.to_thread(dump_signature, order_files.paths)
+        if signature == self.signature:
+            return 0
+        self.signature = signature
+        processed = self.state.processed_rows()
+        new_items = []
+        with self.metrics.phase('load'):
+            items = await asyncio.to_thread(list, iter_order_items(order_files, self.start_date,
+                                                                   date.fromordinal(today).isoformat(),
+                                                                   self.snapshot_dir, self.parse_workers))
+            for item in items:
+                key = item_key(item)
+                if key in processed or key in self.order_ids_by_key:
+                    continue
+                self.order_ids_by_key[key] = item.order_id
+                new_items.append(item)
+            self.metrics.count('rows', len(new_items))
+        self.pending = sorted(self.pending + new_items, key=lambda item: item.order_day)
+        logger.info(f"Ingested {len(new_items)} new rows from the dump")
+        return len(new_items)
+
+    async def poll_transactions(self, today: int) -> int:
+        """Fetch un-noted transactions since the sync cursor (and any older window a new row needs) into the index."""
+        start_day = (date.fromisoformat(self.cursor).toordinal() if self.cursor else today) - SYNC_OVERLAP_DAYS
+        windows = [get_transaction_window(item.order_day, item.delivery_day)
+                   for item in self.pending if item.delivery_day is not None]
+        if windows:
+            earliest = min(window[0] for window in windows)
+            if self.fetched_from is None or earliest < self.fetched_from:
+                start_day = min(start_day, earliest)
+        self.fetched_from = start_day if self.fetched_from is None else min(self.fetched_from, start_day)
+
+        with self.metrics.phase('fetch'):
+            fetched = await fetch_transaction_window(self.mm, self.category_ids, date.fromordinal(start_day).isoformat(),
+                                                     date.fromordinal(today).isoformat(), self.merchant_searches,
+                                                     self.fetch_concurrency, self.metrics)
+        added = sum(self.index.add(transaction) for transaction in fetched
+                    if transaction['id'] not in self.matched_transactions)
+        self.cursor = date.fromordinal(today).isoformat()
+        if not self.dry_run:
+            self.state.set_cursor(SYNC_CURSOR, self.cursor)
+        return added
+
+    def expire_pending(self, today: int) -> None:
+        """Journal as unmatched the pending rows whose posting window closed more than SYNC_OVERLAP_DAYS ago."""
+        expired, pending = [], []
+        for item in self.pending:
+            last_day = get_transaction_window(item.order_day, item.delivery_day)[1] \
+                if item.delivery_day is not None else item.order_day
+            (expired if last_day < today - SYNC_OVERLAP_DAYS else pending).append(item)
+        if expired:
+            logger.info(f"Giving up on {len(expired)} rows whose posting window has closed")
+            if not self.dry_run:
+                self.state.record_unmatched(expired)
+        self.pending = pending
+
+    async def cycle(self) -> dict:
+        """Run one sync cycle, matching and classifying only what changed since the last one."""
+        started = time.perf_counter()
+        self.cycles += 1
+        today = date.today().toordinal()
+        with self.metrics.phase('categories'):
+            mm_categories = await load_categories(self.mm, self.categories_cache_file,
+                                                  self.categories_refresh_seconds, self.metrics)
+        cat_names, cat_map = process_categories(mm_categories)
+
+        new_rows = await self.ingest_dump(today)
+        new_transactions = await self.poll_transactions(today)
+        matches = []
+        if self.pending and (new_rows or new_transactions):
+            matches, _, writer = await match_classify_and_write(
+                self.mm, self.anthropic_client, self.pending, self.index, self.order_ids_by_key, cat_names, cat_map,
+                self.limiter, self.dry_run, state=self.state, merchant_searches=self.merchant_searches,
+                fetch_concurrency=self.fetch_concurrency, metrics=self.metrics, tolerance=self.tolerance,
+                **self.write_options)
+            # Matches whose classification failed weren't written. Their rows stay pending, and the next poll fetches
+            # their windows again so their transactions go back into the index
+            if any(match.transaction_id not in writer.submitted for match in matches):
+                self.fetched_from = None
+            matches = [match for match in matches if match.transaction_id in writer.submitted]
+            matched_keys = {key for match in matches for key in match.item_keys}
+            self.matched_transactions.update(match.transaction_id for match in matches)
+            self.pending = [item for item in self.pending if item_key(item) not in matched_keys]
+        self.expire_pending(today)
+
+        summary = {
+            'cycle': self.cycles,
+            'new_rows': new_rows,
+            'new_transactions': new_transactions,
+            'matches': len(matches),
+            'pending_rows': len(self.pending),
+            'seconds': time.perf_counter() - started,
+        }
+        logger.info(f"Cycle {self.cycles}: {new_rows} new rows, {new_transactions} new transactions, "
+                    f"{len(matches)} matches, {len(self.pending)} rows pending ({summary['seconds']:.2f}s)")
+        return summary
+
+    async def run(self, interval_seconds: float, stop: asyncio.Event, metrics_file: Optional[str] = None) -> None:
+        """Run a cycle every interval_seconds until stop is set. A cycle in progress always finishes first."""
+        while not stop.is_set():
+            try:
+                await self.cycle()
+            except Exception as e:
+                logger.exception(f"Watch cycle failed, trying again in {interval_seconds:g}s: {e}")
+            if metrics_file:
+                self.metrics.write(metrics_file)
+            try:
+                await asyncio.wait_for(stop.wait(), interval_seconds)
+            except asyncio.TimeoutError:
+                pass
+        logger.info(f"Stopped watching after {self.cycles} cycles")
+
+
+def tolerance_from_args(args: dict) -> AmountTolerance:
+    tolerance = AmountTolerance(args.get('amount_tolerance', 'exact'),
+                                int(args.get('tolerance_cents', DEFAULT_TOLERANCE_CENTS)),
+                                float(args.get('tolerance_percent', DEFAULT_TOLERANCE_PERCENT)),
+                                float(args.get('tax_rate', DEFAULT_TAX_RATE)))
+    if tolerance.policy not in TOLERANCE_POLICIES:
+        raise ValueError(f"amount_tolerance must be one of {', '.join(TOLERANCE_POLICIES)}, not {tolerance.policy}")
+    return tolerance
+
+
+def run_options(args: dict) -> dict:
+    """Convert merged config and command-line arguments into the keyword arguments of match_and_update_transactions."""
+    merchant_searches = args.get('merchant_searches', MERCHANT_SEARCHES)
+    if isinstance(merchant_searches, str):
+        merchant_searches = [search.strip() for search in merchant_searches.split(',') if search.strip()]
+    return {
+        'category_ids': args.get('category_ids'),
+        'sleep_seconds': float(args.get('sleep_seconds', 1.0)),
+        'start_date': args['start_date'],
+        'end_date': args['end_date'],
+        'dry_run': args.get('dry_run', False),
+        'max_concurrency': int(args.get('max_concurrency', DEFAULT_MAX_CONCURRENCY)),
+        'requests_per_second': float(args.get('requests_per_second', DEFAULT_REQUESTS_PER_SECOND)),
+        'batch_size': int(args.get('batch_size', DEFAULT_BATCH_SIZE)),
+        'use_message_batches': args.get('message_batches', False),
+        'batch_poll_seconds': float(args.get('batch_poll_seconds', DEFAULT_BATCH_POLL_SECONDS)),
+        'snapshot_dir': args.get('snapshot_dir', DEFAULT_SNAPSHOT_DIR) if args.get('columnar', False) else None,
+        'resume': args.get('resume', False),
+        'write_concurrency': int(args.get('write_concurrency', DEFAULT_WRITE_CONCURRENCY)),
+        'write_max_attempts': int(args.get('write_max_attempts', DEFAULT_WRITE_MAX_ATTEMPTS)),
+        'dead_letter_file': args.get('dead_letter_file', DEFAULT_DEAD_LETTER_FILE),
+        'dry_run_file': args.get('dry_run_file', DEFAULT_DRY_RUN_FILE),
+        'merchant_searches': merchant_searches,
+        'fetch_concurrency': int(args.get('fetch_concurrency', DEFAULT_FETCH_CONCURRENCY)),
+        'local_confidence': float(args.get('local_confidence', DEFAULT_LOCAL_CONFIDENCE)),
+        'categories_cache_file': args.get('categories_cache_file', DEFAULT_CATEGORIES_CACHE_FILE),
+        'categories_refresh_seconds': float(args.get('categories_refresh_hours', DEFAULT_CATEGORIES_REFRESH_HOURS))
+        * 60 * 60,
+        'tolerance': tolerance_from_args(args),
+        'parse_workers': int(args.get('parse_workers', DEFAULT_PARSE_WORKERS)),
+    }
+
+
+def apply_options(options: dict) -> dict:
+    """The subset of run_options that apply_plan takes. A dry run applies the plan to the dry run file."""
+    return {
+        'concurrency': options['write_concurrency'],
+        'max_attempts': options['write_max_attempts'],
+        'dead_letter_file': options['dead_letter_file'],
+        'dry_run_file': options['dry_run_file'] if options['dry_run'] else None,
+        'merchant_searches': options['merchant_searches'],
+        'fetch_concurrency': options['fetch_concurrency'],
+        'categories_cache_file': options['categories_cache_file'],
+        'categories_refresh_seconds': options['categories_refresh_seconds'],
+    }
+
+
+def load_accounts(config_files: List[str], base_args: dict) -> dict:
+    """
+    Read the config of every account of an --accounts run, layered over the shared arguments. Returns the arguments of
+    each account by name.
+
+    An account is named by its config's account_name, or else the config file's name. The files listed in
+    ACCOUNT_FILE_OPTIONS default to the account's own folder under DEFAULT_ACCOUNTS_DIR, and orders_dir to the
+    `Your Orders` folder next to the config, so accounts never share a session, journal or dump by accident.
+    """
+    accounts = {}
+    for config_file in config_files:
+        if not os.path.exists(config_file):
+            raise ValueError(f"Account config {config_file} does not exist")
+        config_values = load_config(config_file)
+        name = config_values.get('account_name') or os.path.splitext(os.path.basename(config_file))[0]
+        if name in accounts:
+            raise ValueError(f"Two accounts are named {name}, set account_name in {config_file}")
+        missing_args = [arg for arg in ('email', 'password') if arg not in config_values]
+        if missing_args:
+            raise ValueError(f"Account config {config_file} is missing {', '.join(missing_args)}")
+        account_dir = os.path.join(DEFAULT_ACCOUNTS_DIR, name)
+        os.makedirs(account_dir, exist_ok=True)
+        defaults = {option: os.path.join(account_dir, os.path.basename(default))
+                    for option, default in ACCOUNT_FILE_OPTIONS.items()}
+        defaults['orders_dir'] = os.path.join(os.path.dirname(config_file), DEFAULT_ORDERS_DIR)
+        accounts[name] = {**base_args, **defaults, **config_values}
+    return accounts
+
+
+async def run_account(name: str, args: dict, anthropic_client: any,
+                      cache: Optional[ClassificationCache] = None) -> dict:
+    """
+    Run the command for one account of an --accounts run with its own Monarch session, rate limiter, state file and
+    metrics, sharing the Anthropic client and classification cache. Returns the account's summary.
+    """
+    current_account.set(name)
+    started = time.perf_counter()
+    metrics = RunMetrics()
+    command = args.get('command', 'run')
+    options = run_options(args)
+
+    mm = MonarchSession(MonarchMoney(session_file=args['session_file']), args['email'], args['password'])
+    state = StateStore(args['state_file'])
+    local_classifier = None
+    if args.get('local_classifier', False):
+        local_classifier = LocalClassifier(args['local_classifier_file'])
+        if args.get('retrain_local_classifier', False):
+            local_classifier.reset()
+    try:
+        with metrics.phase('login'):
+            await mm.login()
+            metrics.count('session_reused', int(mm.reused_session))
+        if command == 'apply':
+            summary = await apply_plan(mm, args['plan_file'], state, metrics=metrics, **apply_options(options))
+        else:
+            if command == 'plan':
+                options.update(dry_run=True, dry_run_file=args['plan_file'])
+            orders_dir = args['orders_dir']
+            order_files = await asyncio.to_thread(discover_order_files, orders_dir)
+            logger.info(f"Orders folder {orders_dir}: {len(order_files.paths)} files")
+            summary = await match_and_update_transactions(mm, anthropic_client, order_files, cache=cache, state=state,
+                                                          metrics=metrics, local_classifier=local_classifier,
+                                                          **options)
+    finally:
+        metrics.write(args['metrics_file'])
+        state.close()
+    return {'command': command, **summary, 'tokens': dict(metrics.tokens), 'seconds': time.perf_counter() - started}
+
+
+async def run_accounts(accounts: dict, anthropic_client: any, cache: Optional[ClassificationCache] = None,
+                       metrics_file: Optional[str] = None) -> dict:
+    """
+    Run every account concurrently in this event loop. An account that fails is logged and reported in the summary
+    without stopping the others. Returns each account's summary and the aggregate throughput.
+    """
+    started = time.perf_counter()
+    hits, misses, shared = (cache.hits, cache.misses, cache.shared) if cache is not None else (0, 0, 0)
+    results = await asyncio.gather(*(run_account(name, args, anthropic_client, cache) for name, args in accounts.items()),
+                                   return_exceptions=True)
+    seconds = time.perf_counter() - started
+
+    summaries = {}
+    for name, result in zip(accounts, results):
+        if isinstance(result, BaseException):
+            logger.error(f"Account {name} failed: {result!r}", exc_info=result)
+            summaries[name] = {'error': repr(result)}
+        else:
+            summaries[name] = result
+    completed = [summary for summary in summaries.values() if 'error' not in summary]
+    items = sum(summary.get('items', 0) for summary in completed)
+    matches = sum(sum(summary.get('matches', {}).values()) for summary in completed)
+    written = sum(summary.get('updates_written', summary.get('applied', 0)) for summary in completed)
+    tokens = defaultdict(int)
+    for summary in completed:
+        for field, count in summary['tokens'].items():
+            tokens[field] += count
+    aggregate = {
+        'accounts': len(accounts),
+        'failed': len(accounts) - len(completed),
+        'seconds': seconds,
+        'items': items,
+        'matches': matches,
+        'updates_written': written,
+        'items_per_second': items / seconds if seconds else 0.0,
+        'updates_per_second': written / seconds if seconds else 0.0,
+        'tokens': dict(tokens),
+        'cache': {'hits': cache.hits - hits, 'misses': cache.misses - misses, 'shared': cache.shared - shared}
+        if cache is not None else None,
+    }
+
+    for name, summary in summaries.items():
+        if 'error' in summary:
+            logger.info(f"  {name}: failed, {summary['error']}")
+        else:
+            logger.info(f"  {name}: {summary.get('items', 0)} rows, {sum(summary.get('matches', {}).values())} "
+                        f"matches, {summary.get('updates_written', summary.get('applied', 0))} updates written "
+                        f"in {summary['seconds']:.2f}s")
+    logger.info(f"{len(completed)} of {len(accounts)} accounts finished in {seconds:.2f}s: {items} rows, {matches} "
+                f"matches, {written} updates ({aggregate['items_per_second']:.1f} rows/s, "
+                f"{aggregate['updates_per_second']:.1f} updates/s)")
+    if cache is not None:
+        logger.info(f"Shared classification cache: {aggregate['cache']['hits']} hits, {aggregate['cache']['misses']} "
+                    f"misses, {aggregate['cache']['shared']} shared in-flight requests")
+    result = {'accounts': summaries, 'aggregate': aggregate}
+    if metrics_file:
+        with open(metrics_file, 'w', encoding='utf-8') as file:
+            json.dump(result, file, indent=2)
+        logger.info(f"Wrote the batch summary to {metrics_file}")
+    return result
 
 
 def load_config(config_file):
@@ -460,7 +3002,13 @@ def get_last_of_previous_month():
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Process command-line arguments.')
+    parser.add_argument('command', nargs='?', default='run', choices=COMMANDS,
+                        help='run matches, classifies and updates Monarch in one go. plan does the matching and '
+                             'classification and saves the updates to plan_file for review, apply writes them')
     parser.add_argument('--config', help='Config file path for arguments')
+    parser.add_argument('--accounts', nargs='+', required=False,
+                        help='Config files of several Monarch accounts to process concurrently in one run '
+                             '(comma-separated in config)')
 
     parser.add_argument('--category_ids', nargs='+', required=False,
                         help='Category IDs to filter (space-separated)')
@@ -471,7 +3019,98 @@ def parse_args():
     parser.add_argument('--password', required=False,
                         help='Monarch password')
     parser.add_argument('--sleep_seconds', default=1.0,
-                        help='Sleep seconds to mitigate rate limits by Anthropic')
+                        help='Slowest pace, in seconds between requests, the Anthropic rate limiter backs off to')
+    parser.add_argument('--max_concurrency', default=DEFAULT_MAX_CONCURRENCY,
+                        help='Maximum number of classification requests in flight at once')
+    parser.add_argument('--requests_per_second', default=DEFAULT_REQUESTS_PER_SECOND,
+                        help='Fastest rate of classification requests per second')
+    parser.add_argument('--batch_size', default=DEFAULT_BATCH_SIZE,
+                        help='Number of items to classify per Anthropic request')
+    parser.add_argument('--message_batches', action='store_true', default=False,
+                        help='Classify through the Anthropic Message Batches API, for large backfills')
+    parser.add_argument('--batch_poll_seconds', default=DEFAULT_BATCH_POLL_SECONDS,
+                        help='Seconds between status checks of a submitted message batch')
+    parser.add_argument('--anthropic_base_url', required=False,
+                        help='Override the Anthropic API base URL, e.g. to point at a local stub server')
+    parser.add_argument('--orders_dir', default=DEFAULT_ORDERS_DIR,
+                        help='Amazon data dump folder; every retail and digital order history CSV under it is loaded')
+    parser.add_argument('--parse_workers', default=DEFAULT_PARSE_WORKERS,
+                        help='Processes used to parse the CSV shards of the dump in parallel')
+    parser.add_argument('--columnar', action='store_true', default=False,
+                        help='Load the Amazon dump with the vectorized loader and reuse a cached Parquet snapshot of it')
+    parser.add_argument('--snapshot_dir', default=DEFAULT_SNAPSHOT_DIR,
+                        help='Directory for the Parquet snapshots written by --columnar')
+    parser.add_argument('--state_file', default=DEFAULT_STATE_FILE,
+                        help='SQLite journal of the rows and transactions processed so far')
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help='Skip rows and transactions already recorded in the state file by earlier runs')
+    parser.add_argument('--write_concurrency', default=DEFAULT_WRITE_CONCURRENCY,
+                        help='Maximum number of Monarch updates in flight at once')
+    parser.add_argument('--write_max_attempts', default=DEFAULT_WRITE_MAX_ATTEMPTS,
+                        help='Attempts per Monarch update before it is written to the dead-letter file')
+    parser.add_argument('--dead_letter_file', default=DEFAULT_DEAD_LETTER_FILE,
+                        help='File collecting Monarch updates that failed after every retry')
+    parser.add_argument('--retry_dead_letters', action='store_true', default=False,
+                        help='Replay the updates in the dead-letter file instead of matching')
+    parser.add_argument('--dry_run_file', default=DEFAULT_DRY_RUN_FILE,
+                        help='File the updates a dry run would make are written to')
+    parser.add_argument('--plan_file', default=DEFAULT_PLAN_FILE,
+                        help='File the plan command saves the planned updates to and the apply command reads them from')
+    parser.add_argument('--merchant_searches', nargs='+', default=MERCHANT_SEARCHES,
+                        help='Monarch search terms used to find candidate transactions (comma-separated in config)')
+    parser.add_argument('--fetch_concurrency', default=DEFAULT_FETCH_CONCURRENCY,
+                        help='Maximum number of Monarch transaction pages fetched at once')
+    parser.add_argument('--cache_file', default=DEFAULT_CACHE_FILE,
+                        help='SQLite file used to cache classifications between runs')
+    parser.add_argument('--cache_max_entries', default=DEFAULT_CACHE_MAX_ENTRIES,
+                        help='Maximum number of cached classifications before the least recently used are evicted')
+    parser.add_argument('--cache_ttl_days', required=False,
+                        help='Ignore cached classifications older than this many days')
+    parser.add_argument('--no_cache', action='store_true', default=False,
+                        help='Do not read or write the classification cache')
+    parser.add_argument('--session_file', default=DEFAULT_SESSION_FILE,
+                        help='File the Monarch session is saved to and reused from until it expires')
+    parser.add_argument('--categories_cache_file', default=DEFAULT_CATEGORIES_CACHE_FILE,
+                        help='File the Monarch category list is cached in')
+    parser.add_argument('--categories_refresh_hours', default=DEFAULT_CATEGORIES_REFRESH_HOURS,
+                        help='Hours before the cached category list is fetched again (0 always fetches it)')
+    parser.add_argument('--local_classifier', action='store_true', default=False,
+                        help='Label items with a local model trained on past matches, only asking Claude when unsure')
+    parser.add_argument('--local_classifier_file', default=DEFAULT_LOCAL_CLASSIFIER_FILE,
+                        help='File the local classifier is saved to between runs')
+    parser.add_argument('--local_confidence', default=DEFAULT_LOCAL_CONFIDENCE,
+                        help='Lowest local classifier confidence (0-1) accepted without asking Claude')
+    parser.add_argument('--retrain_local_classifier', action='store_true', default=False,
+                        help='Discard the saved local classifier and retrain it from the notes in Monarch')
+    parser.add_argument('--log_level', default=DEFAULT_LOG_LEVEL, choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='How much to log. DEBUG shows every item, match and Anthropic response')
+    parser.add_argument('--metrics_file', default=DEFAULT_METRICS_FILE,
+                        help='File the JSON summary of run metrics is written to at exit')
+    parser.add_argument('--profile', action='store_true', default=False,
+                        help='Profile the run with cProfile and tracemalloc')
+    parser.add_argument('--profile_file', default=DEFAULT_PROFILE_FILE,
+                        help='File the cProfile stats of a --profile run are saved to')
+    parser.add_argument('--amount_tolerance', default='exact', choices=TOLERANCE_POLICIES,
+                        help='How far a charge may differ from the Amazon amount: exact, absolute (tolerance_cents), '
+                             'percent (tolerance_percent) or tax (up to tax_rate above the amount)')
+    parser.add_argument('--tolerance_cents', default=DEFAULT_TOLERANCE_CENTS,
+                        help='Cents a charge may differ by with --amount_tolerance absolute')
+    parser.add_argument('--tolerance_percent', default=DEFAULT_TOLERANCE_PERCENT,
+                        help='Percent a charge may differ by with --amount_tolerance percent')
+    parser.add_argument('--tax_rate', default=DEFAULT_TAX_RATE,
+                        help='Highest sales tax rate (e.g. 0.1) added to the amount with --amount_tolerance tax')
+    parser.add_argument('--record', action='store_true', default=False,
+                        help='Record every Monarch and Anthropic request and response to the cassette file')
+    parser.add_argument('--replay', action='store_true', default=False,
+                        help='Serve Monarch and Anthropic from the cassette file instead of the real services')
+    parser.add_argument('--cassette_file', default=DEFAULT_CASSETTE_FILE,
+                        help='Compressed file the --record traffic is saved to and --replay reads from')
+    parser.add_argument('--replay_latency', default=0.0,
+                        help='Seconds each replayed call waits, to simulate the real services')
+    parser.add_argument('--watch', action='store_true', default=False,
+                        help='Keep running, matching new dump rows and new Monarch transactions as they appear')
+    parser.add_argument('--watch_interval_seconds', default=DEFAULT_WATCH_INTERVAL_SECONDS,
+                        help='Seconds between sync cycles in --watch mode')
     parser.add_argument('--is_digital_order',
                         help='Set to True if processing a digital order')
     parser.add_argument('--start_date', default=get_first_of_previous_month(), required=False,
@@ -495,7 +3134,8 @@ def parse_args():
     final_args = {**cmd_args, **config_values}
 
     # Validate required arguments
-    required_args = ['api_key', 'email', 'password']
+    # In an --accounts run the credentials come from each account's config
+    required_args = ['api_key'] if final_args.get('accounts') else ['api_key', 'email', 'password']
     missing_args = [arg for arg in required_args if arg not in final_args]
     if missing_args:
         parser.error(f"Missing required arguments: {', '.join(missing_args)}")
@@ -505,39 +3145,229 @@ def parse_args():
 
 # Usage
 
+async def main_accounts(config_files: List[str], args: dict) -> None:
+    for option in ('watch', 'record', 'replay', 'retry_dead_letters'):
+        if args.get(option, False):
+            raise ValueError(f"--{option} can't be used with --accounts")
+    accounts = load_accounts(config_files, args)
+    for name, account_args in accounts.items():
+        logger.info(f"Account {name}: orders in {account_args['orders_dir']}, state in {account_args['state_file']}")
+    logger.info(f"Command: {args.get('command', 'run')}")
+
+    # One Anthropic client, so one connection pool, and one cache for every account. The cache is keyed by the
+    # category list, so answers are shared between the accounts whose category names match
+    client = LazyAsyncAnthropic(api_key=args['api_key'], max_retries=0, base_url=args.get('anthropic_base_url'))
+    cache = None
+    if not args.get('no_cache', False):
+        cache_ttl_days = float(args['cache_ttl_days']) if args.get('cache_ttl_days') else None
+        cache = ClassificationCache(args.get('cache_file', DEFAULT_CACHE_FILE),
+                                    int(args.get('cache_max_entries', DEFAULT_CACHE_MAX_ENTRIES)),
+                                    cache_ttl_days * 24 * 60 * 60 if cache_ttl_days is not None else None)
+    try:
+        await run_accounts(accounts, client, cache, args.get('metrics_file', DEFAULT_METRICS_FILE))
+    finally:
+        if cache is not None:
+            cache.close()
+
+
 async def main():
     args = parse_args()
-    category_ids = args.get('category_ids')
+    accounts = args.get('accounts')
+    if isinstance(accounts, str):
+        accounts = [config_file.strip() for config_file in accounts.split(',') if config_file.strip()]
+    logging.basicConfig(level=str(args.get('log_level', DEFAULT_LOG_LEVEL)).upper(),
+                        format=ACCOUNT_LOG_FORMAT if accounts else '%(message)s')
+    if accounts:
+        for handler in logging.getLogger().handlers:
+            handler.addFilter(AccountLogFilter())
+        await main_accounts(accounts, args)
+        return
+    options = run_options(args)
+    category_ids = options['category_ids']
     api_key = args['api_key']
-    csv_name = './Your Orders/Retail.OrderHistory.1/Retail.OrderHistory.1.csv'
-    digital_items_csv_name = './Your Orders/Digital-Ordering.1/Digital Items.csv'
-    digital_transaction_csv_name = './Your Orders/Digital-Ordering.1/Digital Orders Monetary.csv'
+    orders_dir = args.get('orders_dir', DEFAULT_ORDERS_DIR)
+    parse_workers = options['parse_workers']
     email = args['email']
     password = args['password']
-    sleep_seconds = float(args.get('sleep_seconds', 1.0))
-    start_date = args['start_date']
-    end_date = args['end_date']
-    dry_run = args.get('dry_run', False)
-
-    print(f"Monarch Category IDs: {category_ids}")
-    print(f"Anthropic API Key: {api_key}")
-    print(f"CSV Name: {csv_name}")
-    print(f"Digital CSV Name: {digital_items_csv_name}")
-    print(f"Digital Transaction CSV Name: {digital_transaction_csv_name}")
-    print(f"Monarch Email: {email}")
-    print(f"Monarch Password: {password}")
-    print(f"Sleep seconds: {sleep_seconds}")
-    print(f"start date: {start_date}")
-    print(f"end date: {end_date}")
-    print(f"Dry run mode: {dry_run}")
-
-    mm = MonarchMoney()
-    client = AsyncAnthropic(api_key=api_key)
-
-    await mm.login(email, password)
-    await match_and_update_transactions(mm, client, csv_name, digital_items_csv_name, digital_transaction_csv_name,
-                                        category_ids, sleep_seconds,
-                                        start_date, end_date, dry_run)
+    sleep_seconds = options['sleep_seconds']
+    max_concurrency = options['max_concurrency']
+    requests_per_second = options['requests_per_second']
+    start_date = options['start_date']
+    end_date = options['end_date']
+    dry_run = options['dry_run']
+    batch_size = options['batch_size']
+    use_message_batches = options['use_message_batches']
+    batch_poll_seconds = options['batch_poll_seconds']
+    anthropic_base_url = args.get('anthropic_base_url')
+    no_cache = args.get('no_cache', False)
+    state_file = args.get('state_file', DEFAULT_STATE_FILE)
+    write_concurrency = options['write_concurrency']
+    write_max_attempts = options['write_max_attempts']
+    dead_letter_file = options['dead_letter_file']
+    dry_run_file = options['dry_run_file']
+    merchant_searches = options['merchant_searches']
+    fetch_concurrency = options['fetch_concurrency']
+    resume = options['resume']
+    snapshot_dir = options['snapshot_dir']
+    cache_file = args.get('cache_file', DEFAULT_CACHE_FILE)
+    cache_max_entries = int(args.get('cache_max_entries', DEFAULT_CACHE_MAX_ENTRIES))
+    cache_ttl_days = float(args['cache_ttl_days']) if args.get('cache_ttl_days') else None
+    session_file = args.get('session_file', DEFAULT_SESSION_FILE)
+    categories_cache_file = options['categories_cache_file']
+    categories_refresh_hours = options['categories_refresh_seconds'] / (60 * 60)
+    use_local_classifier = args.get('local_classifier', False)
+    local_classifier_file = args.get('local_classifier_file', DEFAULT_LOCAL_CLASSIFIER_FILE)
+    local_confidence = options['local_confidence']
+    retrain_local_classifier = args.get('retrain_local_classifier', False)
+    metrics_file = args.get('metrics_file', DEFAULT_METRICS_FILE)
+    profile = args.get('profile', False)
+    profile_file = args.get('profile_file', DEFAULT_PROFILE_FILE)
+    tolerance = options['tolerance']
+    record = args.get('record', False)
+    replay = args.get('replay', False)
+    cassette_file = args.get('cassette_file', DEFAULT_CASSETTE_FILE)
+    replay_latency = float(args.get('replay_latency', 0.0))
+    if record and replay:
+        raise ValueError("--record and --replay can't be used together")
+    if replay and use_message_batches:
+        raise ValueError("--message_batches can't be replayed from a cassette")
+    command = args.get('command', 'run')
+    plan_file = args.get('plan_file', DEFAULT_PLAN_FILE)
+    watch = args.get('watch', False)
+    if watch and command != 'run':
+        raise ValueError(f"--watch can't be used with the {command} command")
+    watch_interval_seconds = float(args.get('watch_interval_seconds', DEFAULT_WATCH_INTERVAL_SECONDS))
+
+    logger.info(f"Command: {command}")
+    logger.info(f"Monarch Category IDs: {category_ids}")
+    logger.info(f"Anthropic API Key: {api_key}")
+    logger.info(f"Orders folder: {orders_dir}")
+    logger.info(f"Parse workers: {parse_workers}")
+    logger.info(f"Monarch Email: {email}")
+    logger.info(f"Monarch Password: {password}")
+    logger.info(f"Sleep seconds: {sleep_seconds}")
+    logger.info(f"Max concurrency: {max_concurrency}")
+    logger.info(f"Requests per second: {requests_per_second}")
+    logger.info(f"start date: {start_date}")
+    logger.info(f"end date: {end_date}")
+    logger.info(f"Dry run mode: {dry_run}")
+    logger.info(f"Batch size: {batch_size}")
+    logger.info(f"Message batches mode: {use_message_batches}")
+    logger.info(f"Classification cache: {'disabled' if no_cache or record or replay else cache_file}")
+    logger.info(f"Order snapshot directory: {snapshot_dir or 'disabled'}")
+    logger.info(f"State file: {state_file}")
+    logger.info(f"Resume: {resume}")
+    logger.info(f"Write concurrency: {write_concurrency}")
+    logger.info(f"Dead letter file: {dead_letter_file}")
+    logger.info(f"Plan file: {plan_file}")
+    logger.info(f"Merchant searches: {merchant_searches}")
+    logger.info(f"Fetch concurrency: {fetch_concurrency}")
+    logger.info(f"Session file: {session_file}")
+    logger.info(f"Categories cache: {'disabled' if record or replay else categories_cache_file}, "
+                f"refreshed every {categories_refresh_hours} hours")
+    logger.info(f"Local classifier: {local_classifier_file if use_local_classifier else 'disabled'}")
+    logger.info(f"Local confidence: {local_confidence}")
+    logger.info(f"Metrics file: {metrics_file}")
+    logger.info(f"Profile: {profile_file if profile else 'disabled'}")
+    logger.info(f"Amount tolerance: {tolerance}")
+    logger.info(f"Cassette: {f'recording to {cassette_file}' if record else f'replaying {cassette_file}' if replay else 'disabled'}")
+    logger.info(f"Watch: {f'every {watch_interval_seconds:g}s' if watch else 'disabled'}")
+
+    metrics = RunMetrics()
+    metrics.timings['import'] = MODULE_LOAD_SECONDS
+    profiler = None
+    if profile:
+        tracemalloc.start()
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    mm = MonarchSession(MonarchMoney(session_file=session_file), email, password)
+    # Retries are left to the adaptive rate limiter so it can see throttling responses
+    client = LazyAsyncAnthropic(api_key=api_key, max_retries=0, base_url=anthropic_base_url)
+    cassette = None
+    if record:
+        cassette = Cassette(cassette_file)
+        mm, client = CassetteMonarch(cassette, mm), CassetteAnthropic(cassette, client)
+    elif replay:
+        cassette = Cassette(cassette_file).load()
+        mm, client = CassetteMonarch(cassette, latency=replay_latency), CassetteAnthropic(cassette, latency=replay_latency)
+    if cassette is not None:
+        # Always ask for the categories and classifications so they are part of the recording, and a replay neither
+        # reads nor changes the local caches
+        categories_cache_file = options['categories_cache_file'] = None
+
+    cache = None
+    if not no_cache and cassette is None:
+        cache = ClassificationCache(cache_file, cache_max_entries,
+                                    cache_ttl_days * 24 * 60 * 60 if cache_ttl_days is not None else None)
+
+    # A replayed run didn't really update Monarch, so it must not be journaled
+    state = StateStore(':memory:' if replay else state_file)
+
+    local_classifier = None
+    if use_local_classifier:
+        local_classifier = LocalClassifier(local_classifier_file)
+        if retrain_local_classifier:
+            local_classifier.reset()
+        if replay:
+            local_classifier.path = None  # learns during the replay but is never saved
+
+    with metrics.phase('login'):
+        await mm.login()
+        metrics.count('session_reused', int(mm.reused_session))
+    try:
+        if args.get('retry_dead_letters', False):
+            await retry_dead_letters(mm, dead_letter_file, state, write_concurrency, write_max_attempts, metrics)
+            return
+        if watch:
+            stop = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for signal_number in (signal.SIGINT, signal.SIGTERM):
+                try:
+                    loop.add_signal_handler(signal_number, stop.set)
+                except NotImplementedError:  # Windows event loops, where Ctrl+C raises KeyboardInterrupt instead
+                    pass
+            limiter = classification_limiter(requests_per_second, sleep_seconds)
+            if dry_run:
+                clear_dry_run_file(dry_run_file)
+            watcher = Watcher(mm, client, orders_dir,
+                              category_ids, start_date, state, limiter, metrics, snapshot_dir, merchant_searches,
+                              fetch_concurrency, categories_cache_file, categories_refresh_hours * 60 * 60, dry_run,
+                              tolerance, parse_workers,
+                              max_concurrency=max_concurrency, cache=cache, batch_size=batch_size,
+                              use_message_batches=use_message_batches, batch_poll_seconds=batch_poll_seconds,
+                              write_concurrency=write_concurrency, write_max_attempts=write_max_attempts,
+                              dead_letter_file=dead_letter_file, dry_run_file=dry_run_file,
+                              local_classifier=local_classifier, local_confidence=local_confidence)
+            logger.info(f"Watching for new rows and transactions every {watch_interval_seconds:g}s, "
+                        f"press Ctrl+C to stop")
+            await watcher.run(watch_interval_seconds, stop, metrics_file)
+            return
+        if command == 'apply':
+            await apply_plan(mm, plan_file, state, metrics=metrics, **apply_options(options))
+            return
+        if command == 'plan':
+            # A plan is a dry run saved for review, so it starts from an empty file and never journals
+            options.update(dry_run=True, dry_run_file=plan_file)
+        order_files = discover_order_files(orders_dir)
+        for path in order_files.paths:
+            logger.info(f"  {path}")
+        await match_and_update_transactions(mm, client, order_files, cache=cache, state=state, metrics=metrics,
+                                            local_classifier=local_classifier, **options)
+        if command == 'plan':
+            logger.info(f"Review the plan in {plan_file}, then write it to Monarch with `python main.py apply`")
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            report_profile(profiler, profile_file, metrics)
+        if record:
+            cassette.save()
+        elif replay:
+            logger.info(f"Replayed {cassette.replayed} responses, {cassette.misses} requests were not recorded")
+        metrics.write(metrics_file)
+        state.close()
+        if cache is not None:
+            cache.close()
 
 
 if __name__ == '__main__':
@@ -46,6 +46,7 @@ setup(
         "pandas==2.2.3",
         "path==16.12.1",
         "pprintpp==0.4.0",
+        "pyarrow==18.0.0",
         "pycares==4.4.0",
         "pycparser==2.22",
         "pydantic==2.7.1",
@@ -68,5 +69,5 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Operating System :: OS Independent',
     ],
-    python_requires='>=3.6',
+    python_requires='>=3.10',
 )
\ No newline at end of file
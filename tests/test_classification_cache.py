@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+import main
+
+CATEGORIES = ['Groceries', 'Electronics']
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = main.ClassificationCache(str(tmp_path / 'cache.sqlite3'), max_entries=3)
+    yield cache
+    cache.close()
+
+
+class SlowClassifier:
+    """Answers each key with the category named after its first word, after yielding so callers can overlap."""
+
+    def __init__(self, error: Exception = None):
+        self.calls = []
+        self.error = error
+
+    async def __call__(self, keys):
+        self.calls.append(list(keys))
+        await asyncio.sleep(0.01)
+        if self.error is not None:
+            raise self.error
+        return [key.split()[0] if key.split()[0] in CATEGORIES else 'Not a category' for key in keys]
+
+
+def test_concurrent_lookups_share_one_request(cache):
+    classify = SlowClassifier()
+
+    async def run():
+        return await asyncio.gather(cache.get_or_classify(['Groceries milk', 'Electronics cable'], classify, CATEGORIES),
+                                    cache.get_or_classify(['Groceries milk'], classify, CATEGORIES))
+
+    assert asyncio.run(run()) == [['Groceries', 'Electronics'], ['Groceries']]
+    assert classify.calls == [['Groceries milk', 'Electronics cable']]
+    assert (cache.misses, cache.shared, cache.hits) == (2, 1, 0)
+
+    assert asyncio.run(cache.get_or_classify(['Groceries milk'], classify, CATEGORIES)) == ['Groceries']
+    assert len(classify.calls) == 1 and cache.hits == 1
+
+
+def test_answers_outside_the_category_list_are_not_cached(cache):
+    classify = SlowClassifier()
+    for _ in range(2):
+        assert asyncio.run(cache.get_or_classify(['Toys blocks'], classify, CATEGORIES)) == ['Not a category']
+    assert len(classify.calls) == 2
+
+
+def test_failure_reaches_every_waiter_and_is_not_remembered(cache):
+    failing = SlowClassifier(error=RuntimeError('overloaded'))
+
+    async def run():
+        return await asyncio.gather(cache.get_or_classify(['Groceries milk'], failing, CATEGORIES),
+                                    cache.get_or_classify(['Groceries milk'], failing, CATEGORIES),
+                                    return_exceptions=True)
+
+    assert [type(result) for result in asyncio.run(run())] == [RuntimeError, RuntimeError]
+    assert len(failing.calls) == 1
+
+    classify = SlowClassifier()
+    assert asyncio.run(cache.get_or_classify(['Groceries milk'], classify, CATEGORIES)) == ['Groceries']
+    assert len(classify.calls) == 1
+
+
+def test_least_recently_used_entries_are_evicted(cache, monkeypatch):
+    clock = iter(range(100))
+    monkeypatch.setattr(main.time, 'time', lambda: next(clock))
+    for key in ('a', 'b', 'c'):
+        cache.put(key, 'Groceries')
+    cache.get('a')
+    cache.put('d', 'Groceries')
+    assert [cache.get(key) for key in ('a', 'b', 'c', 'd')] == ['Groceries', None, 'Groceries', 'Groceries']
+
+
+def test_expired_entries_are_ignored(tmp_path):
+    cache = main.ClassificationCache(str(tmp_path / 'cache.sqlite3'), ttl_seconds=-1)
+    cache.put('a', 'Groceries')
+    assert cache.get('a') is None
+    cache.close()
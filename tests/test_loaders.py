@@ -0,0 +1,67 @@
+import csv
+import os
+
+import pytest
+
+import main
+
+RETAIL_HEADER = [main.RETAIL_ORDER_ID_COLUMN, main.RETAIL_ORDER_DATE_COLUMN, main.RETAIL_DESCRIPTION_COLUMN,
+                 main.RETAIL_SUB_TOTAL_COLUMN, main.RETAIL_DELIVERY_DATE_COLUMN]
+
+
+def write_csv(path: str, header: list, rows: list) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8-sig', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+@pytest.fixture
+def order_files(tmp_path) -> main.OrderFiles:
+    """A dump with two overlapping retail shards and a digital shard with credits and 'Not Applicable' rows."""
+    first = [['111-1', '2024-01-05T10:00:00Z', 'Kettle', '1,234.56', '2024-01-07T00:00:00Z'],
+             ['111-2', '2024-01-06T11:00:00Z', 'Socks', '4.99', '2024-01-08T00:00:00Z'],
+             ['111-2', '2024-01-06T11:00:00Z', 'Socks', '4.99', '2024-01-08T00:00:00Z'],
+             ['111-3', '2024-01-09T12:00:00Z', 'Lamp', '20.00', main.NOT_AVAILABLE],
+             ['111-4', '2023-06-01T12:00:00Z', 'Too old', '1.00', '2023-06-02T00:00:00Z']]
+    second = [first[1], ['111-5', '2024-02-01T09:30:00Z', 'Refunded', '-3.50', 'not a date']]
+    write_csv(str(tmp_path / 'Retail.OrderHistory.1' / 'Retail.OrderHistory.1.csv'), RETAIL_HEADER, first)
+    write_csv(str(tmp_path / 'Retail.OrderHistory.2' / 'Retail.OrderHistory.2.csv'), RETAIL_HEADER, second)
+
+    digital = tmp_path / 'Digital-Ordering.1'
+    write_csv(str(digital / main.DIGITAL_ITEMS_FILE),
+              [main.DIGITAL_ITEM_ID_COLUMN, main.DIGITAL_ORDER_DATE_COLUMN, main.DIGITAL_DESCRIPTION_COLUMN,
+               main.DIGITAL_DELIVERY_DATE_COLUMN],
+              [['D01', '2024-01-10T08:00:00Z', 'Album', '2024-01-10T08:01:00Z'],
+               ['D02', '2024-01-11T08:00:00Z', 'Free app', ''],
+               ['D03', '2024-01-12T08:00:00Z', 'Rental', '2024-01-12T08:00:00Z']])
+    write_csv(str(digital / main.DIGITAL_MONETARY_FILE),
+              [main.DIGITAL_ITEM_ID_COLUMN, main.DIGITAL_AMOUNT_COLUMN],
+              [['D01', '9.99'], ['D01', '-2.00'], ['D01', 'Not Applicable'], ['D03', '-5.00']])
+    return main.discover_order_files(str(tmp_path))
+
+
+def load(order_files: main.OrderFiles, snapshot_dir=None, workers: int = 1) -> list:
+    items = main.iter_order_items(order_files, '2024-01-01', '2024-12-31', snapshot_dir, workers=workers)
+    return sorted(items, key=lambda item: (item.is_digital, item.order_id, item.occurrence))
+
+
+def test_streaming_and_columnar_loaders_agree(order_files, tmp_path):
+    streamed = load(order_files)
+    assert len(streamed) == 8
+    assert streamed == load(order_files, str(tmp_path / 'snapshots'))
+
+
+def test_worker_processes_parse_the_same_items(order_files):
+    assert load(order_files, workers=3) == load(order_files)
+
+
+def test_digital_amounts_sum_signed_rows(order_files):
+    cents = {item.order_id: item.cents for item in load(order_files) if item.is_digital}
+    assert cents == {'D01': 799, 'D02': None, 'D03': 500}
+
+
+def test_identical_rows_are_kept_once_across_shards(order_files):
+    socks = [item for item in load(order_files) if item.order_id == '111-2']
+    assert [item.occurrence for item in socks] == [0, 1]
@@ -0,0 +1,107 @@
+import itertools
+import random
+from datetime import date
+
+import pytest
+
+import main
+
+FIRST_DAY = date(2024, 1, 1).toordinal()
+
+
+def make_transaction(number: int, cents: int, day: int) -> dict:
+    return {'id': f'txn-{number}', 'amount': -cents / 100, 'date': date.fromordinal(day).isoformat()}
+
+
+def random_component(rng: random.Random):
+    """A small candidate graph with random edges and integer costs, plus the nodes it was built for."""
+    node_count, transaction_count = rng.randint(2, 5), rng.randint(1, 5)
+    transactions = [make_transaction(number, 1000, FIRST_DAY + number) for number in range(transaction_count)]
+    nodes = [main.MatchNode(1000, FIRST_DAY, FIRST_DAY + rng.randint(0, 10)) for _ in range(node_count)]
+    edges = [[(transaction, rng.randint(0, 6)) for transaction in transactions if rng.random() < 0.5]
+             for _ in nodes]
+    if not edges[0]:
+        edges[0].append((rng.choice(transactions), rng.randint(0, 6)))
+    return nodes, transactions, edges
+
+
+def score(assigned: dict, edges) -> tuple:
+    """(matched nodes, total cost) of an assignment, checking it only uses real edges and distinct transactions."""
+    transaction_ids = [transaction['id'] for transaction in assigned.values()]
+    assert len(transaction_ids) == len(set(transaction_ids))
+    total = 0
+    for node_id, transaction in assigned.items():
+        costs = [cost for candidate, cost in edges[node_id] if candidate['id'] == transaction['id']]
+        assert costs, f'node {node_id} was given a transaction it has no edge to'
+        total += min(costs)
+    return len(assigned), total
+
+
+def brute_force(node_ids, edges) -> tuple:
+    """The best (matched nodes, total cost) found by trying every way to give each node one edge or none."""
+    best = (0, 0)
+    for choice in itertools.product(*[[None] + edges[node_id] for node_id in node_ids]):
+        chosen = [edge for edge in choice if edge is not None]
+        if len({transaction['id'] for transaction, _ in chosen}) < len(chosen):
+            continue
+        candidate = (len(chosen), sum(cost for _, cost in chosen))
+        if candidate[0] > best[0] or (candidate[0] == best[0] and candidate[1] < best[1]):
+            best = candidate
+    return best
+
+
+@pytest.mark.parametrize('seed', range(400))
+def test_assign_component_matches_brute_force(seed):
+    nodes, transactions, edges = random_component(random.Random(seed))
+    node_ids = list(range(len(nodes)))
+    transaction_ids = [transaction['id'] for transaction in transactions]
+    assigned = main.assign_component(node_ids, transaction_ids, edges, nodes)
+    assert score(assigned, edges) == brute_force(node_ids, edges)
+
+
+def maximum_matching(edges) -> int:
+    """Size of a maximum bipartite matching, by augmenting paths."""
+    owner = {}
+
+    def augment(node_id, seen):
+        for transaction, _ in edges[node_id]:
+            if transaction['id'] in seen:
+                continue
+            seen.add(transaction['id'])
+            if transaction['id'] not in owner or augment(owner[transaction['id']], seen):
+                owner[transaction['id']] = node_id
+                return True
+        return False
+
+    return sum(augment(node_id, set()) for node_id in range(len(edges)))
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_large_component_matches_as_many_nodes_as_possible(seed):
+    rng = random.Random(seed)
+    nodes = []
+    for _ in range(main.MAX_EXACT_ASSIGNMENT_SIZE):
+        order_day = FIRST_DAY + rng.randint(0, 40)
+        nodes.append(main.MatchNode(1000, order_day, order_day + rng.randint(0, 10)))
+    transactions = [make_transaction(number, 1000, FIRST_DAY + rng.randint(0, 50)) for number in range(60)]
+    index = main.TransactionIndex(transactions)
+    edges = main.candidate_edges(nodes, index)
+    node_ids = [node_id for node_id, node_edges in enumerate(edges) if node_edges]
+    transaction_ids = list({transaction['id']: None for node_id in node_ids for transaction, _ in edges[node_id]})
+    assert len(node_ids) + len(transaction_ids) > main.MAX_EXACT_ASSIGNMENT_SIZE
+
+    assigned = main.assign_component(node_ids, transaction_ids, edges, nodes)
+    matched, _ = score(assigned, edges)
+    assert matched == maximum_matching(edges)
+
+
+def test_assign_transactions_removes_assigned_transactions():
+    transactions = [make_transaction(0, 1000, FIRST_DAY + 1), make_transaction(1, 1000, FIRST_DAY + 3),
+                    make_transaction(2, 2500, FIRST_DAY + 2)]
+    index = main.TransactionIndex(transactions)
+    nodes = [main.MatchNode(1000, FIRST_DAY + 3, FIRST_DAY + 5), main.MatchNode(1000, FIRST_DAY, FIRST_DAY + 2),
+             main.MatchNode(4000, FIRST_DAY, FIRST_DAY + 2)]
+    assignment = main.assign_transactions(nodes, index)
+    assert [transaction and transaction['id'] for transaction in assignment] == ['txn-1', 'txn-0', None]
+    assert len(index) == 1 and 'txn-2' in index
+
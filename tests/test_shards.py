@@ -0,0 +1,35 @@
+import os
+
+import main
+
+
+def row(order_id: str, cents: int = 499, description: str = 'Socks') -> tuple:
+    return order_id, description, 738900, 738898, cents, False
+
+
+def test_rows_repeated_across_shards_are_kept_once():
+    first = [row('111-1'), row('111-1'), row('111-2')]
+    second = [row('111-1'), row('111-2'), row('111-3')]
+    merged = main.merge_shard_items([first, second])
+    assert [item.order_id for item in merged] == ['111-1', '111-1', '111-2', '111-3']
+
+
+def test_a_shard_with_more_copies_of_a_row_adds_only_the_extra_copies():
+    merged = main.merge_shard_items([[row('111-1')], [row('111-1'), row('111-1'), row('111-1', cents=500)]])
+    assert [(item.order_id, item.cents) for item in merged] == [('111-1', 499), ('111-1', 499), ('111-1', 500)]
+
+
+def test_every_retail_and_digital_shard_is_discovered(tmp_path):
+    for folder, name in [('Retail.OrderHistory.2', 'Retail.OrderHistory.2.csv'),
+                         ('Retail.OrderHistory.1', 'Retail.OrderHistory.1.csv'),
+                         ('Digital-Ordering.1', main.DIGITAL_ITEMS_FILE)]:
+        os.makedirs(tmp_path / folder)
+        (tmp_path / folder / name).write_text('')
+    (tmp_path / 'Digital-Ordering.2').write_text('not a folder')
+
+    order_files = main.discover_order_files(str(tmp_path))
+    assert [os.path.relpath(path, tmp_path) for path in order_files.retail] == [
+        os.path.join('Retail.OrderHistory.1', 'Retail.OrderHistory.1.csv'),
+        os.path.join('Retail.OrderHistory.2', 'Retail.OrderHistory.2.csv')]
+    assert order_files.digital == ((str(tmp_path / 'Digital-Ordering.1' / main.DIGITAL_ITEMS_FILE),
+                                    str(tmp_path / 'Digital-Ordering.1' / main.DIGITAL_MONETARY_FILE)),)
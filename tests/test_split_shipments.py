@@ -0,0 +1,55 @@
+import itertools
+import random
+from datetime import date
+
+import pytest
+
+import main
+
+ORDER_DAY = date(2024, 3, 1).toordinal()
+
+
+def make_transaction(number: int, cents: int, day: int) -> dict:
+    return {'id': f'txn-{number}', 'amount': -cents / 100, 'date': date.fromordinal(day).isoformat()}
+
+
+def make_order(*item_cents: int) -> main.AggregatedOrder:
+    return main.AggregatedOrder('112-1', [main.OrderItem('112-1', f'Item {position}', ORDER_DAY + 2, ORDER_DAY,
+                                                         cents, False)
+                                          for position, cents in enumerate(item_cents)])
+
+
+@pytest.mark.parametrize('seed', range(100))
+def test_reachable_subset_sums_matches_brute_force(seed):
+    rng = random.Random(seed)
+    item_cents = [rng.randint(1, 3000) for _ in range(rng.randint(1, 8))]
+    limit = rng.randint(0, sum(item_cents))
+    reachable = main.reachable_subset_sums(item_cents, limit)
+
+    totals = {sum(subset) for size in range(len(item_cents) + 1)
+              for subset in itertools.combinations(item_cents, size)}
+    assert set(reachable) == {total for total in totals if total <= limit}
+    for total, (_, _, count) in reachable.items():
+        positions = main.subset_for_total(reachable, total)
+        assert len(positions) == len(set(positions)) == count
+        assert sum(item_cents[position] for position in positions) == total
+
+
+def test_order_charged_per_shipment_is_matched_per_shipment():
+    index = main.TransactionIndex([make_transaction(0, 2500, ORDER_DAY + 1), make_transaction(1, 1200, ORDER_DAY + 3),
+                                   make_transaction(2, 900, ORDER_DAY + 2)])
+    matches, unmatched_rows = main.match_split_shipments([make_order(1000, 1500, 700, 500)], index)
+
+    assert {match.transaction_id: match.description for match in matches} == \
+        {'txn-0': 'Item 0 Item 1', 'txn-1': 'Item 2 Item 3'}
+    assert unmatched_rows == []
+    assert list(index) == [make_transaction(2, 900, ORDER_DAY + 2)]
+
+
+def test_charges_outside_the_window_are_not_matched():
+    index = main.TransactionIndex([make_transaction(0, 2500, ORDER_DAY + 30)])
+    matches, unmatched_rows = main.match_split_shipments([make_order(1000, 1500, 700)], index)
+
+    assert matches == []
+    assert [row.cents for row in unmatched_rows] == [3200]
+    assert len(index) == 1
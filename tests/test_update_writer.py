@@ -0,0 +1,89 @@
+import asyncio
+import os
+
+import pytest
+
+import main
+
+
+class FlakyMonarch:
+    """Fails each transaction's first failures[transaction_id] updates, then accepts them."""
+
+    def __init__(self, **failures: int):
+        self.failures = failures
+        self.calls = []
+        self.updated = {}
+
+    async def update_transaction(self, transaction_id: str, notes: str, category_id: str) -> None:
+        self.calls.append(transaction_id)
+        if self.failures.get(transaction_id, 0) > 0:
+            self.failures[transaction_id] -= 1
+            raise ConnectionError(f'update of {transaction_id} failed')
+        self.updated[transaction_id] = (notes, category_id)
+
+
+class FailingStateStore(main.StateStore):
+    def record_update(self, update: main.MonarchUpdate) -> None:
+        raise OSError('disk full')
+
+
+def make_update(transaction_id: str) -> main.MonarchUpdate:
+    return main.MonarchUpdate(transaction_id, f'Notes for {transaction_id}', 'category-1', 'Groceries',
+                              'PRE-AGGREGATION', (f'row-{transaction_id}',), ('111-1',))
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(main, 'WRITE_BACKOFF_SECONDS', 0.0)
+
+
+async def write(mm, updates, **options) -> main.UpdateWriter:
+    async with main.UpdateWriter(mm, concurrency=2, **options) as writer:
+        for update in updates:
+            await writer.submit(update)
+    return writer
+
+
+def test_failed_updates_are_retried_and_journaled(tmp_path):
+    mm = FlakyMonarch(a=2)
+    state = main.StateStore(':memory:')
+    writer = asyncio.run(write(mm, [make_update('a'), make_update('b'), make_update('a')], max_attempts=3,
+                               dead_letter_file=str(tmp_path / 'dead.jsonl'), state=state))
+
+    assert (writer.written, writer.failed, writer.duplicates) == (2, 0, 1)
+    assert sorted(mm.calls) == ['a', 'a', 'a', 'b']
+    assert state.matched_transactions() == {'a', 'b'}
+    assert not os.path.exists(tmp_path / 'dead.jsonl')
+
+
+def test_exhausted_updates_are_dead_lettered_and_replayed(tmp_path):
+    dead_letter_file = str(tmp_path / 'dead.jsonl')
+    writer = asyncio.run(write(FlakyMonarch(a=5), [make_update('a'), make_update('b')], max_attempts=2,
+                               dead_letter_file=dead_letter_file))
+    assert (writer.written, writer.failed) == (1, 1)
+    assert main.load_updates(dead_letter_file) == [make_update('a')]
+
+    mm = FlakyMonarch()
+    state = main.StateStore(':memory:')
+    asyncio.run(main.retry_dead_letters(mm, dead_letter_file, state, max_attempts=2))
+    assert mm.updated == {'a': ('Notes for a', 'category-1')}
+    assert state.matched_transactions() == {'a'}
+    assert not os.path.exists(dead_letter_file) and not os.path.exists(dead_letter_file + '.replaying')
+
+
+def test_dry_run_writes_updates_to_the_file_only(tmp_path):
+    mm = FlakyMonarch()
+    dry_run_file = str(tmp_path / 'dry.jsonl')
+    writer = asyncio.run(write(mm, [make_update('a'), make_update('b')], dry_run_file=dry_run_file,
+                               dead_letter_file=str(tmp_path / 'dead.jsonl')))
+    assert writer.written == 2 and mm.calls == []
+    assert sorted(main.load_updates(dry_run_file)) == [make_update('a'), make_update('b')]
+
+
+def test_workers_survive_journaling_errors(tmp_path):
+    mm = FlakyMonarch()
+    writer = asyncio.run(asyncio.wait_for(
+        write(mm, [make_update(transaction_id) for transaction_id in 'abcde'],
+              dead_letter_file=str(tmp_path / 'dead.jsonl'), state=FailingStateStore(':memory:')), timeout=5))
+    assert sorted(mm.updated) == list('abcde')
+    assert writer.errors == 5